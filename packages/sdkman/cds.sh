@@ -0,0 +1,72 @@
+#!/usr/bin/env bash
+# Record the classes the compilers and runtimes load on typical submissions and store them in class data sharing
+# archives in /opt/cds, which the rules in languages/ pass to the JVMs. With -Xshare:auto, a JVM that cannot use an
+# archive (e.g. because the JDK was updated without rebuilding the package) loads classes the slow way instead of
+# failing.
+set -e
+
+out=/opt/cds
+mkdir -p "$out"
+cd "$(mktemp -d)"
+
+cat >Main.java <<'END'
+import java.io.*;
+import java.util.*;
+
+class Main {
+    public static void main(String[] args) throws IOException {
+        BufferedReader in = new BufferedReader(new InputStreamReader(System.in));
+        List<Long> numbers = new ArrayList<>();
+        String line;
+        while ((line = in.readLine()) != null) {
+            StringTokenizer tokens = new StringTokenizer(line);
+            while (tokens.hasMoreTokens()) {
+                numbers.add(Long.parseLong(tokens.nextToken()));
+            }
+        }
+        Collections.sort(numbers);
+        Map<Long, Integer> counts = new HashMap<>();
+        for (long number : numbers) {
+            counts.merge(number, 1, Integer::sum);
+        }
+        StringBuilder sb = new StringBuilder();
+        sb.append(String.format("%d %d%n", numbers.size(), counts.size()));
+        System.out.print(sb);
+    }
+}
+END
+
+cat >main.kt <<'END'
+fun main() {
+    val numbers = generateSequence(::readLine).flatMap { it.split(" ").asSequence() }.filter { it.isNotEmpty() }.map { it.toLong() }.toMutableList()
+    numbers.sort()
+    val counts = numbers.groupingBy { it }.eachCount()
+    println("${numbers.size} ${counts.size}")
+}
+END
+
+cat >main.scala <<'END'
+object Main {
+  def main(args: Array[String]): Unit = {
+    val numbers = scala.io.Source.stdin.getLines().flatMap(_.split(" ")).filter(_.nonEmpty).map(_.toLong).toVector.sorted
+    val counts = numbers.groupBy(identity).map { case (k, v) => k -> v.size }
+    println(s"${numbers.size} ${counts.size}")
+  }
+}
+END
+
+printf '3 1 2\n2 5\n' >input
+
+# The classes of the compilers come from the JDK or from a fixed classpath, so dynamic archives on top of the default
+# CDS archive of the JDK apply to every run
+javac -J-XX:ArchiveClassesAtExit="$out/javac.jsa" Main.java
+jar -J-XX:ArchiveClassesAtExit="$out/jar.jsa" cfe main.jar Main Main.class
+kotlinc -J-XX:ArchiveClassesAtExit="$out/kotlinc.jsa" main.kt -d kotlin.jar
+scalac -J-XX:ArchiveClassesAtExit="$out/scalac.jsa" main.scala -d scala.jar
+kotlin -J-XX:ArchiveClassesAtExit="$out/kotlin.jsa" kotlin.jar <input >/dev/null
+scala -J-XX:ArchiveClassesAtExit="$out/scala.jsa" scala.jar <input >/dev/null
+
+# The classpath of `java -jar` is the submission itself, which a dynamic archive would never match. A static archive of
+# the JDK classes a typical program loads works with any classpath.
+java -XX:DumpLoadedClassList=java.classlist -jar main.jar <input >/dev/null
+java -Xshare:dump -XX:SharedClassListFile=java.classlist -XX:SharedArchiveFile="$out/java.jsa" -Xlog:cds=off
@@ -0,0 +1,25 @@
+#include <assert.h>
+#include <ctype.h>
+#include <errno.h>
+#include <float.h>
+#include <inttypes.h>
+#include <limits.h>
+#include <math.h>
+#include <stdbool.h>
+#include <stddef.h>
+#include <stdint.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <time.h>
+
+static int compare(const void *a, const void *b) {
+	return strcmp(*(const char **)a, *(const char **)b);
+}
+
+int main() {
+	const char *words[] = {"world!", "Hello,"};
+	qsort(words, 2, sizeof(words[0]), compare);
+	printf("%s %s\n", words[0], words[1]);
+	return 0;
+}
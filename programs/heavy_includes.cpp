@@ -0,0 +1,11 @@
+#include <bits/stdc++.h>
+using namespace std;
+
+int main() {
+	map<string, vector<int>> m;
+	m["Hello, world!"].push_back(1);
+	unordered_set<int> s(m.begin()->second.begin(), m.begin()->second.end());
+	priority_queue<pair<int, string>> q;
+	q.emplace(*s.begin(), m.begin()->first);
+	cout << q.top().second << endl;
+}
@@ -0,0 +1,15 @@
+using System;
+using System.Collections.Generic;
+using System.IO;
+using System.Linq;
+using System.Text;
+
+public class HeavyIncludes {
+    public static void Main(string[] args) {
+        var counts = new SortedDictionary<string, int>();
+        foreach (var word in "Hello, world!".Split(' ')) {
+            counts[word] = counts.TryGetValue(word, out var n) ? n + 1 : 1;
+        }
+        Console.WriteLine(string.Join(" ", counts.Keys.OrderBy(w => w)));
+    }
+}
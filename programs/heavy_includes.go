@@ -0,0 +1,37 @@
+package main
+
+import (
+	"bufio"
+	"container/heap"
+	"fmt"
+	"math/big"
+	"os"
+	"regexp"
+	"sort"
+	"strings"
+)
+
+type intHeap []int
+
+func (h intHeap) Len() int            { return len(h) }
+func (h intHeap) Less(i, j int) bool  { return h[i] < h[j] }
+func (h intHeap) Swap(i, j int)       { h[i], h[j] = h[j], h[i] }
+func (h *intHeap) Push(x interface{}) { *h = append(*h, x.(int)) }
+func (h *intHeap) Pop() interface{} {
+	old := *h
+	x := old[len(old)-1]
+	*h = old[:len(old)-1]
+	return x
+}
+
+func main() {
+	h := &intHeap{2, 1}
+	heap.Init(h)
+	words := regexp.MustCompile(`\w+`).FindAllString("world Hello", -1)
+	sort.Strings(words)
+	w := bufio.NewWriter(os.Stdout)
+	defer w.Flush()
+	if big.NewInt(int64(heap.Pop(h).(int))).Sign() > 0 {
+		fmt.Fprintln(w, strings.Join(words, ", ")+"!")
+	}
+}
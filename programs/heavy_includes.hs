@@ -0,0 +1,11 @@
+import qualified Data.Map.Strict as Map
+import qualified Data.Set as Set
+import Data.List (intercalate, sortOn)
+import Data.Char (isSpace)
+import Control.Monad (forM_)
+
+main :: IO ()
+main = do
+  let counts = Map.fromListWith (+) [(w, 1 :: Int) | w <- words "Hello, world!"]
+      unique = Set.fromList (Map.keys counts)
+  putStrLn (intercalate " " (sortOn id (Set.toList unique)))
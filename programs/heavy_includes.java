@@ -0,0 +1,16 @@
+import java.io.*;
+import java.util.*;
+import java.util.function.*;
+import java.util.stream.*;
+
+class HeavyIncludes {
+    public static void main(String[] args) {
+        Map<String, Integer> counts = new TreeMap<>();
+        for (String word : "Hello, world!".split(" ")) {
+            counts.merge(word, 1, Integer::sum);
+        }
+        PrintWriter out = new PrintWriter(new BufferedWriter(new OutputStreamWriter(System.out)));
+        out.println(counts.keySet().stream().collect(Collectors.joining(" ")));
+        out.flush();
+    }
+}
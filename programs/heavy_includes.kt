@@ -0,0 +1,9 @@
+import java.util.*
+
+fun main() {
+    val counts = TreeMap<String, Int>()
+    for (word in "Hello, world!".split(" ")) {
+        counts.merge(word, 1, Int::plus)
+    }
+    println(counts.keys.sortedBy { it }.joinToString(" "))
+}
@@ -0,0 +1,17 @@
+import bisect
+import collections
+import datetime
+import decimal
+import fractions
+import functools
+import heapq
+import itertools
+import json
+import math
+import operator
+import random
+import re
+import string
+
+words = collections.Counter(re.findall(r"\w+", "Hello world"))
+print(", ".join(sorted(words)) + "!")
@@ -0,0 +1,19 @@
+use std::collections::{BTreeMap, BinaryHeap, HashMap, HashSet, VecDeque};
+use std::io::{self, BufWriter, Write};
+
+fn main() {
+    let mut counts: HashMap<&str, usize> = HashMap::new();
+    for word in "Hello, world!".split(' ') {
+        *counts.entry(word).or_default() += 1;
+    }
+    let ordered: BTreeMap<_, _> = counts.into_iter().collect();
+    let unique: HashSet<_> = ordered.keys().collect();
+    let mut heap: BinaryHeap<_> = unique.into_iter().map(|w| std::cmp::Reverse(*w)).collect();
+    let mut words = VecDeque::new();
+    while let Some(std::cmp::Reverse(word)) = heap.pop() {
+        words.push_back(word);
+    }
+    let out = io::stdout();
+    let mut out = BufWriter::new(out.lock());
+    writeln!(out, "{}", words.into_iter().collect::<Vec<_>>().join(" ")).unwrap();
+}
@@ -0,0 +1,11 @@
+#include <iostream>
+
+int main() {
+	std::ios::sync_with_stdio(false);
+	std::cin.tie(nullptr);
+	long long sum = 0, x;
+	while (std::cin >> x) {
+		sum += x;
+	}
+	std::cout << sum << std::endl;
+}
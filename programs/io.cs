@@ -0,0 +1,16 @@
+using System;
+using System.IO;
+
+public class Io {
+    public static void Main(string[] args) {
+        var input = new StreamReader(Console.OpenStandardInput());
+        long sum = 0;
+        string line;
+        while ((line = input.ReadLine()) != null) {
+            foreach (var token in line.Split(new[] {' '}, StringSplitOptions.RemoveEmptyEntries)) {
+                sum += long.Parse(token);
+            }
+        }
+        Console.WriteLine(sum);
+    }
+}
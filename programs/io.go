@@ -0,0 +1,19 @@
+package main
+
+import (
+	"bufio"
+	"fmt"
+	"os"
+	"strconv"
+)
+
+func main() {
+	scanner := bufio.NewScanner(os.Stdin)
+	scanner.Split(bufio.ScanWords)
+	var sum int64
+	for scanner.Scan() {
+		x, _ := strconv.ParseInt(scanner.Text(), 10, 64)
+		sum += x
+	}
+	fmt.Println(sum)
+}
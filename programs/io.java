@@ -0,0 +1,17 @@
+import java.io.*;
+import java.util.*;
+
+class Io {
+    public static void main(String[] args) throws IOException {
+        BufferedReader in = new BufferedReader(new InputStreamReader(System.in));
+        long sum = 0;
+        String line;
+        while ((line = in.readLine()) != null) {
+            StringTokenizer tokens = new StringTokenizer(line);
+            while (tokens.hasMoreTokens()) {
+                sum += Long.parseLong(tokens.nextToken());
+            }
+        }
+        System.out.println(sum);
+    }
+}
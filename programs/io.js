@@ -0,0 +1,8 @@
+const input = require("fs").readFileSync(0, "utf8");
+let sum = 0;
+for (const token of input.split(/\s+/)) {
+	if (token) {
+		sum += Number(token);
+	}
+}
+console.log(sum);
@@ -0,0 +1,12 @@
+fun main() {
+    val input = System.`in`.bufferedReader()
+    var sum = 0L
+    input.forEachLine { line ->
+        for (token in line.split(' ')) {
+            if (token.isNotEmpty()) {
+                sum += token.toLong()
+            }
+        }
+    }
+    println(sum)
+}
@@ -0,0 +1,104 @@
+from __future__ import annotations
+
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+import os
+import struct
+import threading
+from typing import BinaryIO
+import zstandard
+
+
+# Writer of the zstd seekable format (https://github.com/facebook/zstd/tree/dev/contrib/seekable_format): the data is
+# split into independently compressed frames, followed by a skippable frame listing their sizes. Decompressors that
+# don't know about seekable zstd still see a valid multi-frame zstd file, and the ones that do (ratarmount, via
+# indexed_zstd) can decompress any part of the archive without reading what's before it. The frames are compressed in
+# parallel.
+
+SKIPPABLE_FRAME_MAGIC = 0x184D2A5E
+SEEKABLE_MAGIC = 0x8F92EAB1
+
+
+class SeekableZstdWriter:
+    def __init__(self, f: BinaryIO, level: int=3, frame_size: int=4 * 2 ** 20, threads: int=0):
+        threads = threads or os.cpu_count()
+
+        self.f: BinaryIO = f  # output file
+        self.level: int = level  # zstd compression level
+        self.frame_size: int = frame_size  # size of uncompressed data in each frame
+
+        self.local = threading.local()  # compressor objects are not thread-safe, so each thread gets its own
+        self.executor = ThreadPoolExecutor(threads)
+        self.max_in_flight: int = 2 * threads  # limits memory usage if the output is slow
+
+        self.buffer = bytearray()  # data that doesn't fill a frame yet
+        self.in_flight: deque[tuple[int, Future]] = deque()  # (uncompressed size, compressed frame), in order
+        self.seek_table: list[tuple[int, int]] = []  # (compressed size, uncompressed size) of written frames
+
+
+    def __enter__(self) -> SeekableZstdWriter:
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.executor.shutdown()
+
+
+    def write(self, data: bytes) -> None:
+        self.buffer += data
+        while len(self.buffer) >= self.frame_size:
+            self.submit(bytes(self.buffer[:self.frame_size]))
+            del self.buffer[:self.frame_size]
+
+
+    # Flush the remaining data and write the seek table. Does not close the underlying file.
+    def close(self) -> None:
+        if self.buffer:
+            self.submit(bytes(self.buffer))
+            self.buffer.clear()
+        while self.in_flight:
+            self.write_frame()
+        self.executor.shutdown()
+
+        entries = b"".join(struct.pack("<II", compressed_size, size) for compressed_size, size in self.seek_table)
+        footer = struct.pack("<IBI", len(self.seek_table), 0, SEEKABLE_MAGIC)
+        self.f.write(struct.pack("<II", SKIPPABLE_FRAME_MAGIC, len(entries) + len(footer)) + entries + footer)
+
+
+    def submit(self, chunk: bytes) -> None:
+        while len(self.in_flight) >= self.max_in_flight:
+            self.write_frame()
+        self.in_flight.append((len(chunk), self.executor.submit(self.compress, chunk)))
+
+
+    def compress(self, chunk: bytes) -> bytes:
+        if not hasattr(self.local, "compressor"):
+            self.local.compressor = zstandard.ZstdCompressor(level=self.level, write_content_size=True)
+        return self.local.compressor.compress(chunk)
+
+
+    def write_frame(self) -> None:
+        size, future = self.in_flight.popleft()
+        frame = future.result()
+        self.f.write(frame)
+        self.seek_table.append((len(frame), size))
+
+
+# Create the index ratarmount would otherwise build on first mount, storing it next to the archive where ratarmount
+# looks for it. This is optional, so failures are not fatal.
+def write_ratarmount_index(path: str) -> bool:
+    try:
+        from ratarmountcore import SQLiteIndexedTar
+    except ImportError:
+        print("ratarmountcore is not installed, not creating an index for", path)
+        return False
+
+    try:
+        with SQLiteIndexedTar(path, writeIndex=True, clearIndexCache=True):
+            pass
+    except Exception as e:
+        print("Could not create an index for", path, ":", e)
+        return False
+    return True
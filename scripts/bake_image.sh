@@ -3,27 +3,252 @@ set -e
 
 
 if [ "$1" != "--unshared" ]; then
-	unshare -U -r -m "$0" --unshared
+	unshare -U -r -m "$0" --unshared "$@"
 	exit $?
 fi
+shift
 
 
 root="$(realpath "$(dirname "$0")/..")"
 
+split=0
+full=0
+dedup=1
+sort=1
+output=""
+packages=()
+mksquashfs_opts=()
+while [[ "$#" -gt 0 ]]; do
+	if [[ "$1" =~ ^-.* ]]; then
+		if [[ "$1" == "-h" ]] || [[ "$1" == "--help" ]]; then
+			cat <<EOF
+Usage: $0 [options] [package...] [-- mksquashfs options...]
+
+Bake the built packages (all of them by default) into image.sfs, or into image/ with --split.
+
+Options:
+  --split           ship each package as a separate squashfs image in image/
+  --full            ignore the previous image and bake everything from scratch
+  --no-dedup        do not store duplicate files across packages as hardlinks
+  --no-sort         do not store the files recorded by profile_access.py first
+  -o, --output PATH where to bake the image (default: image.sfs, or image/ with --split)
+
+Baking is incremental. With --split, only the packages that changed since the last bake are converted. The combined
+image can only be extended: it is reused if packages were only added, and any changed or removed package rebuilds the
+whole image. Packages are considered changed when the size or the modification time of the archive changes.
+EOF
+			exit 0
+		elif [[ "$1" == "--split" ]]; then
+			split=1
+			shift
+		elif [[ "$1" == "--full" ]]; then
+			full=1
+			shift
+		elif [[ "$1" == "--no-dedup" ]]; then
+			dedup=0
+			shift
+		elif [[ "$1" == "--no-sort" ]]; then
+			sort=0
+			shift
+		elif [[ "$1" == "-o" ]] || [[ "$1" == "--output" ]]; then
+			shift
+			output="$(realpath -m "$1")"
+			shift
+		elif [[ "$1" == "--" ]]; then
+			# The rest are passed to mksquashfs, e.g. -comp zstd -b 1M
+			shift
+			mksquashfs_opts=( "$@" )
+			break
+		else
+			echo "Unknown option $1" >&2
+			exit 1
+		fi
+	else
+		packages+=( "$1" )
+		shift
+	fi
+done
+
+if [[ "${#packages[@]}" -eq 0 ]]; then
+	for pkg_path in "$root/packages/"*; do
+		packages+=( "${pkg_path##*/}" )
+	done
+fi
+
+# Baking an image in one format to the default location removes the image in the other one, so that run.sh does not
+# pick up a stale image
+if [[ -z "$output" ]]; then
+	if [[ "$split" == "1" ]]; then
+		output="$root/image"
+		rm -rf "$root/image.sfs" "$root/image.sfs.sources"
+	else
+		output="$root/image.sfs"
+		rm -rf "$root/image"
+	fi
+fi
+
+
 if ! [[ -e "$root/tmp" ]]; then
 	mkdir "$root/tmp"
 fi
 mount -t tmpfs tmpfs "$root/tmp"
 
+
+# Print the path to the built package, if any. squashfs is preferred, and .tar.gz is the format older versions of
+# build_packages.py generated
+package_source() {
+	local pkg_path="$root/packages/$1"
+	for source in "$pkg_path/$1.sfs" "$pkg_path/$1.tar.zst" "$pkg_path/$1.tar.gz"; do
+		if [[ -f "$source" ]]; then
+			echo "$source"
+			return
+		fi
+	done
+}
+
+# Hash of the package and, if it is used, of the list of files to store first. Reading whole packages on every bake is
+# slow, so the archive is identified by its path, size and modification time, the same way test_image.py does it.
+package_hash() {
+	{
+		stat -c "%n %s %.9Y" "$(package_source "$1")"
+		if [[ "$sort" == "1" ]] && [[ -f "$root/packages/$1/access.trace" ]]; then
+			cat "$root/packages/$1/access.trace"
+		fi
+	} | sha256sum | cut -d" " -f1
+}
+
+# Write a mksquashfs option to store the files recorded by profile_access.py first, if there are any, into sort_opts
+make_sort_opts() {
+	sort_opts=()
+	if [[ "$sort" == "1" ]]; then
+		"$root/scripts/profile_access.py" --sort-file "$1" "$root/tmp/sort"
+		if [[ -s "$root/tmp/sort" ]]; then
+			sort_opts=( -sort "$root/tmp/sort" )
+		fi
+	fi
+}
+
+mount_package() {
+	mkdir "$2"
+	if [[ "$1" == *.sfs ]]; then
+		squashfuse "$1" "$2"
+	else
+		ratarmount "$1" "$2"
+	fi
+}
+
+
+# Hashes of built packages, as "<name> <sha256>" lines. This is what decides whether a package has to be baked again
+echo "Hashing packages"
+sources="$root/tmp/sources"
+: >"$sources"
+for pkg in "${packages[@]}"; do
+	if [[ -n "$(package_source "$pkg")" ]]; then
+		echo "$pkg $(package_hash "$pkg")" >>"$sources"
+	fi
+done
+# Changing mksquashfs options invalidates everything
+echo "--options ${mksquashfs_opts[*]}" >>"$sources"
+
+declare -A old_hashes
+if [[ "$split" == "1" ]]; then
+	state="$output/.sources"
+else
+	state="$output.sources"
+fi
+if [[ "$full" == "0" ]] && [[ -f "$state" ]]; then
+	while read -r pkg hash; do
+		old_hashes["$pkg"]="$hash"
+	done <"$state"
+	if [[ "${old_hashes["--options"]}" != "${mksquashfs_opts[*]}" ]]; then
+		old_hashes=()
+	fi
+fi
+
+
+if [[ "$split" == "1" ]]; then
+	# Ship each package as a separate squashfs image in image/. Only packages that changed since the last bake are
+	# processed, and packages built with --format squashfs are used as is unless mksquashfs options are given or the files
+	# have to be reordered
+	echo "Building split image"
+	rm -rf "$output.tmp"
+	mkdir "$output.tmp"
+	while read -r pkg hash; do
+		if [[ "$pkg" == --* ]]; then
+			continue
+		fi
+		source="$(package_source "$pkg")"
+		reorder=0
+		if [[ "$sort" == "1" ]] && [[ -f "$root/packages/$pkg/access.trace" ]]; then
+			reorder=1
+		fi
+		if [[ "${old_hashes["$pkg"]}" == "$hash" ]] && [[ -f "$output/$pkg.sfs" ]]; then
+			echo "$pkg is up to date"
+			ln "$output/$pkg.sfs" "$output.tmp/$pkg.sfs"
+		elif [[ "$source" == *.sfs ]] && [[ "${#mksquashfs_opts[@]}" -eq 0 ]] && [[ "$reorder" == "0" ]]; then
+			echo "Using ${source##*/}"
+			ln "$source" "$output.tmp/$pkg.sfs" 2>/dev/null || cp "$source" "$output.tmp/$pkg.sfs"
+		else
+			echo "Converting ${source##*/}"
+			mkdir -p "$root/tmp/split"
+			mount_package "$source" "$root/tmp/split/$pkg"
+			make_sort_opts "$root/tmp/split"
+			mksquashfs "$root/tmp/split/$pkg" "$output.tmp/$pkg.sfs" -noappend "${sort_opts[@]}" "${mksquashfs_opts[@]}"
+			umount "$root/tmp/split/$pkg"
+			rmdir "$root/tmp/split/$pkg"
+		fi
+	done <"$sources"
+	cp "$sources" "$output.tmp/.sources"
+	rm -rf "$output"
+	mv "$output.tmp" "$output"
+	exit 0
+fi
+
+
+# A squashfs image cannot be modified in place, but new directories can be appended to it. So if packages were only
+# added since the last bake, the existing image is extended; any other change requires a full rebuild.
+append=0
+if [[ -f "$output" ]] && [[ "${#old_hashes[@]}" -gt 0 ]]; then
+	append=1
+	declare -A new_hashes
+	while read -r pkg hash; do
+		new_hashes["$pkg"]="$hash"
+	done <"$sources"
+	for pkg in "${!old_hashes[@]}"; do
+		if [[ "${new_hashes["$pkg"]}" != "${old_hashes["$pkg"]}" ]]; then
+			append=0
+		fi
+	done
+	if [[ "$append" == "1" ]] && [[ "${#new_hashes[@]}" -eq "${#old_hashes[@]}" ]]; then
+		echo "Image is up to date"
+		exit 0
+	fi
+fi
+
 echo "Mounting packages"
 mkdir "$root/tmp/packages"
-for pkg_path in "$root/packages/"*; do
-	pkg="${pkg_path##*/}"
-	if [ -f "$pkg_path/$pkg.tar.gz" ]; then
-		mkdir "$root/tmp/packages/$pkg"
-		ratarmount "$pkg_path/$pkg.tar.gz" "$root/tmp/packages/$pkg"
+while read -r pkg hash; do
+	if [[ "$pkg" == --* ]]; then
+		continue
 	fi
-done
+	if [[ "$append" == "0" ]] || [[ -z "${old_hashes["$pkg"]}" ]]; then
+		mount_package "$(package_source "$pkg")" "$root/tmp/packages/$pkg"
+	fi
+done <"$sources"
 
-echo "Building squashfs"
-mksquashfs "$root/tmp/packages" "$root/image.sfs" -noappend
+make_sort_opts "$root/tmp/packages"
+
+rm -f "$output.sources"
+if [[ "$append" == "1" ]]; then
+	echo "Appending new packages to squashfs"
+	mksquashfs "$root/tmp/packages" "$output" "${sort_opts[@]}" "${mksquashfs_opts[@]}"
+elif [[ "$dedup" == "1" ]]; then
+	echo "Deduplicating files"
+	"$root/scripts/dedup_image.py" "$root/tmp/packages" --exclude-file "$root/tmp/dedup.exclude" --pseudo-file "$root/tmp/dedup.pseudo"
+	echo "Building squashfs"
+	mksquashfs "$root/tmp/packages" "$output" -noappend -ef "$root/tmp/dedup.exclude" -pf "$root/tmp/dedup.pseudo" "${sort_opts[@]}" "${mksquashfs_opts[@]}"
+else
+	echo "Building squashfs"
+	mksquashfs "$root/tmp/packages" "$output" -noappend "${sort_opts[@]}" "${mksquashfs_opts[@]}"
+fi
+cp "$sources" "$output.sources"
@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+from __future__ import annotations
+
+import argparse
+from dataclasses import asdict, dataclass, field
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import time
+
+
+# Bakes the image with different mksquashfs compressors and block sizes and measures how long it takes to run each
+# package's tests, with the page cache of the image dropped (cold) and populated (warm). The tests compile and run hello
+# world programs, which is what a judge does most of the time.
+
+
+ROOT = os.path.realpath(os.path.join(os.path.dirname(__file__), ".."))
+
+DEFAULT_COMPRESSORS = ["gzip", "lz4", "lzo", "zstd:3", "zstd:9", "zstd:19", "xz"]
+DEFAULT_BLOCK_SIZES = ["128K", "256K", "1M"]
+
+
+class BenchmarkError(Exception):
+    pass
+
+
+@dataclass
+class PackageResult:
+    cold: list[float] = field(default_factory=list)  # seconds
+    warm: list[float] = field(default_factory=list)  # seconds
+
+
+@dataclass
+class ConfigResult:
+    compressor: str
+    block_size: str
+    image_size: int = 0  # bytes
+    bake_time: float = 0  # seconds
+    packages: dict[str, PackageResult] = field(default_factory=dict)
+
+
+# "zstd:19" means "-comp zstd -Xcompression-level 19"
+def get_mksquashfs_options(compressor: str, block_size: str) -> list[str]:
+    name, _, level = compressor.partition(":")
+    options = ["-comp", name, "-b", block_size]
+    if level:
+        options += ["-Xcompression-level", level]
+    return options
+
+
+# Evict the image from the page cache, so that the next run reads it from disk. This works without root, unlike
+# writing to /proc/sys/vm/drop_caches, but only affects this file.
+def drop_cache(image_path: str) -> None:
+    paths = [image_path]
+    if os.path.isdir(image_path):
+        paths = [os.path.join(image_path, name) for name in os.listdir(image_path)]
+    for path in paths:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+
+
+def bake(image_path: str, package_names: list[str], options: list[str], split: bool) -> float:
+    argv = [os.path.join(ROOT, "scripts", "bake_image.sh"), "--full", "-o", image_path]
+    if split:
+        argv.append("--split")
+    argv += package_names
+    argv += ["--"] + options
+    start = time.monotonic()
+    if subprocess.run(argv, stdout=subprocess.DEVNULL).returncode != 0:
+        raise BenchmarkError(f"Could not bake {image_path}")
+    return time.monotonic() - start
+
+
+def run_tests(image_path: str, package_name: str) -> float:
+    argv = [os.path.join(ROOT, "scripts", "test_image.sh"), "--image", image_path, package_name]
+    start = time.monotonic()
+    if subprocess.run(argv, stdout=subprocess.DEVNULL).returncode != 0:
+        raise BenchmarkError(f"Tests of {package_name} failed on {image_path}")
+    return time.monotonic() - start
+
+
+def benchmark(image_path: str, result: ConfigResult, package_names: list[str], split: bool, runs: int) -> None:
+    options = get_mksquashfs_options(result.compressor, result.block_size)
+    print(f"Baking with {' '.join(options)}", file=sys.stderr)
+    result.bake_time = bake(image_path, package_names, options, split)
+    if split:
+        result.image_size = sum(os.path.getsize(os.path.join(image_path, name)) for name in os.listdir(image_path) if name.endswith(".sfs"))
+    else:
+        result.image_size = os.path.getsize(image_path)
+
+    for package_name in package_names:
+        print(f"Testing {package_name}", file=sys.stderr)
+        package_result = result.packages[package_name] = PackageResult()
+        for _ in range(runs):
+            drop_cache(image_path)
+            package_result.cold.append(run_tests(image_path, package_name))
+        # The last cold run has populated the cache
+        for _ in range(runs):
+            package_result.warm.append(run_tests(image_path, package_name))
+
+
+def remove_image(image_path: str) -> None:
+    if os.path.isdir(image_path):
+        shutil.rmtree(image_path)
+    for path in (image_path, image_path + ".sources"):
+        if os.path.isfile(path):
+            os.unlink(path)
+
+
+def print_table(rows: list[list[str]]) -> None:
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+    for i, row in enumerate(rows):
+        print("  ".join(cell.ljust(width) for cell, width in zip(row, widths)).rstrip())
+        if i == 0:
+            print("  ".join("-" * width for width in widths))
+
+
+def print_results(results: list[ConfigResult], package_names: list[str]) -> None:
+    rows = [["compressor", "block", "size, MiB", "bake, s", "cold, s", "warm, s"]]
+    for result in results:
+        cold = sum(statistics.median(package.cold) for package in result.packages.values())
+        warm = sum(statistics.median(package.warm) for package in result.packages.values())
+        rows.append([result.compressor, result.block_size, f"{result.image_size / 2 ** 20:.0f}", f"{result.bake_time:.0f}", f"{cold:.2f}", f"{warm:.2f}"])
+    print_table(rows)
+    print()
+
+    rows = [["package"] + [f"{result.compressor}/{result.block_size}" for result in results]]
+    for package_name in package_names:
+        row = [package_name]
+        for result in results:
+            package = result.packages[package_name]
+            row.append(f"{statistics.median(package.cold):.2f}/{statistics.median(package.warm):.2f}")
+        rows.append(row)
+    print("Median cold/warm test time per package, s")
+    print_table(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare mksquashfs settings by baking the image with each of them and running the tests.")
+    parser.add_argument("packages", nargs="*", help="names of packages to include (default: all packages with tests)")
+    parser.add_argument("--compressors", nargs="+", default=DEFAULT_COMPRESSORS, metavar="COMP[:LEVEL]", help=f"compressors to try (default: {' '.join(DEFAULT_COMPRESSORS)})")
+    parser.add_argument("--block-sizes", nargs="+", default=DEFAULT_BLOCK_SIZES, metavar="SIZE", help=f"block sizes to try (default: {' '.join(DEFAULT_BLOCK_SIZES)})")
+    parser.add_argument("--runs", type=int, default=3, help="number of cold and warm runs of each test (default: 3)")
+    parser.add_argument("--split", action="store_true", help="bake split images instead of image.sfs")
+    parser.add_argument("--work-dir", default=os.path.join(ROOT, "benchmark"), help="where to store the images (default: benchmark/)")
+    parser.add_argument("--keep", action="store_true", help="do not remove the images after testing them")
+    parser.add_argument("--json", metavar="PATH", help="also save the results in JSON")
+    args = parser.parse_args()
+
+    package_names = args.packages or sorted(
+        name for name in os.listdir(os.path.join(ROOT, "packages"))
+        if os.path.isdir(os.path.join(ROOT, "packages", name, "tests"))
+    )
+
+    os.makedirs(args.work_dir, exist_ok=True)
+
+    results: list[ConfigResult] = []
+    for compressor in args.compressors:
+        for block_size in args.block_sizes:
+            result = ConfigResult(compressor, block_size)
+            image_path = os.path.join(args.work_dir, f"image-{compressor.replace(':', '-')}-{block_size}" + ("" if args.split else ".sfs"))
+            try:
+                benchmark(image_path, result, package_names, args.split, args.runs)
+            except BenchmarkError as e:
+                print(e, file=sys.stderr)
+                continue
+            finally:
+                if not args.keep:
+                    remove_image(image_path)
+            results.append(result)
+
+    if not results:
+        print("No configuration succeeded", file=sys.stderr)
+        sys.exit(1)
+
+    print_results(results, package_names)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump([asdict(result) for result in results], f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
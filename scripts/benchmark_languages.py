@@ -0,0 +1,312 @@
+#!/usr/bin/env python3
+from __future__ import annotations
+
+import argparse
+from dataclasses import asdict, dataclass, field
+import json
+import math
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from typing import Any, Callable, Optional
+
+from benchmark_image import drop_cache, print_table
+from config_eval import EvaluationError, Evaluator, Language, Sandbox, build_submission, parse, run_submission
+from make_config import GenerationError, MakefileParser
+
+
+# Measures how long it takes to identify each language, to build a few standard programs and to run them. Commands run
+# in the sandbox just like on a judge, so the times include sandbox setup. The results can be saved in JSON and compared
+# against a run on another image to catch toolchain regressions.
+
+
+ROOT = os.path.realpath(os.path.join(os.path.dirname(__file__), ".."))
+
+PROGRAMS_PATH = os.path.join(ROOT, "programs")
+
+IO_NUMBERS = 10 ** 6
+
+
+@dataclass
+class Program:
+    name: str
+    expected_output: str
+    input: Optional[str] = None
+
+
+@dataclass
+class Stats:
+    samples: list[float]  # seconds
+    p50: float = 0
+    p95: float = 0
+    p99: float = 0
+    mean: float = 0
+
+    def __post_init__(self):
+        if self.samples:
+            self.p50 = percentile(self.samples, 50)
+            self.p95 = percentile(self.samples, 95)
+            self.p99 = percentile(self.samples, 99)
+            self.mean = sum(self.samples) / len(self.samples)
+
+
+@dataclass
+class LanguageResult:
+    package: str
+    language: str
+    identify: Optional[str] = None  # output of the identify rule
+    phases: dict[str, dict[str, Stats]] = field(default_factory=dict)  # "identify", "<program>/build", "<program>/run" -> "cold"/"warm" -> stats
+    errors: list[str] = field(default_factory=list)
+
+
+# Nearest-rank percentile
+def percentile(samples: list[float], p: float) -> float:
+    samples = sorted(samples)
+    return samples[max(math.ceil(p / 100 * len(samples)) - 1, 0)]
+
+
+def get_programs() -> list[Program]:
+    rng = random.Random(0)
+    numbers = [rng.randint(0, 10 ** 9) for _ in range(IO_NUMBERS)]
+    return [
+        Program("hello_world", "Hello, world!"),
+        Program("heavy_includes", "Hello, world!"),
+        Program("io", str(sum(numbers)), "".join(f"{number}\n" for number in numbers)),
+    ]
+
+
+# Programs live in programs/; hello world is also taken from the tests of the package
+def find_program_source(package: str, program: str, extension: str) -> Optional[str]:
+    for directory in (PROGRAMS_PATH, os.path.join(ROOT, "packages", package, "tests")):
+        path = os.path.join(directory, program + extension)
+        if os.path.isfile(path):
+            return path
+    return None
+
+
+def load_languages(package: str) -> dict[str, Language]:
+    languages = {}
+    languages_path = os.path.join(ROOT, "packages", package, "languages")
+    for file_name in sorted(os.listdir(languages_path)):
+        if not file_name.endswith(".make"):
+            continue
+        with open(os.path.join(languages_path, file_name)) as f:
+            makefile = f.read()
+        try:
+            languages[file_name[:-5]] = Evaluator().evaluate(parse(MakefileParser(makefile).parse()))
+        except (GenerationError, EvaluationError) as e:
+            print(f"Cannot parse {package}/languages/{file_name}: {e}", file=sys.stderr)
+    return languages
+
+
+# The files that hold the package, so that they can be evicted from the page cache
+def get_image_path(package: str, run_opts: list[str]) -> str:
+    if "--dev" in run_opts:
+        package_path = os.path.join(ROOT, "packages", package)
+        for extension in (".sfs", ".tar.zst", ".tar.gz"):
+            path = os.path.join(package_path, package + extension)
+            if os.path.exists(path):
+                return path
+        raise EvaluationError(f"{package} is not built")
+    if "--image" in run_opts:
+        return run_opts[run_opts.index("--image") + 1]
+    if os.path.isdir(os.path.join(ROOT, "image")):
+        return os.path.join(ROOT, "image")
+    return os.path.join(ROOT, "image.sfs")
+
+
+class LanguageBenchmark:
+    def __init__(self, package: str, name: str, language: Language, run_opts: list[str], iterations: int, cold_iterations: int):
+        self.package: str = package
+        self.language: Language = language
+        self.run_opts: list[str] = run_opts
+        self.iterations: int = iterations  # number of warm runs of each phase
+        self.cold_iterations: int = cold_iterations  # number of runs with the page cache dropped
+        self.image_path: str = get_image_path(package, run_opts)
+        self.result: LanguageResult = LanguageResult(package, name)
+
+
+    # Time fn(setup()) with the page cache dropped and populated. setup is not timed. Returns the result of the last run.
+    def measure(self, phase: str, setup: Callable[[], Any], fn: Callable[[Any], Any]) -> Any:
+        cold = []
+        result = None
+        for _ in range(self.cold_iterations):
+            state = setup()
+            drop_cache(self.image_path)
+            start = time.monotonic()
+            result = fn(state)
+            cold.append(time.monotonic() - start)
+        if not self.cold_iterations:
+            # Populate the cache
+            result = fn(setup())
+        warm = []
+        for _ in range(self.iterations):
+            state = setup()
+            start = time.monotonic()
+            result = fn(state)
+            warm.append(time.monotonic() - start)
+        self.result.phases[phase] = {"cold": Stats(cold), "warm": Stats(warm)}
+        return result
+
+
+    def run(self, programs: list[Program]) -> LanguageResult:
+        with tempfile.TemporaryDirectory(prefix="sunwalker-benchmark-") as tmp:
+            try:
+                self.run_identify(tmp)
+            except EvaluationError as e:
+                self.result.errors.append(f"identify: {e}")
+
+            extensions = [pattern[1:] for pattern in self.language.inputs if pattern.startswith("%.")]
+            for program in programs:
+                source = next(filter(None, (find_program_source(self.package, program.name, extension) for extension in extensions)), None)
+                if source is None:
+                    continue
+                try:
+                    self.run_program(program, source, os.path.join(tmp, program.name))
+                except EvaluationError as e:
+                    self.result.errors.append(f"{program.name}: {e}")
+        return self.result
+
+
+    def run_identify(self, tmp: str) -> None:
+        directory = os.path.join(tmp, "identify")
+        os.mkdir(directory)
+        evaluator = Evaluator(Sandbox(self.package, self.run_opts, directory))
+        self.result.identify = str(self.measure("identify", lambda: None, lambda _: self.language.identify(evaluator))).strip()
+
+
+    def run_program(self, program: Program, source: str, tmp: str) -> None:
+        source_name = program.name + os.path.splitext(source)[1]
+
+        def setup_build() -> Sandbox:
+            directory = os.path.join(tmp, "build")
+            if os.path.exists(directory):
+                shutil.rmtree(directory)
+            os.makedirs(directory)
+            shutil.copy(source, os.path.join(directory, source_name))
+            return Sandbox(self.package, self.run_opts, directory)
+
+        def build(sandbox: Sandbox) -> Evaluator:
+            return build_submission(self.language, sandbox, program.name)
+
+        if self.language.build is None:
+            # Interpreted languages have nothing to build
+            evaluator = build(setup_build())
+        else:
+            evaluator = self.measure(f"{program.name}/build", setup_build, build)
+
+        # The artifacts of the last build are reused by all runs
+        output = run_submission(self.language, evaluator, program.input)
+        if output.strip() != program.expected_output:
+            raise EvaluationError(f"Expected {program.expected_output!r}, got {output.strip()[:100]!r}")
+        self.measure(f"{program.name}/run", lambda: evaluator, lambda evaluator: run_submission(self.language, evaluator, program.input))
+
+
+def print_results(results: list[LanguageResult]) -> None:
+    rows = [["language", "phase", "cold p50", "warm p50", "warm p95", "warm p99"]]
+    for result in results:
+        for phase, stats in result.phases.items():
+            cold = f"{stats['cold'].p50:.3f}" if stats["cold"].samples else "-"
+            warm = stats["warm"]
+            rows.append([f"{result.package}/{result.language}", phase, cold, f"{warm.p50:.3f}", f"{warm.p95:.3f}", f"{warm.p99:.3f}"])
+    print("Time, s")
+    print_table(rows)
+    for result in results:
+        for error in result.errors:
+            print(f"{result.package}/{result.language}: {error}")
+
+
+# Compare warm medians with a previous run and report the phases that got slower than the threshold
+def print_comparison(results: list[LanguageResult], old_path: str, threshold: float) -> bool:
+    with open(old_path) as f:
+        old_results = {f"{result['package']}/{result['language']}": result for result in json.load(f)["languages"]}
+
+    rows = [["language", "phase", "old p50", "new p50", "change"]]
+    regressed = False
+    for result in results:
+        key = f"{result.package}/{result.language}"
+        old_result = old_results.get(key)
+        if old_result is None:
+            continue
+        if old_result["identify"] != result.identify:
+            print(f"{key}: {old_result['identify']} -> {result.identify}")
+        for phase, stats in result.phases.items():
+            if phase not in old_result["phases"] or not stats["warm"].samples:
+                continue
+            old_p50 = old_result["phases"][phase]["warm"]["p50"]
+            new_p50 = stats["warm"].p50
+            change = (new_p50 - old_p50) / old_p50 * 100 if old_p50 else 0
+            mark = ""
+            if change > threshold:
+                mark = " !"
+                regressed = True
+            rows.append([key, phase, f"{old_p50:.3f}", f"{new_p50:.3f}", f"{change:+.0f}%{mark}"])
+    print(f"Warm median time compared to {old_path}, s")
+    print_table(rows)
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure how long languages take to identify, build and run standard programs.")
+    parser.add_argument("packages", nargs="*", help="names of packages to benchmark (default: all packages)")
+    parser.add_argument("--languages", nargs="+", metavar="LANGUAGE", help="only benchmark these languages")
+    parser.add_argument("--programs", nargs="+", metavar="PROGRAM", help="only build and run these programs (default: hello_world heavy_includes io)")
+    parser.add_argument("-n", "--iterations", type=int, default=20, help="number of warm runs of each phase (default: 20)")
+    parser.add_argument("--cold-iterations", type=int, default=5, help="number of runs of each phase with the page cache dropped, 0 to disable (default: 5)")
+    parser.add_argument("--dev", action="store_true", help="use the built packages instead of the image")
+    parser.add_argument("--image", help="use this image instead of image.sfs or image/")
+    parser.add_argument("--json", metavar="PATH", help="save the results in JSON")
+    parser.add_argument("--compare", metavar="PATH", help="compare with results saved by --json before")
+    parser.add_argument("--threshold", type=float, default=10, help="fail if a phase got slower than this many percent compared to --compare (default: 10)")
+    args = parser.parse_args()
+
+    run_opts = []
+    if args.dev:
+        run_opts.append("--dev")
+    if args.image:
+        run_opts += ["--image", os.path.realpath(args.image)]
+
+    programs = get_programs()
+    if args.programs:
+        programs = [program for program in programs if program.name in args.programs]
+
+    package_names = args.packages or sorted(
+        name for name in os.listdir(os.path.join(ROOT, "packages"))
+        if os.path.isdir(os.path.join(ROOT, "packages", name, "languages"))
+    )
+
+    results: list[LanguageResult] = []
+    for package in package_names:
+        for name, language in load_languages(package).items():
+            if args.languages and name not in args.languages:
+                continue
+            print(f"Benchmarking {package}/{name}", file=sys.stderr)
+            try:
+                benchmark = LanguageBenchmark(package, name, language, run_opts, args.iterations, args.cold_iterations)
+            except EvaluationError as e:
+                print(e, file=sys.stderr)
+                continue
+            results.append(benchmark.run(programs))
+
+    print_results(results)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({
+                "run_opts": run_opts,
+                "iterations": args.iterations,
+                "cold_iterations": args.cold_iterations,
+                "languages": [asdict(result) for result in results],
+            }, f, indent=4)
+
+    if args.compare:
+        print()
+        if print_comparison(results, args.compare, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
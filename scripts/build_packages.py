@@ -1,21 +1,62 @@
 #!/usr/bin/env python3
 from __future__ import annotations
 
+import argparse
 import atexit
 from collections import defaultdict
+import contextlib
 from dataclasses import dataclass
 import docker
+import hashlib
+import io
+import json
 import os
+import re
+import shutil
+import stat
 import time
-from typing import Optional
+from typing import Callable, Optional
 import shlex
 import string
 import subprocess
 import sys
+import tarfile
+import tempfile
+
+from archive import SeekableZstdWriter, write_ratarmount_index
+from benchmark_languages import find_program_source, load_languages
+from config_eval import EvaluationError, Language, build_submission, run_submission
+from elf import ELFCLASS64, EM_X86_64, ET_DYN, ElfError, ElfFile, is_elf, parse_elf, parse_ld_so_cache, write_ld_so_cache
+from profile_access import TRACED_SYSCALLS_WITH_STAT, get_corpus, test_package, trace_corpus, trace_package
+from test_image import is_ignored, read_gitignore
 
 
 docker_client = docker.from_env()
 
+# Bump this whenever a change to this script affects the contents of the built packages, so that the build cache is
+# invalidated
+BUILDER_VERSION = 5
+
+# Supported formats of built packages, mapped to file extensions
+ARCHIVE_FORMATS = {
+    "tar.zst": ".tar.zst",  # seekable zstd-compressed tar, mountable by ratarmount
+    "squashfs": ".sfs",  # squashfs, mountable by squashfuse and usable by bake_image.sh without recompression
+}
+
+# Files the builder and profile_access.py write into the package directory, which are not part of the build context
+BUILD_OUTPUTS = ["build.log", "trace.json", "trace.txt", "pruned.txt", "access.trace"]
+
+# Files with these extensions are assumed not to be ELF files or scripts unless they are executable, so that their
+# contents don't have to be read out of the container, e.g. for BIN /usr/include
+NON_ELF_EXTENSIONS = {
+    ".a", ".c", ".class", ".css", ".d", ".def", ".gch", ".go", ".gz", ".h", ".hh", ".hi", ".hpp", ".hs", ".html", ".hxx",
+    ".inc", ".jar", ".java", ".js", ".json", ".md", ".mo", ".o", ".pas", ".pm", ".png", ".pp", ".py", ".pyc", ".rb",
+    ".rs", ".rst", ".tcc", ".txt", ".xml", ".zip",
+}
+
+# LD_LIBRARY_PATH that run.sh sets for packages without a generated ld.so.cache
+RUNNER_LIBRARY_PATH = ["/usr/local/lib64", "/usr/local/lib", "/usr/lib64", "/usr/lib", "/lib64", "/lib"]
+
 
 class BuildFailure(Exception):
     pass
@@ -25,38 +66,348 @@ class BuildFailure(Exception):
 class PendingAdditionBinary:
     path: str
 
-    # For ELF files, this is the kind of and the path to the dynamic linker this binary is expected to use (it might use
-    # another linker, this is only an educated guess). linker_path may be None if ldd is to be used to resolve the
-    # dependencies. For other files and for directories, these entries don't bear any particular meaning.
-    linker_kind: str
+    # For ELF files without PT_INTERP (i.e. shared libraries), this is the path to the dynamic linker that is expected to
+    # load the file, or None if the default linker is to be assumed. ELF files with PT_INTERP and other files ignore this.
+    # For directories, this applies to all files inside.
     linker_path: Optional[str]
 
+    # DT_RPATH entries (with $ORIGIN expanded) of the objects that caused this file to be loaded. Dynamic linkers search
+    # the RPATH of the whole chain of loaders, not only of the object that requests the library.
+    loader_rpath: tuple[str, ...]
+
+
+# Resolve the symlinks in all components of an absolute path, like realpath, in a file system that is not mounted.
+# read_link returns the target of the symlink at a path without symlinks, or None if there is no symlink there. The path
+# need not exist.
+def resolve_symlinks(path: str, read_link: Callable[[str], Optional[str]]) -> str:
+    parts = [part for part in path.split("/") if part]
+    resolved = "/"
+    for _ in range(256):
+        if not parts:
+            break
+        part = parts.pop(0)
+        if part == "..":
+            resolved = os.path.dirname(resolved)
+            continue
+        if part == ".":
+            continue
+        next_path = os.path.join(resolved, part)
+        link_target = read_link(next_path)
+        if link_target is not None:
+            if link_target.startswith("/"):
+                resolved = "/"
+            parts = [part for part in link_target.split("/") if part] + parts
+        else:
+            resolved = next_path
+    return resolved
+
+
+@dataclass
+class FileInfo:
+    type: str  # as printed by find -printf %y: "f" for regular files, "d", "l", etc.
+    mode: int  # permission bits
+    size: int
+    link_target: str = ""  # for symlinks, the target as stored in the link
+
+
+# Metadata of all files in the container, taken in one go, so that file types, symlinks and directory contents can be
+# looked up without running a command per question. Paths are looked up the way the kernel does it: symlinks are
+# followed in all components but the last one.
+class FileSystemIndex:
+    def __init__(self, files: dict[str, FileInfo]):
+        self.files: dict[str, FileInfo] = files  # absolute path without symlinks -> metadata
+        self.children: defaultdict[str, list[str]] = defaultdict(list)  # directory -> paths of its entries
+        for path in sorted(files):
+            if path != "/":
+                self.children[os.path.dirname(path)].append(path)
+
+
+    # Resolve the symlinks in all components of an absolute path, like realpath. The path need not exist.
+    def resolve(self, path: str) -> str:
+        def read_link(path: str) -> Optional[str]:
+            info = self.files.get(path)
+            return info.link_target if info is not None and info.type == "l" else None
+        return resolve_symlinks(path, read_link)
+
+
+    # Metadata of the file itself, i.e. of the symlink if the path is one; None if it does not exist
+    def lookup(self, path: str) -> Optional[FileInfo]:
+        path = os.path.normpath(path)
+        if path == "/":
+            return self.files.get("/")
+        return self.files.get(os.path.join(self.resolve(os.path.dirname(path)), os.path.basename(path)))
+
+
+    # Same as `find <path> -not -type d`: the path itself if it's not a directory, or everything under it otherwise
+    def walk(self, path: str) -> list[str]:
+        info = self.lookup(path)
+        if info is None:
+            return []
+        if info.type != "d":
+            return [path]
+        result = []
+        stack = [(path, self.resolve(path))]
+        while stack:
+            path, real_path = stack.pop()
+            for child in self.children.get(real_path, []):
+                child_path = os.path.join(path, os.path.basename(child))
+                if self.files[child].type == "d":
+                    stack.append((child_path, child))
+                else:
+                    result.append(child_path)
+        return result
+
+
+    # Names of the entries of a directory, following symlinks; empty if it does not exist
+    def list_directory(self, path: str) -> set[str]:
+        return {os.path.basename(child) for child in self.children.get(self.resolve(path), [])}
+
+
+@dataclass
+class Warmup:
+    paths: list[str]  # where the command puts its caches
+    argv: list[str]
+    outputs: list[str]  # files the command created or modified under paths
+
+
+@dataclass
+class DynamicLinker:
+    path: str
+    kind: str  # gnu/musl
+    search_paths: list[str]  # default library directories, in the order they are searched
+    cache: dict[str, str]  # contents of ld.so.cache (soname -> path); empty for musl, which does not use a cache
+    cache_path: Optional[str] = None  # where the linker reads ld.so.cache from; None for musl
+
+
+# A bash script that runs in the container for the whole build and executes commands on request, so that we don't have
+# to pay for a docker exec per command. Requests and responses are sequences of NUL-terminated fields on stdin/stdout:
+# - "env", <n>, <n x "name=value">: set the environment for subsequent commands; no response. Like with docker exec, the
+#   variables are added to the environment of the image, minus the ones bash itself exports.
+# - "exec", <flags>, <n>, <n x argument>: run a command; flags are two digits telling whether stdout and stderr are to
+#   be captured. The response is <exit code>, <output length>, followed by the output itself, which is not terminated.
+AGENT_SCRIPT = r"""
+out="$(mktemp)"
+unset_vars=(-u PWD -u SHLVL -u _)
+env_vars=()
+while IFS= read -r -d "" op; do
+	if [[ "$op" == env ]]; then
+		IFS= read -r -d "" n
+		env_vars=()
+		for ((i = 0; i < n; i++)); do
+			IFS= read -r -d "" var
+			env_vars+=( "$var" )
+		done
+	elif [[ "$op" == exec ]]; then
+		IFS= read -r -d "" flags
+		IFS= read -r -d "" n
+		argv=()
+		for ((i = 0; i < n; i++)); do
+			IFS= read -r -d "" arg
+			argv+=( "$arg" )
+		done
+		case "$flags" in
+			11) env "${unset_vars[@]}" "${env_vars[@]}" "${argv[@]}" </dev/null >"$out" 2>&1 ;;
+			10) env "${unset_vars[@]}" "${env_vars[@]}" "${argv[@]}" </dev/null >"$out" 2>/dev/null ;;
+			01) env "${unset_vars[@]}" "${env_vars[@]}" "${argv[@]}" </dev/null 2>"$out" >/dev/null ;;
+			*) : >"$out"; env "${unset_vars[@]}" "${env_vars[@]}" "${argv[@]}" </dev/null >/dev/null 2>&1 ;;
+		esac
+		code=$?
+		printf "%s\0%s\0" "$code" "$(wc -c <"$out")"
+		cat "$out"
+	fi
+done
+rm -f "$out"
+"""
+
+
+class ContainerAgent:
+    def __init__(self, container_id: str):
+        self.proc = subprocess.Popen(["docker", "container", "exec", "-i", container_id, "bash", "-c", AGENT_SCRIPT], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self.env: Optional[dict[str, str]] = None  # environment last sent to the agent
+
+
+    def close(self) -> None:
+        self.proc.stdin.close()
+        self.proc.wait()
+
+
+    # Same semantics as docker's exec_run: returns (exit code, output)
+    def run(self, argv: list[str], env: dict[str, str], stdout: bool=True, stderr: bool=True) -> tuple[int, bytes]:
+        if env != self.env:
+            self.send(["env", str(len(env)), *(f"{key}={value}" for key, value in env.items())])
+            self.env = dict(env)
+        self.send(["exec", f"{int(stdout)}{int(stderr)}", str(len(argv)), *argv])
+        returncode = int(self.read_field())
+        length = int(self.read_field())
+        output = self.proc.stdout.read(length)
+        if len(output) != length:
+            print("Agent exitted unexpectedly")
+            raise BuildFailure()
+        return returncode, output
+
+
+    def send(self, fields: list[str]) -> None:
+        self.proc.stdin.write(b"".join(field.encode(errors="surrogateescape") + b"\0" for field in fields))
+        self.proc.stdin.flush()
+
+
+    def read_field(self) -> str:
+        field = bytearray()
+        while True:
+            c = self.proc.stdout.read(1)
+            if not c:
+                print("Agent exitted unexpectedly")
+                raise BuildFailure()
+            if c == b"\0":
+                return field.decode().strip()
+            field += c
+
+
+# Runs the rules of languages/*.make right in the build container, the way config_eval.Sandbox runs them in the sandbox.
+# Used to measure what warm-ups buy.
+class ContainerSandbox:
+    def __init__(self, builder: PackageBuilder, directory: str):
+        self.builder: PackageBuilder = builder
+        self.directory: str = directory  # working directory in the container
+
+
+    def exec(self, argv: list[str], input: Optional[str]=None) -> str:
+        if input is not None:
+            raise EvaluationError("Commands cannot read input in the build container")
+        returncode, output = self.builder.run_docker_oneshot(["sh", "-c", 'cd "$0" && exec "$@"', self.directory, *argv], check=False, stderr=False)
+        if returncode != 0:
+            raise EvaluationError(f"{' '.join(argv)} exited with code {returncode}")
+        return output.decode(errors="replace")
+
+
+    def host_path(self, path: str) -> str:
+        raise EvaluationError("Files cannot be accessed directly in the build container")
+
+
+# Records what the builder spends its time on, as Chrome trace events (load into chrome://tracing or Perfetto), plus a
+# text summary of the most expensive operations
+class Tracer:
+    def __init__(self):
+        self.start: float = time.monotonic()
+        self.events: list[dict] = []  # complete ("X") events; they nest by time
+
+
+    # Time the body of a with statement. The yielded dict is stored with the event, so the body can add to it.
+    @contextlib.contextmanager
+    def span(self, name: str, category: str, **args):
+        start = time.monotonic()
+        try:
+            yield args
+        finally:
+            end = time.monotonic()
+            self.events.append({
+                "name": name, "cat": category, "ph": "X", "pid": 1, "tid": 1,
+                "ts": round((start - self.start) * 1e6), "dur": round((end - start) * 1e6), "args": args,
+            })
+
+
+    def save(self, path: str) -> None:
+        with open(path, "w") as f:
+            json.dump({"traceEvents": self.events, "displayTimeUnit": "ms"}, f)
+
+
+    def summarize(self, top: int=20) -> str:
+        lines = []
+        total = max((event["ts"] + event["dur"] for event in self.events), default=0) / 1e6
+        lines.append(f"Total: {total:.1f}s")
+
+        lines.append("")
+        lines.append("Phases:")
+        for event in self.events:
+            if event["cat"] == "phase":
+                lines.append(f"{event['dur'] / 1e6:10.2f}s  {event['name']}")
+
+        # Commands grouped by the program they run
+        commands = [event for event in self.events if event["cat"] == "command"]
+        by_program: dict[str, list[dict]] = defaultdict(list)
+        for event in commands:
+            by_program[event["args"]["program"]].append(event)
+        lines.append("")
+        lines.append(f"Commands in the container by program ({len(commands)} in total):")
+        for program, events in sorted(by_program.items(), key=lambda item: -sum(event["dur"] for event in item[1]))[:top]:
+            duration = sum(event["dur"] for event in events) / 1e6
+            output = sum(event["args"].get("output_bytes", 0) for event in events)
+            lines.append(f"{duration:10.2f}s  {len(events):6} calls  {output / 2 ** 20:9.1f} MiB  {program}")
+
+        for title, category in (("Slowest manifest lines:", "manifest"), ("Slowest commands:", "command")):
+            lines.append("")
+            lines.append(title)
+            for event in sorted((event for event in self.events if event["cat"] == category), key=lambda event: -event["dur"])[:top]:
+                lines.append(f"{event['dur'] / 1e6:10.2f}s  {event['name']}")
+        return "\n".join(lines) + "\n"
+
+
+# Short description of a command for traces
+def summarize_argv(argv: list[str], limit: int=120) -> str:
+    s = shlex.join(argv)
+    return s if len(s) <= limit else s[:limit - 3] + "..."
+
 
 class PackageBuilder:
-    def __init__(self, name: str, path: str):
+    def __init__(self, name: str, path: str, remove_image: bool=False, force: bool=False, archive_format: str="tar.zst", prune_unused: bool=False, warmup_report: bool=False, trace: bool=False, build_cache: Optional[str]=None, docker_builder: Optional[str]=None, image_id_path: Optional[str]=None):
         self.name: str = name  # name of package
         self.path: str = path  # path to package directory
+        self.remove_image: bool = remove_image  # whether to delete the Docker image once the package is built
+        self.force: bool = force  # whether to rebuild the package even if the build cache says it is up to date
+        self.archive_format: str = archive_format  # key of ARCHIVE_FORMATS
+        self.prune_unused: bool = prune_unused  # whether to remove files the tests and samples don't access
+        self.warmup_report: bool = warmup_report  # whether to measure how much WARMUP directives speed up the languages
+        self.tracer: Optional[Tracer] = Tracer() if trace else None  # saved to trace.json and trace.txt on close
+        self.build_cache: Optional[str] = build_cache  # directory BuildKit exports layer caches to, one subdirectory per package
+        self.docker_builder: Optional[str] = docker_builder  # buildx builder instance, None for the current one
+        self.image_id_path: Optional[str] = image_id_path  # file to write the ID of the built image to, for BuildScheduler
 
         self.docker_image_id: Optional[str] = None  # the image ID of the built Dockerfile
         self.docker_container = None  # docker SDK container object
+        self.agent: Optional[ContainerAgent] = None  # command server running in the container
 
         self.env: dict[str, str] = {}  # environment variables; imported from Docker environment on start
 
         self.added_binaries: set[str] = set()  # binaries that were already completely analyzed and dependencies of which are pending addition
+        self.keep_paths: list[str] = ["/.sunwalker"]  # files and directories that are never pruned
+        self.warmups: list[Warmup] = []
         self.pending_addition_binaries: dict[str, PendingAdditionBinary] = {}  # binaries/directories which are yet to be analyzed recursively; key is path of binary
 
-        self.linker_kind_cache: dict[str, str] = {}  # key is absolute path to ld.so, value is gnu/musl
+        self.linkers: dict[str, DynamicLinker] = {}  # key is absolute path to ld.so
+        self.elf_files: dict[str, Optional[ElfFile]] = {}  # parsed ELF files; value is None for other files
+        self.directory_listings: dict[str, set[str]] = {}  # names of files in directories libraries are looked up in
+        self.shebangs: dict[str, str] = {}  # executable scripts -> their first line
+        self.filesystem: Optional[FileSystemIndex] = None  # snapshot of the container, taken once the manifest is run
+        self.symlinks: dict[str, str] = {}  # added symlinks -> absolute paths of their targets
+        self.default_libraries: dict[str, dict[str, str]] = {}  # linker path -> soname -> path, for the libraries found
+                                                                 # in ld.so.cache or the default directories
 
-        self.readlink_supports_zero_terminated_output: Optional[bool] = None  # exactly what it says on the tin
-        self.awk_supports_nextfile: Optional[bool] = None  # whether the 'nextfile' command is supported by awk. it's in
-                                                           # POSIX and gawk supports it, but e.g. mawk does not
-        self.default_linker_kind: Optional[str] = None  # kind of default dynamic interpreter (that ldd uses; gnu/musl)
+        self.find_supports_printf: Optional[bool] = None  # GNU find does, busybox find does not
+        self.default_linker_path: Optional[str] = None  # path to the dynamic linker that is used by default
 
 
     def close(self) -> None:
+        if self.tracer and self.tracer.events:
+            self.tracer.save(os.path.join(self.path, "trace.json"))
+            summary = self.tracer.summarize()
+            with open(os.path.join(self.path, "trace.txt"), "w") as f:
+                f.write(summary)
+            print(f"Trace saved to {self.path}/trace.json, summary:")
+            print(summary, end="")
+            self.tracer = None
+        if self.agent:
+            self.agent.close()
         if self.docker_container:
             self.docker_container.stop()
             self.docker_container.remove()
+        if self.remove_image and self.docker_image_id:
+            # The image is untagged, so this removes the intermediate layers too, but not the base image
+            print("Removing Docker image", self.docker_image_id)
+            try:
+                docker_client.images.remove(self.docker_image_id)
+            except docker.errors.APIError as e:
+                # Don't hide the reason the build failed, if it did
+                print("Could not remove Docker image:", e)
 
 
     def __enter__(self) -> PackageBuilder:
@@ -66,69 +417,410 @@ class PackageBuilder:
         self.close()
 
 
-    # Full build process: build Docker image, execute config, create .tar.gz
+    # A span of the trace, if tracing is enabled. The yielded dict holds the arguments of the span.
+    def trace(self, name: str, category: str="phase", **args):
+        if self.tracer is None:
+            return contextlib.nullcontext(args)
+        return self.tracer.span(name, category, **args)
+
+
+    # Full build process: build Docker image, execute config, create .tar.zst or .sfs
     def build(self) -> None:
         print("Building", self.name)
 
+        target_path = os.path.join(self.path, self.name + ARCHIVE_FORMATS[self.archive_format])
+        cache_key = self.get_cache_key()
+        if cache_key is not None and not self.force and self.read_cache_key(target_path) == cache_key:
+            print("Package is up to date, reusing", target_path)
+            return
+
         if os.path.exists(os.path.join(self.path, "Dockerfile")):
             print("Dockerfile exists; running docker build")
-            proc = subprocess.Popen(["docker", "build", self.path], stdout=subprocess.PIPE)
-            for line in proc.stdout:
-                if line.startswith(b"Successfully built "):
-                    self.docker_image_id = line.split()[2].decode()
-                sys.stdout.buffer.write(line)
-                sys.stdout.buffer.flush()
-            proc.wait()
-            if proc.returncode != 0:
-                print("docker build failed, exitting")
-                raise BuildFailure()
-            if not self.docker_image_id:
-                print("Unexpected error: could not get image ID")
-                raise BuildFailure()
+            with self.trace("docker build"):
+                self.docker_image_id = self.build_docker_image()
+            if self.image_id_path:
+                with open(self.image_id_path, "w") as f:
+                    f.write(self.docker_image_id + "\n")
 
             print("Starting Docker container")
-            self.docker_container = docker_client.containers.run(self.docker_image_id, command=["sleep", "infinity"], detach=True)
+            with self.trace("start container"):
+                self.docker_container = docker_client.containers.run(self.docker_image_id, command=["sleep", "infinity"], detach=True)
+                self.agent = ContainerAgent(self.docker_container.id)
         else:
             print("Dockerfile missing; this is not supported")
             raise BuildFailure()
 
-        self.configure()
+        with self.trace("configure"):
+            self.configure()
 
-        self.import_env()
+        with self.trace("import environment"):
+            self.import_env()
 
-        with open(os.path.join(self.path, "manifest")) as f:
+        with self.trace("manifest"), open(os.path.join(self.path, "manifest")) as f:
             for line in f:
-                self.run_command(line)
+                if line.strip() and not line.lstrip().startswith("#"):
+                    with self.trace(line.strip(), "manifest"):
+                        self.run_command(line)
                 # argv = self._split_argv(self._substitute_exec(line))
                 # self.run_command(argv)
 
-        self.commit_binary_addition()
+        with self.trace("add binaries"):
+            self.commit_binary_addition()
+
+        self.check_warmups()
+
+        with self.trace("generate ld.so.cache"):
+            cache_paths = self.write_library_caches()
 
         print("Saving parameters")
         env_str = "".join(f"{key}={value}\n" for key, value in sorted(self.env.items()))
         self.run_docker_oneshot(["sh", "-c", "mkdir /.sunwalker && printf %s \"$1\" >/.sunwalker/env", "-", env_str], user="root")
+        if cache_paths:
+            # Tells the runner that libraries can be found without the default LD_LIBRARY_PATH
+            self.run_docker_oneshot(["sh", "-c", "printf %s \"$1\" >/.sunwalker/ld-cache", "-", "".join(path + "\n" for path in cache_paths)], user="root")
 
         print("Saving image")
-        target_path = os.path.join(self.path, self.name + ".tar.gz")
-        with open(target_path, "wb") as f:
-            proc = self.run_docker(["tar", "czf", "-", "/.sunwalker"] + list(self.added_binaries), stdout=f)
+        with self.trace("save"):
+            self.save(target_path)
+
+        if self.prune_unused:
+            with self.trace("prune"):
+                self.prune(target_path)
+
+        if cache_key is not None:
+            with open(target_path + ".key", "w") as f:
+                f.write(cache_key + "\n")
+
+        # The package is already saved, so the report must not fail the build
+        if self.warmups and self.warmup_report:
+            with self.trace("measure warm-ups"):
+                try:
+                    self.report_warmups()
+                except BuildFailure:
+                    print("-> Could not measure the effect of warm-ups")
+
+
+    # Save the package in the configured format. If keep is given, only the files for which it returns True are saved.
+    def save(self, target_path: str, keep: Optional[Callable[[tarfile.TarInfo], bool]]=None) -> None:
+        # Write to a temporary file first so that a failed build never leaves a truncated archive behind a valid cache
+        # key
+        tmp_path = target_path + ".tmp"
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        try:
+            if self.archive_format == "squashfs":
+                self.save_squashfs(tmp_path, keep)
+            else:
+                self.save_archive(tmp_path, keep)
+            os.replace(tmp_path, target_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+
+        if self.archive_format == "tar.zst":
+            print("Indexing image")
+            write_ratarmount_index(target_path)
+
+
+    # Stream an uncompressed tar of the package out of the container and compress it on the host. Tools in the container
+    # are often single-threaded (or busybox), and we want seekable zstd anyway.
+    def save_archive(self, path: str, keep: Optional[Callable[[tarfile.TarInfo], bool]]=None) -> None:
+        with open(path, "wb") as f, SeekableZstdWriter(f) as writer:
+            self.export_tar(writer, keep)
+
+
+    # Stream a tar of the package out of the container straight into a tar-to-squashfs converter, so that the package
+    # is compressed only once and bake_image.sh can use the result as is
+    def save_squashfs(self, path: str, keep: Optional[Callable[[tarfile.TarInfo], bool]]=None) -> None:
+        if shutil.which("sqfstar"):
+            # squashfs-tools 4.6+
+            converter_argv = ["sqfstar", path]
+        elif shutil.which("tar2sqfs"):
+            # squashfs-tools-ng
+            converter_argv = ["tar2sqfs", path]
+        else:
+            print("Neither sqfstar nor tar2sqfs is installed, cannot create squashfs")
+            raise BuildFailure()
+
+        converter = subprocess.Popen(converter_argv, stdin=subprocess.PIPE)
+        try:
+            self.export_tar(converter.stdin, keep)
+        finally:
+            converter.stdin.close()
+            converter.wait()
+        if converter.returncode != 0:
+            print(converter_argv[0], "failed")
+            raise BuildFailure()
+
+
+    # Start streaming a tar of the package from the container to the stdout of the returned process
+    def start_tar(self) -> subprocess.Popen:
+        return subprocess.Popen(["docker", "container", "exec", self.docker_container.id, "tar", "cf", "-", "/.sunwalker"] + sorted(self.added_binaries), stdout=subprocess.PIPE)
+
+
+    # Write a tar of the package to out. If keep is given, the archive is repacked on the fly, leaving out the members
+    # for which it returns False.
+    def export_tar(self, out, keep: Optional[Callable[[tarfile.TarInfo], bool]]=None) -> None:
+        with self.trace(f"export {len(self.added_binaries)} files", "command", program="tar") as args:
+            proc = self.start_tar()
+            if keep is None:
+                size = 0
+                for chunk in iter(lambda: proc.stdout.read(2 ** 20), b""):
+                    out.write(chunk)
+                    size += len(chunk)
+                args["output_bytes"] = size
+            else:
+                with tarfile.open(fileobj=proc.stdout, mode="r|") as src, tarfile.open(fileobj=out, mode="w|", format=tarfile.PAX_FORMAT) as dst:
+                    for member in src:
+                        if keep(member):
+                            dst.addfile(member, src.extractfile(member) if member.isfile() else None)
+            proc.wait()
+        if proc.returncode != 0:
+            print("tar failed")
+            raise BuildFailure()
+
+
+    # Remove the files that neither the tests nor the sample submissions access from the saved package. The sample
+    # submissions are the programs from programs/ in the languages of the package and the samples/ directory of the
+    # package. They are run under strace against the package that was just saved, and the package is then saved again
+    # without the unused files. Directories, symlinks and paths listed in KEEP directives are always kept. The tests and
+    # the sample submissions are then run again against the pruned package.
+    def prune(self, target_path: str) -> None:
+        if not shutil.which("strace"):
+            print("strace is not installed, cannot prune unused files")
+            raise BuildFailure()
+        # The tests alone only show what a hello world needs
+        if not get_corpus(self.name) and not os.path.isdir(os.path.join(self.path, "samples")):
+            print("The package has no sample submissions in programs/ or samples/, refusing to prune it")
+            raise BuildFailure()
+
+        print("Tracing tests and sample submissions to find unused files")
+        run_opts = ["--archive", os.path.abspath(target_path)]
+        accessed = trace_package(self.name, [*run_opts, "--with-samples"], TRACED_SYSCALLS_WITH_STAT)
+        if accessed is None:
+            print("Tests failed, cannot prune unused files")
+            raise BuildFailure()
+        corpus_accessed = trace_corpus(self.name, run_opts, TRACED_SYSCALLS_WITH_STAT)
+        if corpus_accessed is None:
+            print("Sample submissions failed, cannot prune unused files")
+            raise BuildFailure()
+        accessed += corpus_accessed
+
+        # The traced paths may go through symlinks, which are resolved against the contents of the package
+        members: dict[str, tarfile.TarInfo] = {}
+        proc = self.start_tar()
+        with tarfile.open(fileobj=proc.stdout, mode="r|") as tar:
+            for member in tar:
+                members[os.path.normpath("/" + member.name)] = member
+        proc.wait()
+        if proc.returncode != 0:
+            print("tar failed")
+            raise BuildFailure()
+
+        used: set[str] = set()
+        for path in accessed:
+            used.add(path)
+            used.add(self.resolve_member_path(members, path))
+        # A hard link is stored as a reference to another member, which must be kept too
+        for path in list(used):
+            member = members.get(path)
+            if member is not None and member.islnk():
+                used.add(os.path.normpath("/" + member.linkname))
+
+        def keep(member: tarfile.TarInfo) -> bool:
+            path = os.path.normpath("/" + member.name)
+            if not member.isfile() and not member.islnk():
+                return True
+            return path in used or any(path == keep_path or path.startswith(keep_path + "/") for keep_path in self.keep_paths)
+
+        dropped = sorted(
+            ((member.size, path) for path, member in members.items() if not keep(member)),
+            reverse=True
+        )
+        dropped_size = sum(size for size, _ in dropped)
+        with open(os.path.join(self.path, "pruned.txt"), "w") as f:
+            f.write(f"# {len(dropped)} files, {dropped_size} bytes\n")
+            for size, path in dropped:
+                f.write(f"{size}\t{path}\n")
+        print(f"Pruning {len(dropped)} unused files ({dropped_size / 2 ** 20:.1f} MiB), see {self.path}/pruned.txt")
+
+        print("Saving pruned image")
+        self.save(target_path, keep)
+
+        print("Testing pruned image")
+        if not test_package(self.name, run_opts):
+            # Don't leave a broken package behind, the cache key of which may still match
+            os.unlink(target_path)
+            print("The pruned image is broken; some of the removed files are needed and must be listed with KEEP")
+            raise BuildFailure()
+
+
+    # Resolve symlinks in an absolute path the same way the kernel would inside the package
+    def resolve_member_path(self, members: dict[str, tarfile.TarInfo], path: str) -> str:
+        def read_link(path: str) -> Optional[str]:
+            member = members.get(path)
+            return member.linkname if member is not None and member.issym() else None
+        return resolve_symlinks(path, read_link)
+
+
+    # Build the Dockerfile with BuildKit and return the ID of the image. The SDK only talks to the legacy builder, so
+    # buildx is run as a subprocess; the image ID is read from --iidfile rather than parsed from the output.
+    def build_docker_image(self) -> str:
+        with tempfile.TemporaryDirectory(prefix="sunwalker-build-") as tmp:
+            iid_path = os.path.join(tmp, "iid")
+            argv = ["docker", "buildx", "build", "--progress=plain", "--load", "--iidfile", iid_path]
+            if self.docker_builder is not None:
+                argv += ["--builder", self.docker_builder]
+            if self.build_cache is not None:
+                # Each package has its own cache directory, so that parallel builds don't overwrite each other's index
+                cache_path = os.path.join(self.build_cache, self.name)
+                if os.path.exists(os.path.join(cache_path, "index.json")):
+                    argv += ["--cache-from", f"type=local,src={cache_path}"]
+                argv += ["--cache-to", f"type=local,dest={cache_path},mode=max"]
+            argv.append(self.path)
+
+            proc = subprocess.Popen(argv, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            for line in proc.stdout:
+                sys.stdout.buffer.write(line)
+                sys.stdout.buffer.flush()
+            proc.wait()
             if proc.returncode != 0:
-                print("tar failed")
+                print("docker build failed, exitting")
                 raise BuildFailure()
 
+            try:
+                with open(iid_path) as f:
+                    image_id = f.read().strip()
+            except FileNotFoundError:
+                image_id = ""
+            if not image_id:
+                print("Unexpected error: could not get image ID")
+                raise BuildFailure()
+            return image_id
+
+
+    # Compute the key of the build cache. The package is only rebuilt if a file in the package directory (the build
+    # context of the Dockerfile, the manifest, the tests), its base images, or the builder itself change. Returns None if
+    # the key cannot be computed, i.e. the package should always be rebuilt.
+    def get_cache_key(self) -> Optional[str]:
+        h = hashlib.sha256()
+        h.update(f"builder {BUILDER_VERSION}\n".encode())
+
+        for file_name in ("Dockerfile", "manifest"):
+            if not os.path.isfile(os.path.join(self.path, file_name)):
+                return None
+        for rel_path in self.list_build_context():
+            with open(os.path.join(self.path, rel_path), "rb") as f:
+                content = f.read()
+            h.update(f"{rel_path} {len(content)}\n".encode())
+            h.update(content)
+
+        # The pruned package also depends on what the sample submissions from programs/ do
+        if self.prune_unused:
+            h.update(b"prune\n")
+            for source in sorted({source for *_, source in get_corpus(self.name)}):
+                with open(source, "rb") as f:
+                    content = f.read()
+                h.update(f"{os.path.basename(source)} {len(content)}\n".encode())
+                h.update(content)
+
+        for image in self.get_base_images():
+            digest = self.get_image_digest(image)
+            if digest is None:
+                print("Could not resolve base image", image, "-- build cache is disabled")
+                return None
+            h.update(f"FROM {image} {digest}\n".encode())
+
+        return h.hexdigest()
+
+
+    # List the files in the package directory, relative to it and sorted, except for the outputs of the builder and the
+    # artifacts the tests leave behind, which are listed in .gitignore files
+    def list_build_context(self) -> list[str]:
+        result = []
+        for directory, dir_names, file_names in os.walk(self.path):
+            ignored = read_gitignore(directory) if directory != self.path else []
+            dir_names[:] = [name for name in dir_names if not is_ignored(name, ignored)]
+            for file_name in file_names:
+                if is_ignored(file_name, ignored):
+                    continue
+                if directory == self.path and (
+                    file_name in BUILD_OUTPUTS
+                    or file_name.startswith(self.name + ".tar.")
+                    or file_name.startswith(self.name + ".sfs")
+                    or file_name.endswith(".key")
+                ):
+                    continue
+                result.append(os.path.relpath(os.path.join(directory, file_name), self.path))
+        return sorted(result)
+
+
+    # List images the Dockerfile is based on, excluding references to previous stages of multi-stage builds
+    def get_base_images(self) -> list[str]:
+        images = []
+        stage_names = set()
+        with open(os.path.join(self.path, "Dockerfile")) as f:
+            for line in f:
+                words = line.split()
+                if not words or words[0].upper() != "FROM":
+                    continue
+                words = [word for word in words[1:] if not word.startswith("--")]
+                if not words:
+                    continue
+                if len(words) >= 3 and words[1].upper() == "AS":
+                    stage_names.add(words[2])
+                if words[0] not in stage_names and words[0] != "scratch":
+                    images.append(words[0])
+        return images
+
+
+    # Get the digest of the image the reference currently points to. The registry is asked first, so that tags like
+    # 'latest' are tracked; if the registry is unavailable, the local image is used.
+    def get_image_digest(self, image: str) -> Optional[str]:
+        try:
+            return docker_client.images.get_registry_data(image).id
+        except docker.errors.APIError:
+            pass
+        try:
+            return docker_client.images.get(image).id
+        except docker.errors.APIError:
+            return None
+
+
+    def read_cache_key(self, target_path: str) -> Optional[str]:
+        if not os.path.exists(target_path):
+            return None
+        try:
+            with open(target_path + ".key") as f:
+                return f.read().strip()
+        except FileNotFoundError:
+            return None
+
 
     # Execute a command in the Docker container, possibly passing parameters to subprocess.run, returning a
     # subprocess.CompletedProcess object. Useful for when the output has to be redirected, which run_docker_oneshot does
     # not support.
     def run_docker(self, argv: list[str], **kwargs):
-        return subprocess.run(["docker", "container", "exec", self.docker_container.id] + argv, **kwargs)
+        with self.trace(summarize_argv(argv), "command", program=argv[0]) as args:
+            proc = subprocess.run(["docker", "container", "exec", self.docker_container.id] + argv, **kwargs)
+            args["returncode"] = proc.returncode
+            if isinstance(proc.stdout, bytes):
+                args["output_bytes"] = len(proc.stdout)
+        return proc
         # return subprocess.run(["docker", "run", self.docker_image_id] + argv, **kwargs)
 
 
-    # Execute a command in the Docker container, using Docker SDK and returning output (if check=True) or (exit code,
-    # output). Should be preferred to run_docker.
+    # Execute a command in the Docker container, returning output (if check=True) or (exit code, output). Should be
+    # preferred to run_docker. The command is sent to the agent, unless options only Docker SDK supports are passed.
     def run_docker_oneshot(self, argv: list[str], check: bool=True, **kwargs) -> bytes | tuple[int, bytes]:
-        returncode, stdout = self.docker_container.exec_run(argv, **kwargs, environment=self.env)
+        with self.trace(summarize_argv(argv), "command", program=argv[0]) as args:
+            if self.agent and set(kwargs) <= {"stdout", "stderr"}:
+                returncode, stdout = self.agent.run(argv, self.env, **kwargs)
+            else:
+                args["via"] = "docker exec"
+                returncode, stdout = self.docker_container.exec_run(argv, **kwargs, environment=self.env)
+            args["returncode"] = returncode
+            args["output_bytes"] = len(stdout or b"")
         if check:
             if returncode != 0:
                 print("Command exitted with status", returncode, ":", argv)
@@ -147,31 +839,26 @@ class PackageBuilder:
 
 
     # Detect configuration of the Docker container and various utilities, such as:
-    # - whether readlink supports -z argument;
-    # - what is the default interpreter--that is, what interpreter ldd is for. This is just an optimization: we use this
-    #   as the first guess for the interpreter ELF dynamic objects use. If we guess right, a single ldd call will yield
-    #   the correct dependency list and verify that the binary uses the expected interpreter, and if we guess wrong, ldd
-    #   will provide us with the path to the correct interpreter.
+    # - whether find supports -printf;
+    # - what is the default interpreter. Shared libraries don't specify what dynamic linker they are to be loaded with,
+    #   so unless we know what binary loads them, we assume it's the linker the system shell uses.
     def configure(self) -> None:
-        readlink_help = self.run_docker_oneshot(["readlink", "--help"]).decode()
-        self.readlink_supports_zero_terminated_output = " -z" in readlink_help
-        print("-> readlink -z supported:", self.readlink_supports_zero_terminated_output)
-
-        awk_output = self.run_docker(["sh", "-c", "printf 'a\nb\n' | awk '{print $1} {nextfile}'"], capture_output=True).stdout.decode()
-        assert awk_output in ("a\n", "a\nb\n")
-        self.awk_supports_nextfile = awk_output == "a\n"
-        print("-> awk {nextfile} supported:", self.awk_supports_nextfile)
-
-        ldd_version = self.run_docker_oneshot(["ldd", "--version"], check=False)[1].decode()
-        if "GLIBC" in ldd_version:
-            self.default_linker_kind = "gnu"
-        elif "musl libc" in ldd_version:
-            self.default_linker_kind = "musl"
-        else:
-            print("Unknown linker (only GNU and musl ld are supported) at ldd")
+        returncode, find_output = self.run_docker_oneshot(["find", "/", "-maxdepth", "0", "-printf", "%y"], check=False, stderr=False)
+        self.find_supports_printf = returncode == 0 and find_output == b"d"
+        print("-> find -printf supported:", self.find_supports_printf)
+
+        try:
+            sh = parse_elf(self.run_docker_oneshot(["cat", "/bin/sh"]))
+        except ElfError as e:
+            print("Could not parse /bin/sh:", e)
+            raise BuildFailure()
+        if sh.interpreter is None:
+            print("/bin/sh is statically linked, cannot detect the default dynamic linker")
             raise BuildFailure()
+        self.default_linker_path = sh.interpreter
 
-        print("-> Default linker:", self.default_linker_kind)
+        linker = self.get_linker(self.default_linker_path)
+        print("-> Default linker:", linker.path, f"({linker.kind})")
 
 
     # Run a single command from manifest
@@ -208,13 +895,165 @@ class PackageBuilder:
         elif command == "BIN":
             for arg in args:
                 self.add_binary(arg)
+        elif command == "KEEP":
+            for arg in args:
+                if arg[0] != "/":
+                    print("-> KEEP requires absolute paths, got", arg)
+                    raise BuildFailure()
+                print("-> Keep", arg)
+                self.keep_paths.append(os.path.normpath(arg))
+        elif command == "WARMUP":
+            self.run_warmup(args)
         else:
             print("-> Unknown command", argv)
             raise BuildFailure()
 
 
+    # Run a warm-up command, `WARMUP <path>... -- <command>`, and remember the files it wrote under the paths
+    def run_warmup(self, args: list[str]) -> None:
+        if "--" not in args:
+            print("-> WARMUP requires -- between the paths and the command, got", args)
+            raise BuildFailure()
+        i = args.index("--")
+        paths, argv = [os.path.normpath(path) for path in args[:i]], args[i + 1:]
+        if not paths or not argv or any(path[0] != "/" for path in paths):
+            print("-> WARMUP requires absolute paths and a command, got", args)
+            raise BuildFailure()
+
+        print("-> Warm up", argv)
+        marker = "/tmp/.sunwalker-warmup"
+        self.run_docker_oneshot(["touch", marker])
+        start = time.monotonic()
+        self.run_docker_oneshot(argv, stdout=False, stderr=False)
+        duration = time.monotonic() - start
+        outputs = self.split_null(self.run_docker_oneshot(["find", *paths, "-newer", marker, "-not", "-type", "d", "-print0"]).decode())
+        self.run_docker_oneshot(["rm", marker])
+        print(f"-> Warm-up took {duration:.1f}s and wrote {len(outputs)} files")
+
+        self.warmups.append(Warmup(paths, argv, outputs))
+        # Caches are only read when they hit, so tracing the tests would not see most of them. The rest of the paths is
+        # pruned as usual.
+        self.keep_paths += outputs
+
+
+    # Warm-up outputs that don't end up in the package are wasted effort, and probably a typo in the manifest
+    def check_warmups(self) -> None:
+        for warmup in self.warmups:
+            missing = [path for path in warmup.outputs if path not in self.added_binaries]
+            if missing:
+                print(f"-> {len(missing)} files written by warm-up {warmup.argv} are not added by BIN, e.g.", missing[0])
+                raise BuildFailure()
+
+
+    # Build and run a program in every language of the package with and without the outputs of the warm-ups, and print
+    # the difference. The package is saved by now, so the outputs are simply deleted from the container.
+    def report_warmups(self) -> None:
+        print("Measuring the effect of warm-ups")
+        outputs = [path for warmup in self.warmups for path in warmup.outputs]
+        directory = "/tmp/.sunwalker-warmup-check"
+
+        programs = []
+        for name, language in load_languages(self.name).items():
+            extensions = [pattern[1:] for pattern in language.inputs if pattern.startswith("%.")]
+            source = next(filter(None, (
+                find_program_source(self.name, program, extension)
+                for program in ("heavy_includes", "hello_world") for extension in extensions
+            )), None)
+            if source is None:
+                print("-> No program to measure", name, "with")
+            else:
+                programs.append((name, language, source))
+
+        def measure(language: Language, source: str) -> float:
+            with open(source) as f:
+                code = f.read()
+            self.run_docker_oneshot(["rm", "-rf", directory])
+            self.run_docker_oneshot(["mkdir", directory])
+            self.run_docker_oneshot(["sh", "-c", 'printf %s "$1" >"$0"', f"{directory}/program{os.path.splitext(source)[1]}", code])
+            sandbox = ContainerSandbox(self, directory)
+            start = time.monotonic()
+            run_submission(language, build_submission(language, sandbox, "program"))
+            return time.monotonic() - start
+
+        # The first run populates the page cache
+        warm: dict[str, float] = {}
+        for name, language, source in programs:
+            try:
+                measure(language, source)
+                warm[name] = min(measure(language, source) for _ in range(3))
+            except EvaluationError as e:
+                print("-> Cannot measure", name, ":", e)
+
+        cold: dict[str, float] = {}
+        for name, language, source in programs:
+            if name not in warm:
+                continue
+            times = []
+            try:
+                for _ in range(3):
+                    # Runs may write the caches again, which a fresh sandbox would not see
+                    self.run_docker_oneshot(["rm", "-f", *outputs])
+                    times.append(measure(language, source))
+            except EvaluationError as e:
+                print("-> Cannot measure", name, "without warm-ups:", e)
+                continue
+            cold[name] = min(times)
+
+        for name, language, source in programs:
+            if name in cold:
+                print(f"-> {name} ({os.path.basename(source)}): {cold[name]:.2f}s without warm-ups, {warm[name]:.2f}s with, {cold[name] / warm[name]:.1f}x faster")
+
+
+    # Generate ld.so.cache for the glibc linkers in the package, so that the runner does not have to set a long
+    # LD_LIBRARY_PATH, which makes every process probe each directory in it for each library. The libraries that were
+    # found in the cache or the default directories of the linker during the build map to the same paths, and, like
+    # ldconfig would, the other libraries in the directories the runner used to search are listed too, for dlopen.
+    # Returns the paths of the caches.
+    def write_library_caches(self) -> list[str]:
+        by_directory: defaultdict[str, list[str]] = defaultdict(list)
+        for path in sorted(self.added_binaries):
+            by_directory[os.path.dirname(path)].append(path)
+
+        caches: dict[str, dict[str, str]] = {}
+        for linker in self.linkers.values():
+            if linker.kind != "gnu" or linker.path not in self.added_binaries:
+                continue
+            libraries = caches.setdefault(linker.cache_path, {})
+            for name, path in self.default_libraries.get(linker.path, {}).items():
+                libraries.setdefault(name, path)
+            for directory in RUNNER_LIBRARY_PATH + linker.search_paths:
+                for path in by_directory.get(directory, []):
+                    if ".so" in os.path.basename(path):
+                        libraries.setdefault(os.path.basename(path), path)
+
+        for cache_path, libraries in caches.items():
+            libraries = {name: path for name, path in libraries.items() if self.is_x86_64_library(path)}
+            print("-> Generate", cache_path, "with", len(libraries), "libraries")
+            data = write_ld_so_cache(libraries)
+            archive = io.BytesIO()
+            with tarfile.open(fileobj=archive, mode="w") as tar:
+                info = tarfile.TarInfo(os.path.basename(cache_path))
+                info.size = len(data)
+                info.mode = 0o644
+                tar.addfile(info, io.BytesIO(data))
+            self.run_docker_oneshot(["mkdir", "-p", os.path.dirname(cache_path)])
+            self.docker_container.put_archive(os.path.dirname(cache_path), archive.getvalue())
+            self.added_binaries.add(cache_path)
+            self.keep_paths.append(cache_path)
+        return list(caches)
+
+
+    def is_x86_64_library(self, path: str) -> bool:
+        for _ in range(40):
+            if path not in self.symlinks:
+                break
+            path = self.symlinks[path]
+        elf = self.elf_files.get(path)
+        return elf is not None and elf.elf_class == ELFCLASS64 and elf.machine == EM_X86_64 and elf.type == ET_DYN
+
+
     # Add a file, along with its potential linker, to the pending addition list
-    def add_binary(self, binary_path: str, linker_kind: Optional[str]=None, linker_path: Optional[str]=None) -> None:
+    def add_binary(self, binary_path: str, linker_path: Optional[str]=None, loader_rpath: tuple[str, ...]=()) -> None:
         if binary_path[0] != "/":
             binary_path = self.run_docker_oneshot(["which", binary_path]).decode().strip("\n")
 
@@ -223,10 +1062,7 @@ class PackageBuilder:
         if binary_path in self.pending_addition_binaries or binary_path in self.added_binaries:
             return
 
-        if linker_kind is None:
-            linker_kind = self.default_linker_kind
-
-        self.pending_addition_binaries[binary_path] = PendingAdditionBinary(binary_path, linker_kind, linker_path)
+        self.pending_addition_binaries[binary_path] = PendingAdditionBinary(binary_path, linker_path, loader_rpath)
 
 
     # Import environment variables from Docker container
@@ -239,231 +1075,332 @@ class PackageBuilder:
                 self.env[key] = value
 
 
-    # Batch-add binaries from the pending-addition list. Batch operations are more efficient because they allow us to
-    # use O(1) commands in most cases, except when system tools don't support batch usage (e.g. busybox readlink and
-    # musl ldd don't).
+    # Take a snapshot of the metadata of the container filesystem. With GNU find, this is a single listing; otherwise,
+    # the metadata is listed by stat and the symlinks are read by readlink, which takes one command per symlink.
+    def index_filesystem(self) -> FileSystemIndex:
+        print("Indexing the container filesystem")
+        files: dict[str, FileInfo] = {}
+        if self.find_supports_printf:
+            output = self.run_index_command(["find", "/", "-xdev", "-printf", "%y %m %s %p\\0%l\\0"])
+            fields = output.decode(errors="surrogateescape").split("\0")
+            for header, link_target in zip(fields[:-1:2], fields[1::2]):
+                file_type, mode, size, path = header.split(" ", 3)
+                files[os.path.normpath(path)] = FileInfo(file_type, int(mode, 8), int(size), link_target)
+        else:
+            # busybox stat has no way to separate entries by null bytes, so paths containing newlines are skipped
+            output = self.run_index_command(["find", "/", "-xdev", "-exec", "stat", "-c", "%f %s %n", "{}", "+"])
+            for line in output.decode(errors="surrogateescape").splitlines():
+                try:
+                    raw_mode, size, path = line.split(" ", 2)
+                    mode = int(raw_mode, 16)
+                except ValueError:
+                    print("-> Skipping unexpected line", repr(line))
+                    continue
+                file_type = "f" if stat.S_ISREG(mode) else "d" if stat.S_ISDIR(mode) else "l" if stat.S_ISLNK(mode) else "p" if stat.S_ISFIFO(mode) else "c"
+                files[os.path.normpath(path)] = FileInfo(file_type, stat.S_IMODE(mode), int(size))
+
+            output = self.run_index_command([
+                "find", "/", "-xdev", "-type", "l", "-exec",
+                "sh", "-c", 'for f; do printf "%s\\0%s\\0" "$f" "$(readlink "$f")"; done', "sh", "{}", "+"
+            ])
+            fields = output.decode(errors="surrogateescape").split("\0")
+            for path, link_target in zip(fields[:-1:2], fields[1::2]):
+                info = files.get(os.path.normpath(path))
+                if info is not None:
+                    info.link_target = link_target
+        files.setdefault("/", FileInfo("d", 0o755, 0))
+        print("->", len(files), "files")
+        return FileSystemIndex(files)
+
+
+    # Run a command that lists the filesystem. Its output must not be mixed with errors, and an incomplete listing would
+    # silently drop dependencies, so any failure fails the build.
+    def run_index_command(self, argv: list[str]) -> bytes:
+        returncode, output = self.run_docker_oneshot(argv, check=False, stderr=False)
+        if returncode != 0:
+            print("Command exitted with status", returncode, ":", argv)
+            raise BuildFailure()
+        return output
+
+
+    # Batch-add binaries from the pending-addition list. Everything except the contents of files is looked up in the
+    # index of the filesystem, so each round costs a single command in the container, which reads the files.
     def commit_binary_addition(self) -> None:
+        if self.filesystem is None:
+            with self.trace("index filesystem"):
+                self.filesystem = self.index_filesystem()
+
         while self.pending_addition_binaries:
             lst = self.pending_addition_binaries
             self.pending_addition_binaries = {}
 
-            for symlink in self.add_symlinks_from_list(list(lst.keys())):
-                del lst[symlink]
+            for symlink, link_target in self.add_symlinks_from_list(list(lst.keys())).items():
+                binary = lst.pop(symlink)
+                self.add_binary(link_target, binary.linker_path, binary.loader_rpath)
 
             if not lst:
                 continue
 
             # Try to guess what dependencies the binaries require. Of course, we cannot guess this 100% correctly, but
-            # we can still try.
-
-            # For scripts, read the shebang
-            if self.awk_supports_nextfile:
-                awk_cmdline = "/^#!.*/{printf(\"%s%c%s%c\", FILENAME, 0, $0, 0)} {nextfile}"
-            else:
-                awk_cmdline = "NR==1&&/^#!.*/{printf(\"%s%c%s%c\", FILENAME, 0, $0, 0)}"
-            shebangs = self.split_null(self.run_docker_oneshot(["find", *lst.keys(), "-type", "f", "-executable", "-exec", "awk", awk_cmdline, "{}", "+"]).decode())
-            for script, shebang in zip(shebangs[::2], shebangs[1::2]):
-                splitted = shebang[2:].strip().split(" ", 1)
-                interp = splitted[0]
-                interp_arg = None if len(splitted) == 1 else splitted[1]
-                self.add_binary(interp)
-                if interp in ("env", "/usr/bin/env") and interp_arg:
-                    self.add_binary(interp_arg)
-
-            # For ELF files, split by dynamic linker and ask the linker about what shared libraries are requested
-            files_by_linker: defaultdict[tuple[str, Optional[str]], list[str]] = defaultdict(list)
+            # we can still try. For ELF files, read the dynamic section and resolve the libraries the same way the
+            # dynamic linker would. The loader of a file affects the resolution, so files are grouped by it.
+            files_by_loader: defaultdict[tuple[Optional[str], tuple[str, ...]], list[str]] = defaultdict(list)
             for binary in lst.values():
-                files_by_linker[binary.linker_kind, binary.linker_path].append(binary.path)
+                files_by_loader[binary.linker_path, binary.loader_rpath].append(binary.path)
 
-            for (linker_kind, linker_path), paths in files_by_linker.items():
+            for (linker_path, loader_rpath), paths in files_by_loader.items():
                 # Unpack directories to lists of files
-                paths = self.split_null(self.run_docker_oneshot(["find", *paths, "-not", "-type", "d", "-print0"]).decode())
+                paths = [file for path in paths for file in self.filesystem.walk(path)]
                 if not paths:
                     continue
 
                 # Handle nested symlinks
-                paths = list(set(paths) - set(self.add_symlinks_from_list(paths)))
+                symlinks = self.add_symlinks_from_list(paths)
+                for link_target in symlinks.values():
+                    self.add_binary(link_target, linker_path, loader_rpath)
+                paths = [path for path in paths if path not in symlinks]
 
-                success_list = self.add_shared_elf_recursively(paths, linker_kind, linker_path)
+                self.read_elf_files(paths)
 
-                # Add the binaries to the success list if the addition was successful
-                for path, success in zip(paths, success_list):
-                    if success:
-                        print("-> Add binary", path)
-                        self.added_binaries.add(path)
+                # For scripts, add the interpreter from the shebang
+                for path in paths:
+                    if path not in self.shebangs:
+                        continue
+                    splitted = self.shebangs[path][2:].strip().split(" ", 1)
+                    interp = splitted[0]
+                    interp_arg = None if len(splitted) == 1 else splitted[1]
+                    self.add_binary(interp)
+                    if interp in ("env", "/usr/bin/env") and interp_arg:
+                        self.add_binary(interp_arg)
+
+                self.add_elf_dependencies(paths, linker_path, loader_rpath)
+
+                for path in paths:
+                    print("-> Add binary", path)
+                    self.added_binaries.add(path)
+
+
+    # Find symlinks among files, add them and return a mapping from symlinks to absolute paths of their targets. The
+    # targets are not added automatically.
+    def add_symlinks_from_list(self, files: list[str]) -> dict[str, str]:
+        abs_link_targets = {}
+        for path in files:
+            info = self.filesystem.lookup(path)
+            if info is None:
+                print("File", path, "does not exist")
+                raise BuildFailure()
+            if info.type != "l":
+                continue
+            abs_link_target = os.path.abspath(os.path.join(os.path.dirname(path), info.link_target))
+            print("-> Add symlink", path, "->", abs_link_target)
+            self.added_binaries.add(path)
+            self.symlinks[path] = abs_link_target
+            abs_link_targets[path] = abs_link_target
+        return abs_link_targets
+
+
+    # Stream the files out of the container in a single tar archive and parse the ELF ones. Symlinks must be resolved
+    # beforehand, tar does not follow them.
+    def read_elf_files(self, paths: list[str]) -> None:
+        paths = [path for path in paths if path not in self.elf_files]
+        # Only executables can be scripts, and most files that are not executable are obviously not ELF either
+        for path in paths:
+            info = self.filesystem.lookup(path) if self.filesystem else None
+            if info is not None and (info.type != "f" or (not info.mode & 0o111 and os.path.splitext(path)[1] in NON_ELF_EXTENSIONS)):
+                self.elf_files[path] = None
+        paths = [path for path in paths if path not in self.elf_files]
+        if not paths:
+            return
+
+        with self.trace(f"read {len(paths)} files for ELF headers", "command", program="tar") as args:
+            proc = subprocess.Popen(["docker", "container", "exec", self.docker_container.id, "tar", "cf", "-", *paths], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+            with tarfile.open(fileobj=proc.stdout, mode="r|") as tar:
+                for member in tar:
+                    path = os.path.normpath("/" + member.name)
+                    if member.islnk():
+                        # Hard link to a file that was seen before
+                        self.elf_files[path] = self.elf_files.get(os.path.normpath("/" + member.linkname))
+                        continue
+                    if not member.isfile():
+                        continue
+                    f = tar.extractfile(member)
+                    data = f.read(4)
+                    if not is_elf(data):
+                        self.elf_files[path] = None
+                        if data.startswith(b"#!") and member.mode & 0o111:
+                            self.shebangs[path] = (data + f.read(1024)).split(b"\n", 1)[0].decode(errors="surrogateescape")
+                        continue
+                    data += f.read()
+                    try:
+                        self.elf_files[path] = parse_elf(data)
+                    except ElfError as e:
+                        print("Warning: could not parse ELF file", path, ":", e)
+                        self.elf_files[path] = None
+            proc.wait()
+            args["returncode"] = proc.returncode
+        if proc.returncode != 0:
+            print("Warning: tar failed to read some files, their dependencies are not added")
 
 
-    def add_symlinks_from_list(self, files: list[str]):
-        symlinks = self.split_null(self.run_docker_oneshot(["find", *files, "-maxdepth", "0", "-type", "l", "-print0"]).decode())
-        if symlinks:
-            if self.readlink_supports_zero_terminated_output:
-                link_targets = self.split_null(self.run_docker_oneshot(["readlink", "-z", *symlinks]).decode())
+    # Add the interpreters and the libraries the ELF files require. The files must have been read by read_elf_files.
+    def add_elf_dependencies(self, paths: list[str], linker_path: Optional[str], loader_rpath: tuple[str, ...]) -> None:
+        unresolved: list[tuple[str, ElfFile, DynamicLinker]] = []
+        for path in paths:
+            elf = self.elf_files.get(path)
+            if elf is None:
+                continue
+            if elf.interpreter is not None:
+                self.add_binary(elf.interpreter)
+                linker = self.get_linker(elf.interpreter)
+            else:
+                linker = self.get_linker(linker_path or self.default_linker_path)
+            if elf.needed:
+                unresolved.append((path, elf, linker))
+
+        # Try the expected linker first, and if the libraries cannot be found with it (e.g. a glibc library is being
+        # added to a musl-based image explicitly), any other linker we know of
+        self.list_directories([
+            search_path
+            for path, elf, linker in unresolved
+            for search_path in self.get_library_search_paths(path, elf, linker, loader_rpath)
+        ])
+        for path, elf, linker in unresolved:
+            for candidate_linker in [linker] + [other for other in self.linkers.values() if other is not linker]:
+                search_paths = self.get_library_search_paths(path, elf, candidate_linker, loader_rpath)
+                self.list_directories(search_paths)
+                libraries = [self.resolve_library(name, search_paths, candidate_linker) for name in elf.needed]
+                if None not in libraries:
+                    break
+                if elf.interpreter is not None:
+                    # The linker is set in stone
+                    break
             else:
-                link_targets = []
-                for symlink in symlinks:
-                    link_targets.append(self.run_docker_oneshot(["readlink", symlink])[:-1].decode())
-            assert len(symlinks) == len(link_targets)
-            for symlink, link_target in zip(symlinks, link_targets):
-                abs_link_target = os.path.abspath(os.path.join(os.path.dirname(symlink), link_target))
-                print("-> Add symlink", symlink, "->", abs_link_target)
-                self.added_binaries.add(symlink)
-                self.add_binary(abs_link_target)
+                candidate_linker = linker
+                search_paths = self.get_library_search_paths(path, elf, linker, loader_rpath)
+                libraries = [self.resolve_library(name, search_paths, linker) for name in elf.needed]
 
-        return symlinks
+            for name, library in zip(elf.needed, libraries):
+                if library is None:
+                    print("The linker", linker.path, "could not resolve", name, "required by", path)
+                    raise BuildFailure()
+                if "/" not in name and (candidate_linker.cache.get(name) == library or os.path.dirname(library) in candidate_linker.search_paths):
+                    self.default_libraries.setdefault(candidate_linker.path, {}).setdefault(name, library)
 
+            # Objects with DT_RUNPATH ignore DT_RPATH of everything, including themselves
+            child_loader_rpath = loader_rpath
+            if not elf.runpath:
+                origin = os.path.dirname(path)
+                child_loader_rpath = tuple(self.expand_rpath(rpath, origin) for rpath in elf.rpath) + loader_rpath
 
-    # Add dependencies of shared ELF objects. Returns a list of bools indicating whether the parsing was
-    # successful (True) or the file will have to be reconsidered with different linker settings (False).
-    def add_shared_elf_recursively(self, files: list[str], linker_kind: str, linker_path: Optional[str]) -> list[bool]:
-        command_prefix = ["ldd"] if linker_path is None else [linker_path, "--list"]
+            for library in libraries:
+                self.add_binary(library, candidate_linker.path, child_loader_rpath)
 
-        success = []
 
-        if linker_kind == "gnu" and linker_path is None:
-            # GNU ldd supports multiple arguments
-            stdout = self.run_docker_oneshot(command_prefix + files, check=False, stderr=False)[1].decode()
+    # Directories the libraries requested by the file are looked up in before the default ones, in order
+    def get_library_search_paths(self, path: str, elf: ElfFile, linker: DynamicLinker, loader_rpath: tuple[str, ...]) -> list[str]:
+        origin = os.path.dirname(path)
+        rpath = [self.expand_rpath(rpath, origin) for rpath in elf.rpath]
+        runpath = [self.expand_rpath(runpath, origin) for runpath in elf.runpath]
+        ld_library_path = [os.path.normpath(path) for path in self.env.get("LD_LIBRARY_PATH", "").split(":") if path.startswith("/")]
 
-            # Split by file
-            if len(files) == 1:
-                success.append(self.add_dependencies_from_ldd_output(stdout.splitlines(), files[0], linker_kind))
+        if linker.kind == "gnu":
+            if runpath:
+                search_paths = ld_library_path + runpath
             else:
-                current_file: Optional[str] = None
-                buffer_lines: list[str] = []
-                for line in stdout.splitlines() + [":"]:
-                    if not line.startswith("\t") and line.endswith(":"):
-                        # Next file
-                        if current_file is not None:
-                            success.append(self.add_dependencies_from_ldd_output(buffer_lines, current_file, linker_kind))
-                        current_file = line[:-1]
-                        buffer_lines = []
-                    else:
-                        buffer_lines.append(line)
+                search_paths = rpath + list(loader_rpath) + ld_library_path
         else:
-            # musl ldd does not support multiple arguments. ld.so --list doesn't support multiple arguments either, it
-            # treats the second argument as a symbol name.
+            # musl does not distinguish between RPATH and RUNPATH and searches them after LD_LIBRARY_PATH
+            search_paths = ld_library_path + rpath + runpath + list(loader_rpath)
 
-            if linker_path is None:
-                sh_script = 'for file in "$@"; do echo "$file:"; ldd "$file"; done'
-                sh_args = []
-            else:
-                sh_script = 'linker_path="$1"; shift; for file in "$@"; do echo "$file:"; "$linker_path" --list "$file"; done'
-                sh_args = [linker_path]
-
-            stdout = self.run_docker_oneshot(["sh", "-c", sh_script, "-"] + sh_args + files, check=False, stderr=False)[1].decode()
-
-            current_file: Optional[str] = None
-            buffer_lines: list[str] = []
-            for line in stdout.splitlines() + [":"]:
-                if not line.startswith("\t") and line.endswith(":"):
-                    # Next file
-                    if current_file is not None:
-                        success.append(self.add_dependencies_from_ldd_output(buffer_lines, current_file, linker_kind))
-                    current_file = line[:-1]
-                    buffer_lines = []
-                else:
-                    buffer_lines.append(line)
+        return search_paths + linker.search_paths
 
-        return success
 
+    def expand_rpath(self, rpath: str, origin: str) -> str:
+        rpath = re.sub(r"\$(ORIGIN|\{ORIGIN\})", origin, rpath)
+        rpath = re.sub(r"\$(LIB|\{LIB\})", "lib64", rpath)
+        rpath = re.sub(r"\$(PLATFORM|\{PLATFORM\})", "x86_64", rpath)
+        return os.path.normpath(rpath)
 
-    # Returns True if the dependencies were added successfully, False is the binary file is to be reconsidered with
-    # different linekr settings
-    def add_dependencies_from_ldd_output(self, lines: list[str], binary_path: str, linker_kind: str) -> bool:
-        if not lines or lines[0] == "\tstatically linked" or lines[0] == "\tnot a dynamic executable":
-            # Not a dynamic executable
-            return True
 
-        # Detect the linker that the binary expects. Of course, reading PT_INTERP would be a much more robust solution,
-        # but unfortunately, neither objdump nor readelf are available on most systems, so it is what it is.
-        expected_linker_paths = []
-        for line in lines:
-            if " => " in line and line.startswith("\tld-"):
-                # Linker is specified by name--resolve path
-                expected_linker_paths.append(line.partition(" => ")[2].partition(" (")[0])
-            elif " => " in line and line.startswith("\t/") and "/ld-" in line:
-                # Linker is specified as a symlink
-                expected_linker_paths.append(line[1:].partition(" => ")[0])
-            elif " => " not in line and "/ld-" in line:
-                # Linker is specified by path
-                expected_linker_paths.append(line[1:].partition(" (")[0])
-
-        if not expected_linker_paths:
-            print(binary_path, "does not have any dynamic linker detected while being a dynamic executable")
-            raise BuildFailure()
+    def resolve_library(self, name: str, search_paths: list[str], linker: DynamicLinker) -> Optional[str]:
+        if "/" in name:
+            return os.path.normpath(name)
 
-        # Is any linker requested other than the current one? (musl ldd, for instance, always adds itself as a
-        # dependency for no reason)
-        different_linker_paths = []
-        for expected_linker_path in expected_linker_paths:
-            if self.get_kind_of_linker(expected_linker_path) != linker_kind:
-                different_linker_paths.append(expected_linker_path)
-
-        if len(different_linker_paths) == 1:
-            # We guessed wrong. Add the same binary file to the queue with the correct linker
-            path = different_linker_paths[0]
-            self.add_binary(binary_path, self.get_kind_of_linker(path), path)
-            return False
-        elif different_linker_paths:
-            # The binary requests several other linkers. This is not normal, but it sometimes happens due to symlinks.
-            # Let us resolve them
-            real_linker_paths = set()
-            for path in different_linker_paths:
-                real_linker_paths.add(self.run_docker_oneshot(["realpath", path])[:-1].decode())
-
-            if len(real_linker_paths) > 1:
-                print(binary_path, "has multiple linkers attached, even excluding the default one", different_linker_paths, linker_kind)
-                raise BuildFailure()
+        # search_paths ends with the default directories, and ld.so.cache is consulted right before them
+        n_custom_paths = len(search_paths) - len(linker.search_paths)
+        for i, search_path in enumerate(search_paths):
+            if i == n_custom_paths and name in linker.cache:
+                return linker.cache[name]
+            if name in self.directory_listings.get(search_path, ()):
+                return os.path.join(search_path, name)
+        if name in linker.cache:
+            return linker.cache[name]
 
-            # We still need to add all the symlinks even though they point to the same file
-            for linker_path in different_linker_paths:
-                self.add_binary(linker_path)
+        # The linker itself is often requested by name, e.g. by libc.so.6
+        if name == os.path.basename(linker.path):
+            return linker.path
 
-            path = list(real_linker_paths)[0]
-            self.add_binary(binary_path, self.get_kind_of_linker(path), path)
-            return False
+        return None
 
-        # We guessed right, parse the output
-        for line in lines:
-            if line.startswith("\t"):
-                if " => " in line:
-                    name = line[1:].partition(" => ")[0]
-                    dest = line.partition(" => ")[2].partition(" (")[0]
-                    if dest == "not found":
-                        print("The linker could not resolve", name)
-                        raise BuildFailure()
-                    if dest == "":
-                        # ldd sometimes resolves linux-vdso.so.1 as '', for whatever reason
-                        continue
-                    self.add_binary(dest)
-                elif " (" in line:
-                    name = line[1:].rpartition(" (")[0]
-                    if name.startswith("/"):
-                        self.add_binary(name)
 
-        return True
+    # List several directories at once. Nonexistent directories are considered empty.
+    def list_directories(self, directories: list[str]) -> None:
+        for directory in directories:
+            if directory not in self.directory_listings:
+                self.directory_listings[directory] = self.filesystem.list_directory(directory)
 
 
-    def get_kind_of_linker(self, linker_path: str) -> str:
-        if linker_path not in self.linker_kind_cache:
-            stdout = self.run_docker_oneshot([linker_path], check=False)[1].decode()
-            if "You have invoked `ld.so'" in stdout:
-                ld = "gnu"
-            elif "musl libc" in stdout:
-                ld = "musl"
-            else:
-                # Some versions of GNU ld support (and require) --help and use 'ld.so'; others don't support --help,
-                # print the help when invoked with no arguments and use `ld.so'. I don't know who thought this would be
-                # a good idea.
-                stdout = self.run_docker_oneshot([linker_path, "--help"], check=False)[1].decode()
-                if "You have invoked 'ld.so'" in stdout:
-                    ld = "gnu"
-                else:
-                    print("Unknown linker (only GNU and musl ld are supported) at", linker_path)
-                    raise BuildFailure()
+    # Detect the kind and the default search paths of the dynamic linker by looking at its code
+    def get_linker(self, linker_path: str) -> DynamicLinker:
+        if linker_path in self.linkers:
+            return self.linkers[linker_path]
+
+        returncode, data = self.run_docker_oneshot(["cat", linker_path], check=False, stderr=False)
+        if returncode != 0:
+            print("Dynamic linker", linker_path, "does not exist")
+            raise BuildFailure()
 
-            self.linker_kind_cache[linker_path] = ld
+        if b"musl libc" in data:
+            # musl reads the search path from /etc/ld-musl-$ARCH.path, and uses a hard-coded one if the file is absent
+            arch = os.path.basename(linker_path)[len("ld-musl-"):].partition(".")[0]
+            returncode, path_file = self.run_docker_oneshot(["cat", f"/etc/ld-musl-{arch}.path"], check=False, stderr=False)
+            if returncode == 0:
+                search_paths = [path for path in re.split("[:\n]", path_file.decode()) if path]
+            else:
+                search_paths = ["/lib", "/usr/local/lib", "/usr/lib"]
+            linker = DynamicLinker(linker_path, "musl", search_paths, {})
+        elif b"ld.so.cache" in data:
+            # glibc might be installed to a prefix, e.g. /usr/glibc-compat on Alpine, and the paths are hard-coded
+            match = re.search(rb"([\x21-\x7e]*)/etc/ld\.so\.cache\x00", data)
+            if match is None:
+                print("Could not find path to ld.so.cache in", linker_path)
+                raise BuildFailure()
+            cache_path = match.group(0)[:-1].decode()
+            prefix = match.group(1).decode()
+
+            # The system directories are stored as a list of consecutive strings
+            search_paths = [prefix + path for path in ("/lib64", "/usr/lib64", "/lib", "/usr/lib")]
+            for match in re.finditer(rb"\x00((?:/[\x21-\x7e]*/\x00){2,})", data):
+                paths = match.group(1).split(b"\x00")[:-1]
+                if all(b"lib" in path for path in paths):
+                    search_paths = [os.path.normpath(path.decode()) for path in paths]
+                    break
+
+            cache = {}
+            returncode, cache_data = self.run_docker_oneshot(["cat", cache_path], check=False, stderr=False)
+            if returncode == 0:
+                try:
+                    cache = parse_ld_so_cache(cache_data)
+                except ElfError as e:
+                    print("Warning: could not parse", cache_path, ":", e)
+
+            linker = DynamicLinker(linker_path, "gnu", search_paths, cache, cache_path)
+        else:
+            print("Unknown linker (only GNU and musl ld are supported) at", linker_path)
+            raise BuildFailure()
 
-        return self.linker_kind_cache[linker_path]
+        self.linkers[linker_path] = linker
+        return linker
 
 
     def split_null(self, s: str) -> list[str]:
@@ -473,15 +1410,160 @@ class PackageBuilder:
             return []
 
 
+# Runs several package builds at once, each in a separate process with its own log file. Docker images are the main
+# consumer of disk space, so a new build is only started if there is enough free space for it, and CPU is shared by
+# not starting builds while the machine is already overloaded. When space runs low, the images of the packages that
+# are already built are removed first. If nothing is running, the next build is started regardless, so that a too
+# strict budget slows the build down instead of stalling it.
+class BuildScheduler:
+    def __init__(self, package_names: list[str], jobs: int, min_free_space: int, builder_argv: list[str]):
+        self.pending_package_names: list[str] = list(package_names)  # packages that were not started yet
+        self.jobs: int = jobs  # maximum number of concurrent builds
+        self.min_free_space: int = min_free_space  # in bytes; a build is not started if less space is available
+        self.builder_argv: list[str] = builder_argv  # command line options passed to each build process
+
+        self.running: dict[str, tuple[subprocess.Popen, float]] = {}  # key is package name, value is (process, start time)
+        self.failed_package_names: list[str] = []
+        self.image_id_dir: str = tempfile.mkdtemp(prefix="sunwalker-images-")  # build processes write image IDs here
+        atexit.register(shutil.rmtree, self.image_id_dir, True)
+        self.finished_image_ids: list[str] = []  # images of finished builds, which can be removed to free space
+
+        try:
+            self.docker_root_dir: str = docker_client.info()["DockerRootDir"]
+        except (docker.errors.APIError, KeyError):
+            self.docker_root_dir = "."
+
+
+    # Build all packages, returning True if all of them were built successfully
+    def run(self) -> bool:
+        while self.pending_package_names or self.running:
+            self.poll()
+            while self.pending_package_names and self.can_start():
+                self.start(self.pending_package_names.pop(0))
+            time.sleep(1)
+
+        if self.failed_package_names:
+            print("Failed to build:", " ".join(self.failed_package_names))
+            return False
+        return True
+
+
+    def can_start(self) -> bool:
+        if not self.running:
+            return True
+        if len(self.running) >= self.jobs:
+            return False
+        if self.get_free_space() < self.min_free_space:
+            self.remove_finished_images()
+            if self.get_free_space() < self.min_free_space:
+                return False
+        if os.getloadavg()[0] >= os.cpu_count():
+            return False
+        return True
+
+
+    def get_free_space(self) -> int:
+        free_space = shutil.disk_usage("packages").free
+        try:
+            free_space = min(free_space, shutil.disk_usage(self.docker_root_dir).free)
+        except OSError:
+            # The Docker root directory is not necessarily accessible, e.g. when Docker runs in a VM
+            pass
+        return free_space
+
+
+    # Remove the Docker images of the packages that were already built. Images removed by --remove-images are skipped.
+    def remove_finished_images(self) -> None:
+        while self.finished_image_ids:
+            image_id = self.finished_image_ids.pop(0)
+            try:
+                docker_client.images.remove(image_id)
+                print("Removed Docker image", image_id, "to free disk space")
+            except docker.errors.ImageNotFound:
+                pass
+            except docker.errors.APIError as e:
+                print("Could not remove Docker image", image_id + ":", e)
+
+
+    def start(self, package_name: str) -> None:
+        free_space = self.get_free_space()
+        if free_space < self.min_free_space:
+            print(f"Warning: only {free_space / 2 ** 30:.1f} GiB of disk space is available")
+
+        log_path = os.path.join("packages", package_name, "build.log")
+        print("Building", package_name, "(log:", log_path + ")")
+        with open(log_path, "wb") as log:
+            proc = subprocess.Popen(
+                [sys.executable, os.path.abspath(__file__), *self.builder_argv, "--image-id-file", os.path.join(self.image_id_dir, package_name), package_name],
+                stdin=subprocess.DEVNULL,
+                stdout=log,
+                stderr=subprocess.STDOUT,
+                env={**os.environ, "PYTHONUNBUFFERED": "1"}
+            )
+        self.running[package_name] = (proc, time.monotonic())
+
+
+    def poll(self) -> None:
+        for package_name, (proc, start_time) in list(self.running.items()):
+            if proc.poll() is None:
+                continue
+            del self.running[package_name]
+            image_id_path = os.path.join(self.image_id_dir, package_name)
+            if os.path.exists(image_id_path):
+                with open(image_id_path) as f:
+                    self.finished_image_ids.append(f.read().strip())
+            duration = time.monotonic() - start_time
+            if proc.returncode == 0:
+                print(f"Built {package_name} in {duration:.0f}s")
+            else:
+                print(f"Failed to build {package_name} after {duration:.0f}s, see packages/{package_name}/build.log")
+                self.failed_package_names.append(package_name)
+
+
 def main():
-    if len(sys.argv) == 1:
-        package_names = os.listdir("packages")
-    else:
-        package_names = sys.argv[1:]
+    parser = argparse.ArgumentParser(description="Build sunwalker packages.")
+    parser.add_argument("packages", nargs="*", help="names of packages to build (default: all packages)")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="number of packages to build in parallel, 0 means one per CPU (default: 1)")
+    parser.add_argument("--min-free-space", type=float, default=20, metavar="GIB", help="do not start a parallel build if less disk space is available (default: 20)")
+    parser.add_argument("--remove-images", action="store_true", help="remove the Docker image of each package after it is built")
+    parser.add_argument("-f", "--force", action="store_true", help="rebuild packages even if they are up to date")
+    parser.add_argument("--format", choices=ARCHIVE_FORMATS, default="tar.zst", help="format of built packages (default: tar.zst)")
+    parser.add_argument("--prune-unused", action="store_true", help="remove files that the tests, programs/ and samples/ of the package do not access (requires strace)")
+    parser.add_argument("--warmup-report", action="store_true", help="measure how much WARMUP directives speed up building and running programs")
+    parser.add_argument("--build-cache", metavar="DIR", help="export BuildKit layer caches to this directory and reuse them in later builds (requires a builder with the docker-container driver, see --builder)")
+    parser.add_argument("--builder", help="buildx builder instance to build the Dockerfiles with (default: the current one)")
+    parser.add_argument("--image-id-file", help=argparse.SUPPRESS)  # used by BuildScheduler
+    parser.add_argument("--trace", action="store_true", help="record the time spent on each step and command to packages/<name>/trace.json (Chrome trace format) and trace.txt")
+    args = parser.parse_args()
+
+    package_names = args.packages or sorted(os.listdir("packages"))
+    jobs = args.jobs or os.cpu_count()
+
+    if jobs > 1 and len(package_names) > 1:
+        builder_argv = []
+        if args.remove_images:
+            builder_argv.append("--remove-images")
+        if args.force:
+            builder_argv.append("--force")
+        builder_argv += ["--format", args.format]
+        if args.prune_unused:
+            builder_argv.append("--prune-unused")
+        if args.warmup_report:
+            builder_argv.append("--warmup-report")
+        if args.trace:
+            builder_argv.append("--trace")
+        if args.build_cache:
+            builder_argv += ["--build-cache", os.path.realpath(args.build_cache)]
+        if args.builder:
+            builder_argv += ["--builder", args.builder]
+        scheduler = BuildScheduler(package_names, jobs, int(args.min_free_space * 2 ** 30), builder_argv)
+        if not scheduler.run():
+            sys.exit(1)
+        return
 
     for package_name in package_names:
         path = os.path.join("packages", package_name)
-        with PackageBuilder(package_name, path) as pkg:
+        with PackageBuilder(package_name, path, remove_image=args.remove_images, force=args.force, archive_format=args.format, prune_unused=args.prune_unused, warmup_report=args.warmup_report, trace=args.trace, build_cache=args.build_cache and os.path.realpath(args.build_cache), docker_builder=args.builder, image_id_path=args.image_id_file) as pkg:
             pkg.build()
 
 
@@ -0,0 +1,558 @@
+#!/usr/bin/env python3
+from __future__ import annotations
+
+from dataclasses import dataclass
+import glob
+import inspect
+import json
+import os
+import re
+import socket
+import subprocess
+import threading
+import time
+from typing import Any, Callable, Optional
+
+from runner_daemon import send_request
+
+
+# Reference evaluator of the Lisp config generated by make_config.py. The config is loaded once, and the rules of each
+# language are compiled to Python closures, with the regular expressions of sed and grep compiled in advance, so that
+# the only per-submission cost is running the commands. Commands are run in the sandbox through the runner daemon if
+# $SUNWALKER_RUNNER_SOCKET is set and through run.sh otherwise; builtins like sed and cut are implemented here instead of
+# running the real tools, the same way a judge does it.
+
+
+ROOT = os.path.realpath(os.path.join(os.path.dirname(__file__), ".."))
+
+# Where the working directory is mounted in the sandbox
+SANDBOX_DIR = "/submission"
+
+
+class EvaluationError(Exception):
+    pass
+
+
+class Symbol(str):
+    pass
+
+
+NIL = Symbol("nil")
+
+TOKEN_REGEX = re.compile(r'\s*(?:(\()|(\))|("(?:[^"\\]|\\.)*")|(-?\d+)(?=[\s()]|$)|([^\s()"]+))')
+
+
+def parse(code: str) -> Any:
+    stack: list[list] = [[]]
+    pos = 0
+    while True:
+        match = TOKEN_REGEX.match(code, pos)
+        if not match or match.end() == pos:
+            if code[pos:].strip():
+                raise EvaluationError(f"Unexpected character at position {pos}")
+            break
+        pos = match.end()
+        open_paren, close_paren, string, number, symbol = match.groups()
+        if open_paren:
+            stack.append([])
+        elif close_paren:
+            if len(stack) == 1:
+                raise EvaluationError(f"Unbalanced ')' at position {pos - 1}")
+            expr = stack.pop()
+            stack[-1].append(expr)
+        elif string:
+            stack[-1].append(json.loads(string))
+        elif number:
+            stack[-1].append(int(number))
+        else:
+            stack[-1].append(Symbol(symbol))
+    if len(stack) != 1:
+        raise EvaluationError("Unbalanced '('")
+    if len(stack[0]) != 1:
+        raise EvaluationError(f"Expected a single expression, found {len(stack[0])}")
+    return stack[0][0]
+
+
+POSIX_CLASSES = {
+    "alpha": "a-zA-Z",
+    "digit": "0-9",
+    "alnum": "a-zA-Z0-9",
+    "upper": "A-Z",
+    "lower": "a-z",
+    "xdigit": "0-9a-fA-F",
+    "space": r" \t\n\r\f\v",
+    "blank": r" \t",
+    "punct": re.escape("!\"#$%&'()*+,-./:;<=>?@[\\]^_`{|}~"),
+}
+
+
+# Translate a POSIX basic regular expression, as understood by GNU sed and grep, to Python syntax
+def bre_to_python(pattern: str) -> str:
+    result = ""
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if c == "\\" and i + 1 < len(pattern):
+            c = pattern[i + 1]
+            i += 2
+            if c in "(){}+?|":
+                result += c
+            elif c.isdigit() or c in "wWsSbB":
+                result += "\\" + c
+            elif c == "n":
+                result += "\n"
+            else:
+                result += re.escape(c)
+        elif c == "[":
+            end = i + 1
+            if end < len(pattern) and pattern[end] == "^":
+                end += 1
+            if end < len(pattern) and pattern[end] == "]":
+                end += 1
+            while end < len(pattern) and pattern[end] != "]":
+                if pattern.startswith("[:", end):
+                    end = pattern.index(":]", end + 2) + 2
+                else:
+                    end += 1
+            if end >= len(pattern):
+                raise EvaluationError(f"Unterminated bracket expression in {pattern}")
+            body = pattern[i + 1:end]
+            negate = body.startswith("^")
+            if negate:
+                body = body[1:]
+            body = body.replace("\\", "\\\\").replace("[", "\\[")
+            for name, replacement in POSIX_CLASSES.items():
+                body = body.replace(f"\\[:{name}:]", replacement)
+            if body.startswith("]"):
+                body = "\\]" + body[1:]
+            result += "[" + ("^" if negate else "") + body + "]"
+            i = end + 1
+        elif c == "*" and (i == 0 or pattern[i - 2:i] == "\\("):
+            result += "\\*"
+            i += 1
+        elif c in "(){}+?|":
+            result += "\\" + c
+            i += 1
+        else:
+            result += c
+            i += 1
+    return result
+
+
+# Translate the replacement of sed's s command to a template for re.sub
+def sed_replacement_to_python(repl: str) -> str:
+    result = ""
+    i = 0
+    while i < len(repl):
+        c = repl[i]
+        if c == "\\" and i + 1 < len(repl):
+            c = repl[i + 1]
+            i += 2
+            if c.isdigit():
+                result += f"\\g<{c}>"
+            elif c == "n":
+                result += "\n"
+            else:
+                result += c.replace("\\", "\\\\")
+        elif c == "&":
+            result += "\\g<0>"
+            i += 1
+        else:
+            result += c.replace("\\", "\\\\")
+            i += 1
+    return result
+
+
+def split_lines(s: str) -> list[str]:
+    return s.splitlines(keepends=True)
+
+
+def compile_bre(pattern: str) -> re.Pattern:
+    try:
+        return re.compile(bre_to_python(pattern))
+    except re.error as e:
+        raise EvaluationError(f"Invalid regular expression {pattern}: {e}")
+
+
+# sed s/regex/template/: replace the first match on each line
+def sed(regex: re.Pattern, template: str, s: str) -> str:
+    return "".join(
+        regex.sub(template, line.rstrip("\n"), count=1) + ("\n" if line.endswith("\n") else "")
+        for line in split_lines(s)
+    )
+
+
+def grep(regex: re.Pattern, s: str) -> str:
+    return "".join(line for line in split_lines(s) if regex.search(line.rstrip("\n")))
+
+
+@dataclass
+class FieldRange:
+    start: int  # 0-based, inclusive
+    end: Optional[int]  # exclusive, None means up to the last field
+
+
+# A compiled expression; takes the evaluator that provides the sandbox and the variables
+Compiled = Callable[["Evaluator"], Any]
+
+
+@dataclass
+class Language:
+    identify: Compiled  # evaluates to the human-readable compiler name and version
+    base_rule: Compiled  # evaluates to the base name of the submission
+    inputs: list[str]  # patterns of source files, e.g. %.cpp
+    build: Optional[Compiled]  # compiles the submission, None if there is nothing to build
+    run_prerequisites: Compiled  # evaluates to the list of files needed for running
+    run_argv: Compiled  # evaluates to the command that runs the submission
+
+
+class Sandbox:
+    def __init__(self, package: str, run_opts: list[str], directory: str):
+        self.package: str = package
+        self.run_opts: list[str] = run_opts  # options passed to run.sh
+        self.directory: str = directory  # host directory mounted as the working directory
+        self.setup_time: float = 0  # seconds spent setting up sandboxes, summed over all commands
+        self.command_time: float = 0  # seconds spent running the commands themselves
+
+    def exec(self, argv: list[str], input: Optional[str]=None) -> str:
+        if not argv:
+            raise EvaluationError("Empty command")
+        if os.environ.get("SUNWALKER_RUNNER_SOCKET"):
+            return self.exec_via_daemon(argv, input)
+        # run.sh writes the time at which the sandbox was ready to SUNWALKER_TIMING_FD
+        read_fd, write_fd = os.pipe()
+        try:
+            start = time.time()
+            proc = subprocess.run(
+                [
+                    os.path.join(ROOT, "scripts", "run.sh"), *self.run_opts, f"-f{SANDBOX_DIR}={self.directory}",
+                    f"-d{SANDBOX_DIR}", self.package, "--", *argv
+                ],
+                input=None if input is None else input.encode(),
+                stdin=subprocess.DEVNULL if input is None else None,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                env={**os.environ, "SUNWALKER_TIMING_FD": str(write_fd)},
+                pass_fds=[write_fd]
+            )
+            end = time.time()
+            os.close(write_fd)
+            write_fd = -1
+            with os.fdopen(read_fd) as f:
+                read_fd = -1
+                ready = f.read().strip()
+        finally:
+            for fd in (read_fd, write_fd):
+                if fd != -1:
+                    os.close(fd)
+        if ready:
+            ready_time = min(max(float(ready), start), end)
+            self.setup_time += ready_time - start
+            self.command_time += end - ready_time
+        else:
+            self.command_time += end - start
+
+        if proc.returncode != 0:
+            stderr = proc.stderr.decode(errors="replace").strip()
+            raise EvaluationError(f"{' '.join(argv)} exited with code {proc.returncode}" + (f": {stderr}" if stderr else ""))
+        return proc.stdout.decode(errors="replace")
+
+    # Talk to the daemon directly instead of starting run.sh and the daemon client for each command
+    def exec_via_daemon(self, argv: list[str], input: Optional[str]) -> str:
+        request = {
+            "package": self.package, "argv": argv, "files": [f"{SANDBOX_DIR}={os.path.abspath(self.directory)}"],
+            "cwd": SANDBOX_DIR
+        }
+        stdin_r, stdin_w = os.pipe()
+        stdout_r, stdout_w = os.pipe()
+        stderr_r, stderr_w = os.pipe()
+        outputs: dict[int, bytes] = {}
+
+        def write_input():
+            with open(stdin_w, "wb") as f:
+                try:
+                    f.write((input or "").encode())
+                except BrokenPipeError:
+                    pass
+
+        def read_output(fd):
+            with open(fd, "rb") as f:
+                outputs[fd] = f.read()
+
+        threads = [
+            threading.Thread(target=write_input),
+            threading.Thread(target=read_output, args=(stdout_r,)),
+            threading.Thread(target=read_output, args=(stderr_r,)),
+        ]
+        for thread in threads:
+            thread.start()
+        # The ends passed to the command; the threads finish once these are closed everywhere
+        passed_fds = [stdin_r, stdout_w, stderr_w]
+        start = time.time()
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                sock.connect(os.environ["SUNWALKER_RUNNER_SOCKET"])
+                send_request(sock, request, passed_fds)
+                for fd in passed_fds:
+                    os.close(fd)
+                passed_fds = []
+                response = json.loads(sock.makefile("rb").readline() or b"{}")
+        except OSError as e:
+            raise EvaluationError(f"Could not talk to the runner daemon: {e}")
+        finally:
+            for fd in passed_fds:
+                os.close(fd)
+            for thread in threads:
+                thread.join()
+        end = time.time()
+
+        if "started" in response:
+            ready_time = min(max(response["started"], start), end)
+            self.setup_time += ready_time - start
+            self.command_time += end - ready_time
+        else:
+            self.command_time += end - start
+
+        if "error" in response or not response:
+            raise EvaluationError(f"{' '.join(argv)}: {response.get('error', 'no response from the runner daemon')}")
+        if response.get("status", 0) != 0 or "signal" in response:
+            stderr = outputs.get(stderr_r, b"").decode(errors="replace").strip()
+            status = f"was killed by signal {response['signal']}" if "signal" in response else f"exited with code {response['status']}"
+            raise EvaluationError(f"{' '.join(argv)} {status}" + (f": {stderr}" if stderr else ""))
+        return outputs.get(stdout_r, b"").decode(errors="replace")
+
+    # Translate a path inside the sandbox to the host
+    def host_path(self, path: str) -> str:
+        path = os.path.normpath(os.path.join(SANDBOX_DIR, path))
+        if os.path.commonpath([path, SANDBOX_DIR]) != SANDBOX_DIR:
+            raise EvaluationError(f"{path} is outside of the working directory")
+        return os.path.join(self.directory, os.path.relpath(path, SANDBOX_DIR))
+
+
+class Evaluator:
+    def __init__(self, sandbox: Optional[Sandbox]=None, variables: Optional[dict[str, str]]=None):
+        self.sandbox: Optional[Sandbox] = sandbox  # None if commands are not allowed, e.g. when loading the config
+        self.variables: dict[str, str] = variables or {}
+
+
+    # Convenient for one-off expressions; compile the expression once if it's evaluated many times
+    def evaluate(self, expr: Any) -> Any:
+        return compile_expr(expr)(self)
+
+
+    def get_sandbox(self) -> Sandbox:
+        if self.sandbox is None:
+            raise EvaluationError("Commands cannot be run here")
+        return self.sandbox
+
+
+    def builtin_list(self, *items):
+        return list(items)
+
+    def builtin_pair(self, key, value):
+        return (key, value)
+
+    def builtin_map(self, pairs):
+        return dict(pairs or [])
+
+    def builtin_config(self, packages):
+        return packages or {}
+
+    def builtin_package(self, languages):
+        return languages or {}
+
+    def builtin_language(self, identify, base_rule, inputs, build, run):
+        run_prerequisites, run_argv = run
+        return Language(
+            compile_expr(identify), compile_expr(base_rule), inputs, None if build == NIL else compile_expr(build),
+            compile_expr(run_prerequisites), compile_expr(run_argv)
+        )
+
+    def builtin_run(self, prerequisites, argv):
+        # Both are quoted, they are evaluated for each submission
+        return (prerequisites, argv)
+
+    def builtin_var(self, name):
+        if name not in self.variables:
+            raise EvaluationError(f"Variable {name} is not set")
+        return self.variables[name]
+
+    def builtin_concat(self, *items):
+        items = [item for item in items if item is not None]
+        if all(isinstance(item, str) for item in items):
+            return "".join(items)
+        result = []
+        for item in items:
+            result += item if isinstance(item, list) else [item]
+        return result
+
+    def builtin_range(self, start, end):
+        return FieldRange(start, end)
+
+    def builtin_stripnl(self, s):
+        return s.rstrip("\n")
+
+    def builtin_head(self, n, s):
+        return "".join(split_lines(s)[:n])
+
+    def builtin_tail(self, n, s):
+        return "".join(split_lines(s)[-n:] if n > 0 else [])
+
+    # Only used if the pattern is not a literal, see compile_expr
+    def builtin_sed(self, pattern, repl, s):
+        return sed(compile_bre(pattern), sed_replacement_to_python(repl), s)
+
+    def builtin_grep(self, pattern, s):
+        return grep(compile_bre(pattern), s)
+
+    def builtin_cut(self, s, delimiter, fields):
+        if not isinstance(fields, list):
+            fields = [fields]
+        lines = []
+        for line in split_lines(s):
+            newline = "\n" if line.endswith("\n") else ""
+            line = line.rstrip("\n")
+            parts = line.split(delimiter)
+            if len(parts) == 1:
+                # Lines without delimiters are printed as is
+                lines.append(line + newline)
+                continue
+            selected = set()
+            for field in fields:
+                if isinstance(field, FieldRange):
+                    selected.update(range(field.start, len(parts) if field.end is None else min(field.end, len(parts))))
+                elif field < len(parts):
+                    selected.add(field)
+            lines.append(delimiter.join(parts[i] for i in sorted(selected)) + newline)
+        return "".join(lines)
+
+    def builtin_basename(self, path):
+        return os.path.basename(path.rstrip("/")) + "\n"
+
+    def builtin_glob(self, pattern):
+        sandbox = self.get_sandbox()
+        matches = sorted(glob.glob(glob.escape(sandbox.host_path(pattern)).replace("%", "*")))
+        if not matches:
+            # The target does not exist yet
+            return pattern.replace("%", self.variables.get("$base", "*"))
+        paths = [os.path.join(os.path.dirname(pattern), os.path.basename(match)) for match in matches]
+        return paths[0] if len(paths) == 1 else paths
+
+    def builtin_cat(self, path):
+        try:
+            with open(self.get_sandbox().host_path(path), errors="replace") as f:
+                return f.read()
+        except OSError as e:
+            raise EvaluationError(f"cat: {path}: {e.strerror}")
+
+    def builtin_mv(self, from_, to):
+        sandbox = self.get_sandbox()
+        try:
+            os.rename(sandbox.host_path(from_), sandbox.host_path(to))
+        except OSError as e:
+            raise EvaluationError(f"mv: {from_}: {e.strerror}")
+        return ""
+
+    def builtin_exec(self, argv):
+        return self.builtin_exec_with(None, argv)
+
+    def builtin_exec_with(self, input, argv):
+        flat_argv = []
+        for arg in argv or []:
+            flat_argv += arg if isinstance(arg, list) else [arg]
+        return self.get_sandbox().exec([str(arg) for arg in flat_argv], input)
+
+
+def compile_expr(expr: Any) -> Compiled:
+    if isinstance(expr, Symbol):
+        if expr == NIL:
+            return lambda evaluator: None
+        raise EvaluationError(f"Unknown symbol {expr}")
+    if not isinstance(expr, list):
+        return lambda evaluator: expr
+    if not expr or not isinstance(expr[0], Symbol):
+        raise EvaluationError(f"Expected a function call, found {expr}")
+
+    name = expr[0]
+    args = expr[1:]
+
+    if name == "quote":
+        if len(args) != 1:
+            raise EvaluationError(f"quote takes 1 argument, {len(args)} given")
+        value = args[0]
+        return lambda evaluator: value
+
+    # Compile regular expressions once instead of on every evaluation
+    if name == "sed" and len(args) == 3 and all(isinstance(arg, str) for arg in args[:2]):
+        regex = compile_bre(args[0])
+        template = sed_replacement_to_python(args[1])
+        input = compile_expr(args[2])
+        return lambda evaluator: sed(regex, template, input(evaluator))
+    if name == "grep" and len(args) == 2 and isinstance(args[0], str):
+        regex = compile_bre(args[0])
+        input = compile_expr(args[1])
+        return lambda evaluator: grep(regex, input(evaluator))
+
+    function = getattr(Evaluator, "builtin_" + name, None)
+    if function is None:
+        raise EvaluationError(f"Unknown function {name}")
+    parameters = inspect.signature(function).parameters.values()
+    if not any(parameter.kind == parameter.VAR_POSITIONAL for parameter in parameters) and len(args) != len(parameters) - 1:
+        raise EvaluationError(f"{name} takes {len(parameters) - 1} arguments, {len(args)} given")
+
+    compiled_args = [compile_expr(arg) for arg in args]
+    return lambda evaluator: function(evaluator, *[arg(evaluator) for arg in compiled_args])
+
+
+# Parse image.cfg into {package: {language: Language}}
+def load_config(code: str) -> dict[str, dict[str, Language]]:
+    return Evaluator().evaluate(parse(code))
+
+
+def load_config_file(path: str) -> dict[str, dict[str, Language]]:
+    with open(path) as f:
+        return load_config(f.read())
+
+
+# Compile a submission stored in the sandbox directory as <base><extension>. Returns the evaluator to run it with.
+def build_submission(language: Language, sandbox: Sandbox, base: str) -> Evaluator:
+    evaluator = Evaluator(sandbox, {"$base": base})
+    evaluator.variables["$base"] = language.base_rule(evaluator)
+    if language.build is not None:
+        language.build(evaluator)
+    # A run rule that lists files the build does not produce would fail in the judge
+    for path in language.run_prerequisites(evaluator):
+        if not os.path.exists(sandbox.host_path(path)):
+            raise EvaluationError(f"{path} is needed to run the submission, but the build did not produce it")
+    return evaluator
+
+
+def run_submission(language: Language, evaluator: Evaluator, input: Optional[str]=None) -> str:
+    return evaluator.builtin_exec_with(input, language.run_argv(evaluator))
+
+
+# The indexed JSON written by make_config.py --json. Languages are parsed on first use.
+class ConfigIndex:
+    VERSION = 1  # INDEX_VERSION in make_config.py
+
+    def __init__(self, path: str):
+        with open(path) as f:
+            self.index: dict = json.load(f)
+        if self.index.get("version") != self.VERSION:
+            raise EvaluationError(f"{path} has version {self.index.get('version')}, expected {self.VERSION}")
+        self.languages: dict[str, Language] = {}
+
+    def get_language(self, name: str) -> tuple[str, Language]:
+        i = self.index["by_language"].get(name)
+        if i is None:
+            raise EvaluationError(f"Unknown language {name}")
+        entry = self.index["entries"][i]
+        if name not in self.languages:
+            self.languages[name] = Evaluator().builtin_language(
+                parse(entry["identify"]), parse(entry["base_rule"]), entry["inputs"], parse(entry["build"]),
+                Evaluator().evaluate(parse(entry["run"]))
+            )
+        return entry["package"], self.languages[name]
+
+    def find_by_extension(self, extension: str) -> list[str]:
+        return [self.index["entries"][i]["language"] for i in self.index["by_extension"].get(extension, [])]
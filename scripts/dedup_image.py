@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+from __future__ import annotations
+
+import argparse
+from collections import defaultdict
+import hashlib
+import os
+import stat
+
+
+# Many packages contain identical files, e.g. binutils and glibc libraries. mksquashfs already stores duplicate data
+# blocks once, but each copy is still a separate inode, so the kernel caches each of them separately. This script finds
+# files with identical content and metadata in the directory that is about to be packed and tells mksquashfs to store
+# all but one copy as hardlinks: the copies are excluded via -ef, and pseudo-definitions passed via -pf create the links.
+
+
+# Escape a path for use in mksquashfs exclude and pseudo files, where whitespace separates fields
+def escape(path: str) -> str:
+    return "".join("\\" + c if c in " \t\\\"'" else c for c in path)
+
+
+def hash_file(path: str) -> bytes:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(2 ** 20)
+            if not chunk:
+                break
+            h.update(chunk)
+    return h.digest()
+
+
+# Returns groups of paths relative to root, each group listing files with identical content, mode and owner
+def find_duplicates(root: str) -> list[list[str]]:
+    # Only files whose size is not unique can be duplicates, so most files need not be read at all
+    by_size: defaultdict[tuple, list[str]] = defaultdict(list)
+    seen_inodes: set[tuple[int, int]] = set()
+    for dir_path, dir_names, file_names in os.walk(root):
+        dir_names.sort()
+        for file_name in sorted(file_names):
+            path = os.path.join(dir_path, file_name)
+            st = os.lstat(path)
+            if not stat.S_ISREG(st.st_mode) or st.st_size == 0:
+                continue
+            # Files that are already hardlinked are only considered once
+            if (st.st_dev, st.st_ino) in seen_inodes:
+                continue
+            seen_inodes.add((st.st_dev, st.st_ino))
+            by_size[(st.st_size, st.st_mode, st.st_uid, st.st_gid)].append(os.path.relpath(path, root))
+
+    groups: list[list[str]] = []
+    for key, paths in by_size.items():
+        if len(paths) < 2:
+            continue
+        by_hash: defaultdict[bytes, list[str]] = defaultdict(list)
+        for path in paths:
+            by_hash[hash_file(os.path.join(root, path))].append(path)
+        groups += [group for group in by_hash.values() if len(group) > 1]
+
+    return groups
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Find duplicate files across packages and generate mksquashfs options to store them as hardlinks.")
+    parser.add_argument("root", help="directory that will be passed to mksquashfs")
+    parser.add_argument("--exclude-file", required=True, help="where to write the list of files to pass to mksquashfs -ef")
+    parser.add_argument("--pseudo-file", required=True, help="where to write the pseudo-definitions to pass to mksquashfs -pf")
+    args = parser.parse_args()
+
+    groups = find_duplicates(args.root)
+
+    saved_files = 0
+    saved_bytes = 0
+    with open(args.exclude_file, "w") as exclude_file, open(args.pseudo_file, "w") as pseudo_file:
+        for group in sorted(groups):
+            original = group[0]
+            for path in group[1:]:
+                exclude_file.write(escape(path) + "\n")
+                pseudo_file.write(f"{escape(path)} l {escape(original)}\n")
+            saved_files += len(group) - 1
+            saved_bytes += (len(group) - 1) * os.lstat(os.path.join(args.root, original)).st_size
+
+    print(f"Found {saved_files} duplicate files in {len(groups)} groups, {saved_bytes / 2 ** 20:.1f} MiB saved")
+
+
+if __name__ == "__main__":
+    main()
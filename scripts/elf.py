@@ -0,0 +1,257 @@
+from __future__ import annotations
+
+from dataclasses import dataclass, field
+import functools
+import struct
+from typing import Optional
+
+
+# Just enough of the ELF format to find out which interpreter and shared libraries a binary requires, so that we don't
+# have to run ldd in the container for every file
+
+
+class ElfError(Exception):
+    pass
+
+
+ELF_MAGIC = b"\x7fELF"
+
+ELFCLASS32 = 1
+ELFCLASS64 = 2
+
+ELFDATA2LSB = 1
+ELFDATA2MSB = 2
+
+ET_REL = 1
+ET_EXEC = 2
+ET_DYN = 3
+
+EM_X86_64 = 62
+
+PT_LOAD = 1
+PT_DYNAMIC = 2
+PT_INTERP = 3
+
+DT_NULL = 0
+DT_NEEDED = 1
+DT_STRTAB = 5
+DT_STRSZ = 10
+DT_SONAME = 14
+DT_RPATH = 15
+DT_RUNPATH = 29
+
+
+@dataclass
+class ElfFile:
+    elf_class: int  # ELFCLASS32 or ELFCLASS64
+    machine: int  # EM_*
+    type: int  # ET_*
+    interpreter: Optional[str] = None  # PT_INTERP, None for static binaries and most shared libraries
+    needed: list[str] = field(default_factory=list)  # DT_NEEDED entries, in order
+    soname: Optional[str] = None  # DT_SONAME
+    rpath: list[str] = field(default_factory=list)  # DT_RPATH, split by ':', $ORIGIN and alike are not expanded
+    runpath: list[str] = field(default_factory=list)  # DT_RUNPATH, split by ':', $ORIGIN and alike are not expanded
+
+
+def is_elf(data: bytes) -> bool:
+    return data[:4] == ELF_MAGIC
+
+
+def parse_elf(data: bytes) -> ElfFile:
+    if not is_elf(data):
+        raise ElfError("Not an ELF file")
+    if len(data) < 16:
+        raise ElfError("Truncated ELF header")
+
+    elf_class = data[4]
+    if data[5] == ELFDATA2LSB:
+        endian = "<"
+    elif data[5] == ELFDATA2MSB:
+        endian = ">"
+    else:
+        raise ElfError(f"Unknown ELF data encoding {data[5]}")
+
+    if elf_class == ELFCLASS64:
+        header_format = endian + "HHIQQQIHHHHHH"
+        phdr_format = endian + "IIQQQQQQ"
+        dyn_format = endian + "qQ"
+    elif elf_class == ELFCLASS32:
+        header_format = endian + "HHIIIIIHHHHHH"
+        phdr_format = endian + "IIIIIIII"
+        dyn_format = endian + "iI"
+    else:
+        raise ElfError(f"Unknown ELF class {elf_class}")
+
+    try:
+        e_type, e_machine, _, _, e_phoff, _, _, _, e_phentsize, e_phnum, _, _, _ = struct.unpack_from(header_format, data, 16)
+    except struct.error:
+        raise ElfError("Truncated ELF header")
+
+    elf = ElfFile(elf_class, e_machine, e_type)
+
+    # Program headers are what the dynamic linker uses, so we use them too instead of section headers (which may be
+    # stripped)
+    loads: list[tuple[int, int, int]] = []  # (vaddr, offset, filesz)
+    dynamic: Optional[tuple[int, int]] = None  # (offset, filesz)
+    for i in range(e_phnum):
+        try:
+            phdr = struct.unpack_from(phdr_format, data, e_phoff + i * e_phentsize)
+        except struct.error:
+            raise ElfError("Truncated program header table")
+        if elf_class == ELFCLASS64:
+            p_type, _, p_offset, p_vaddr, _, p_filesz, _, _ = phdr
+        else:
+            p_type, p_offset, p_vaddr, _, p_filesz, _, _, _ = phdr
+
+        if p_type == PT_LOAD:
+            loads.append((p_vaddr, p_offset, p_filesz))
+        elif p_type == PT_DYNAMIC:
+            dynamic = (p_offset, p_filesz)
+        elif p_type == PT_INTERP:
+            elf.interpreter = read_string(data, p_offset, p_offset + p_filesz)
+
+    if dynamic is None:
+        return elf
+
+    entries: list[tuple[int, int]] = []
+    strtab_vaddr: Optional[int] = None
+    strtab_size: Optional[int] = None
+    dyn_offset, dyn_size = dynamic
+    dyn_entsize = struct.calcsize(dyn_format)
+    for offset in range(dyn_offset, dyn_offset + dyn_size - dyn_entsize + 1, dyn_entsize):
+        try:
+            d_tag, d_val = struct.unpack_from(dyn_format, data, offset)
+        except struct.error:
+            raise ElfError("Truncated dynamic section")
+        if d_tag == DT_NULL:
+            break
+        if d_tag == DT_STRTAB:
+            strtab_vaddr = d_val
+        elif d_tag == DT_STRSZ:
+            strtab_size = d_val
+        elif d_tag in (DT_NEEDED, DT_SONAME, DT_RPATH, DT_RUNPATH):
+            entries.append((d_tag, d_val))
+
+    if not entries:
+        return elf
+    if strtab_vaddr is None:
+        raise ElfError("Dynamic section has no string table")
+
+    # DT_STRTAB is a virtual address; translate it to a file offset
+    for p_vaddr, p_offset, p_filesz in loads:
+        if p_vaddr <= strtab_vaddr < p_vaddr + p_filesz:
+            strtab_offset = p_offset + strtab_vaddr - p_vaddr
+            break
+    else:
+        raise ElfError("String table is not mapped by any segment")
+    strtab_end = len(data) if strtab_size is None else strtab_offset + strtab_size
+
+    for d_tag, d_val in entries:
+        s = read_string(data, strtab_offset + d_val, strtab_end)
+        if d_tag == DT_NEEDED:
+            elf.needed.append(s)
+        elif d_tag == DT_SONAME:
+            elf.soname = s
+        elif d_tag == DT_RPATH:
+            elf.rpath += [path for path in s.split(":") if path]
+        elif d_tag == DT_RUNPATH:
+            elf.runpath += [path for path in s.split(":") if path]
+
+    return elf
+
+
+def read_string(data: bytes, start: int, end: int) -> str:
+    if start >= len(data):
+        raise ElfError("String points outside of the file")
+    terminator = data.find(b"\x00", start, end)
+    if terminator == -1:
+        terminator = min(end, len(data))
+    return data[start:terminator].decode(errors="surrogateescape")
+
+
+# ld.so.cache, as generated by glibc's ldconfig. Only the new format is supported; files in the old format generated by
+# glibc < 2.32 also contain a new-format cache, so this is fine.
+
+LD_SO_CACHE_MAGIC_NEW = b"glibc-ld.so.cache1.1"
+
+FLAG_TYPE_MASK = 0x00ff
+FLAG_ELF_LIBC6 = 0x0003
+FLAG_REQUIRED_MASK = 0xff00
+FLAG_X8664_LIB64 = 0x0300
+
+CACHE_FLAGS_ENDIAN_LITTLE = 2
+
+
+# Returns a mapping from sonames to paths. If a soname is present several times, the first entry wins, as in ld.so.
+def parse_ld_so_cache(data: bytes, flags: int=FLAG_ELF_LIBC6 | FLAG_X8664_LIB64) -> dict[str, str]:
+    base = data.find(LD_SO_CACHE_MAGIC_NEW)
+    if base == -1:
+        raise ElfError("Unsupported ld.so.cache format")
+
+    try:
+        nlibs, _ = struct.unpack_from("<II", data, base + 20)
+    except struct.error:
+        raise ElfError("Truncated ld.so.cache")
+
+    libraries: dict[str, str] = {}
+    for i in range(nlibs):
+        try:
+            entry_flags, key, value, _, hwcap = struct.unpack_from("<iIIIQ", data, base + 48 + i * 24)
+        except struct.error:
+            raise ElfError("Truncated ld.so.cache")
+        if entry_flags & (FLAG_TYPE_MASK | FLAG_REQUIRED_MASK) != flags or hwcap != 0:
+            continue
+        name = read_string(data, base + key, len(data))
+        if name not in libraries:
+            libraries[name] = read_string(data, base + value, len(data))
+
+    return libraries
+
+
+# The order in which ld.so expects sonames: like strcmp, except that runs of digits are compared as numbers
+def compare_sonames(a: str, b: str) -> int:
+    i = j = 0
+    while i < len(a):
+        if a[i].isdigit():
+            if j >= len(b) or not b[j].isdigit():
+                return 1
+            start = i
+            while i < len(a) and a[i].isdigit():
+                i += 1
+            value_a = int(a[start:i])
+            start = j
+            while j < len(b) and b[j].isdigit():
+                j += 1
+            value_b = int(b[start:j])
+            if value_a != value_b:
+                return value_a - value_b
+        elif j < len(b) and b[j].isdigit():
+            return -1
+        elif j >= len(b) or a[i] != b[j]:
+            return ord(a[i]) - (ord(b[j]) if j < len(b) else 0)
+        else:
+            i += 1
+            j += 1
+    return 0 if j >= len(b) else -ord(b[j])
+
+
+# Generate ld.so.cache in the new format, which glibc has supported for ages and which ldconfig writes by default since
+# glibc 2.32. libraries maps sonames to paths, and all of them must have the given flags.
+def write_ld_so_cache(libraries: dict[str, str], flags: int=FLAG_ELF_LIBC6 | FLAG_X8664_LIB64) -> bytes:
+    # ld.so does a binary search over the entries, which ldconfig sorts in descending order
+    names = sorted(libraries, key=functools.cmp_to_key(compare_sonames), reverse=True)
+
+    strings = bytearray()
+    offsets: dict[str, int] = {}
+    strings_start = 48 + 24 * len(names)
+    for string in [*names, *(libraries[name] for name in names)]:
+        if string not in offsets:
+            offsets[string] = strings_start + len(strings)
+            strings += string.encode(errors="surrogateescape") + b"\x00"
+
+    data = bytearray(LD_SO_CACHE_MAGIC_NEW)
+    data += struct.pack("<IIB3xI12x", len(names), len(strings), CACHE_FLAGS_ENDIAN_LITTLE, 0)
+    for name in names:
+        data += struct.pack("<iIIIQ", flags, offsets[name], offsets[libraries[name]], 0, 0)
+    data += strings
+    return bytes(data)
@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+from __future__ import annotations
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass, field
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from typing import Optional
+
+from benchmark_image import print_table
+from benchmark_languages import Program, find_program_source, get_programs, load_languages, percentile
+from config_eval import EvaluationError, Language, Sandbox, build_submission, run_submission
+
+
+# Runs many compile+run jobs at once, like a judge under load, with increasing concurrency. Reports throughput, latency
+# and how the time of a job splits between sandbox setup, compilation and execution, to show how many parallel jobs a
+# node can take before latency falls off a cliff.
+
+
+ROOT = os.path.realpath(os.path.join(os.path.dirname(__file__), ".."))
+
+DEFAULT_CONCURRENCY = [1, 2, 4, 8, 16, 32]
+
+
+@dataclass
+class JobResult:
+    language: str
+    latency: float = 0  # seconds, whole job
+    build_setup: float = 0  # seconds spent setting up sandboxes for building
+    build: float = 0  # seconds spent in the build commands
+    run_setup: float = 0
+    run: float = 0
+    error: Optional[str] = None
+
+
+@dataclass
+class LevelResult:
+    concurrency: int
+    duration: float = 0  # seconds
+    jobs: list[JobResult] = field(default_factory=list)
+
+    def summary(self) -> dict:
+        succeeded = [job for job in self.jobs if job.error is None]
+        latencies = [job.latency for job in succeeded]
+        summary = {
+            "concurrency": self.concurrency,
+            "jobs": len(self.jobs),
+            "errors": len(self.jobs) - len(succeeded),
+            "throughput": len(succeeded) / self.duration if self.duration else 0,
+        }
+        if succeeded:
+            summary.update({
+                "p50": percentile(latencies, 50),
+                "p95": percentile(latencies, 95),
+                "p99": percentile(latencies, 99),
+                **{
+                    part: sum(getattr(job, part) for job in succeeded) / len(succeeded)
+                    for part in ("build_setup", "build", "run_setup", "run")
+                },
+            })
+        return summary
+
+
+class LoadTest:
+    def __init__(self, mix: list[tuple[str, str, Language, float]], program: Program, run_opts: list[str]):
+        self.mix = mix  # (package, language name, language, weight)
+        self.program: Program = program
+        self.run_opts: list[str] = run_opts
+        self.sources: dict[str, str] = {}  # "<package>/<language>" -> source of the program
+        for package, name, language, _ in mix:
+            extensions = [pattern[1:] for pattern in language.inputs if pattern.startswith("%.")]
+            source = next(filter(None, (find_program_source(package, program.name, extension) for extension in extensions)), None)
+            if source is None:
+                raise EvaluationError(f"{program.name} is not available for {package}/{name}")
+            self.sources[f"{package}/{name}"] = source
+
+
+    def run_job(self, package: str, name: str, language: Language, tmp: str) -> JobResult:
+        result = JobResult(f"{package}/{name}")
+        directory = tempfile.mkdtemp(dir=tmp)
+        source = self.sources[f"{package}/{name}"]
+        shutil.copy(source, os.path.join(directory, self.program.name + os.path.splitext(source)[1]))
+        start = time.monotonic()
+        try:
+            sandbox = Sandbox(package, self.run_opts, directory)
+            evaluator = build_submission(language, sandbox, self.program.name)
+            result.build_setup, result.build = sandbox.setup_time, sandbox.command_time
+
+            sandbox.setup_time = sandbox.command_time = 0
+            output = run_submission(language, evaluator, self.program.input)
+            result.run_setup, result.run = sandbox.setup_time, sandbox.command_time
+            if output.strip() != self.program.expected_output:
+                raise EvaluationError(f"Expected {self.program.expected_output!r}, got {output.strip()[:100]!r}")
+        except EvaluationError as e:
+            result.error = str(e)
+        result.latency = time.monotonic() - start
+        shutil.rmtree(directory)
+        return result
+
+
+    # Keep `concurrency` jobs running for `duration` seconds
+    def run_level(self, concurrency: int, duration: float, seed: int) -> LevelResult:
+        level = LevelResult(concurrency)
+        lock = threading.Lock()
+        rng = random.Random(seed)
+        deadline = time.monotonic() + duration
+
+        def worker(tmp: str) -> None:
+            while time.monotonic() < deadline:
+                with lock:
+                    package, name, language, _ = rng.choices(self.mix, weights=[weight for *_, weight in self.mix])[0]
+                job = self.run_job(package, name, language, tmp)
+                with lock:
+                    level.jobs.append(job)
+
+        with tempfile.TemporaryDirectory(prefix="sunwalker-load-") as tmp:
+            start = time.monotonic()
+            with ThreadPoolExecutor(concurrency) as executor:
+                for future in [executor.submit(worker, tmp) for _ in range(concurrency)]:
+                    future.result()
+            level.duration = time.monotonic() - start
+        return level
+
+
+# Languages are given as <package>/<language>, or just <language> if only one package has a language of that name
+def parse_mix(mix: list[str]) -> list[tuple[str, str, Language, float]]:
+    weights = {}
+    for item in mix:
+        name, _, weight = item.partition("=")
+        weights[name] = float(weight or 1)
+
+    languages: dict[str, list[tuple[str, str, Language]]] = {}  # name and <package>/<name> -> candidates
+    packages_path = os.path.join(ROOT, "packages")
+    for package in sorted(os.listdir(packages_path)):
+        if not os.path.isdir(os.path.join(packages_path, package, "languages")):
+            continue
+        for name, language in load_languages(package).items():
+            for key in (name, f"{package}/{name}"):
+                languages.setdefault(key, []).append((package, name, language))
+
+    result = []
+    seen = set()
+    for key, weight in weights.items():
+        candidates = languages.get(key)
+        if not candidates:
+            raise EvaluationError(f"Unknown language {key}")
+        if len(candidates) > 1:
+            raise EvaluationError(f"Language {key} is defined by several packages, use one of: {' '.join(f'{package}/{name}' for package, name, _ in candidates)}")
+        package, name, language = candidates[0]
+        if (package, name) in seen:
+            raise EvaluationError(f"Language {package}/{name} is given twice")
+        seen.add((package, name))
+        result.append((package, name, language, weight))
+    return result
+
+
+def print_levels(levels: list[LevelResult]) -> None:
+    rows = [["concurrency", "jobs", "errors", "jobs/s", "p50, s", "p95, s", "p99, s", "build setup", "build", "run setup", "run"]]
+    for level in levels:
+        summary = level.summary()
+        row = [str(level.concurrency), str(summary["jobs"]), str(summary["errors"]), f"{summary['throughput']:.2f}"]
+        if "p50" in summary:
+            row += [f"{summary[key]:.3f}" for key in ("p50", "p95", "p99", "build_setup", "build", "run_setup", "run")]
+        else:
+            row += ["-"] * 7
+        rows.append(row)
+    print("Latency of a job and mean time spent in each part of it, s")
+    print_table(rows)
+
+    errors: dict[str, int] = {}
+    for level in levels:
+        for job in level.jobs:
+            if job.error is not None:
+                key = f"{job.language}: {job.error}"
+                errors[key] = errors.get(key, 0) + 1
+    for error, count in sorted(errors.items(), key=lambda item: -item[1]):
+        print(f"{count}x {error}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run many compile+run jobs concurrently and measure how the runner scales.")
+    parser.add_argument("mix", nargs="+", metavar="[PACKAGE/]LANGUAGE[=WEIGHT]", help="languages to submit, with relative frequencies (default weight: 1)")
+    parser.add_argument("-c", "--concurrency", type=int, nargs="+", default=DEFAULT_CONCURRENCY, help=f"numbers of concurrent jobs to try, in order (default: {' '.join(map(str, DEFAULT_CONCURRENCY))})")
+    parser.add_argument("-t", "--duration", type=float, default=30, help="seconds to run each concurrency level for (default: 30)")
+    parser.add_argument("--program", default="hello_world", help="program to submit (default: hello_world)")
+    parser.add_argument("--seed", type=int, default=0, help="seed for choosing languages")
+    parser.add_argument("--dev", action="store_true", help="use the built packages instead of the image")
+    parser.add_argument("--image", help="use this image instead of image.sfs or image/")
+    parser.add_argument("--json", metavar="PATH", help="save the results in JSON")
+    args = parser.parse_args()
+
+    run_opts = []
+    if args.dev:
+        run_opts.append("--dev")
+    if args.image:
+        run_opts += ["--image", os.path.realpath(args.image)]
+
+    programs = {program.name: program for program in get_programs()}
+    if args.program not in programs:
+        print(f"Unknown program {args.program}, expected one of: {' '.join(programs)}", file=sys.stderr)
+        sys.exit(1)
+
+    try:
+        load_test = LoadTest(parse_mix(args.mix), programs[args.program], run_opts)
+    except EvaluationError as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
+
+    levels: list[LevelResult] = []
+    for concurrency in args.concurrency:
+        print(f"Running {concurrency} jobs at once for {args.duration:.0f}s", file=sys.stderr)
+        levels.append(load_test.run_level(concurrency, args.duration, args.seed))
+
+    print_levels(levels)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump([{**level.summary(), "samples": [asdict(job) for job in level.jobs]} for level in levels], f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,20 @@
 #!/usr/bin/env python3
 from __future__ import annotations
 
-import os
+import argparse
 from dataclasses import dataclass
+import hashlib
 import itertools
 import json
+import os
+import re
 import sys
 import tarfile
+import tempfile
+from typing import Optional, Type
+
+from config_eval import EvaluationError, Evaluator, Sandbox, parse
+from test_image import get_package_hash, read_image_hashes
 
 
 class GenerationError(Exception):
@@ -26,6 +34,11 @@ class MakefileParser:
 
 
     def parse(self) -> str:
+        return description_to_lisp(self.parse_description())
+
+
+    # Parse into the parts of a (language ...) form, each as Lisp code, except inputs
+    def parse_description(self) -> dict:
         # Split into rules
         current_rule = ""
         current_rule_code = ""
@@ -56,9 +69,13 @@ class MakefileParser:
         if not self.inputs:
             raise GenerationError("No inputs detected")
 
-        inputs = f"(list {' '.join(json.dumps(input) for input in self.inputs)})"
-        lisp = f"(language (quote {self.identify_lisp}) (quote {self.base_rule_lisp}) {inputs} (quote {build_lisp}) {self.run_lisp})"
-        return lisp
+        return {
+            "identify": self.identify_lisp,
+            "base_rule": self.base_rule_lisp,
+            "inputs": sorted(self.inputs),
+            "build": build_lisp,
+            "run": self.run_lisp,
+        }
 
 
     def parse_rule(self, rule: str, code: str):
@@ -153,6 +170,14 @@ class MakefileParser:
         return statements
 
 
+def description_to_lisp(description: dict) -> str:
+    inputs = f"(list {' '.join(json.dumps(input) for input in description['inputs'])})"
+    return (
+        f"(language (quote {description['identify']}) (quote {description['base_rule']}) {inputs} "
+        f"(quote {description['build']}) {description['run']})"
+    )
+
+
 class Statement:
     def to_lisp(self, input=None) -> str:
         raise NotImplementedError()
@@ -172,7 +197,7 @@ class ExecStatement(Statement):
         if input is None:
             return f"(exec {argv})"
         else:
-            return f"(exec_with {input} {argv}"
+            return f"(exec_with {input} {argv})"
     def substitute_variables(self, vars: dict[str, str]):
         return ExecStatement([token.substitute_variables(vars) for token in self.tokens])
 
@@ -241,7 +266,7 @@ class MetaVariableToken(Token):
 class GlobToken(Token):
     pattern: str
     def __str__(self):
-        return self.pattern.sub("%", "*")
+        return self.pattern.replace("%", "*")
     def to_lisp(self, input=None):
         return f"(glob {json.dumps(self.pattern)})"
     def substitute_variables(self, vars: dict[str, str]):
@@ -272,8 +297,7 @@ class EchoBuiltinCommand(BuiltinCommand):
             for arg in self.argv:
                 if to_concat:
                     to_concat.append(StringToken(" "))
-                else:
-                    to_concat.append(arg)
+                to_concat.append(arg)
             return ConcatToken(to_concat).to_lisp()
     def substitute_variables(self, vars: dict[str, str]):
         return EchoBuiltinCommand([arg.substitute_variables(vars) for arg in self.argv])
@@ -453,6 +477,15 @@ BUILTIN_COMMANDS: dict[str, Type[BuiltinCommand]] = {
 }
 
 
+# Runs of characters that are taken literally: anything but quotes and substitutions, and outside of quotes, whitespace
+# and the terminator of $(...)
+QUOTED_LITERAL_REGEX = re.compile(r'(?:[^"$]|\$(?![(<^@]))+')
+UNQUOTED_LITERAL_REGEXES = {
+    None: re.compile(r'(?:[^\s"$]|\$(?![(<^@]))+'),
+    ")": re.compile(r'(?:[^\s"$)]|\$(?![(<^@]))+'),
+}
+
+
 class StatementParser:
     def __init__(self, code: str):
         self.code: str = code
@@ -466,6 +499,8 @@ class StatementParser:
             self.skip_whitespace()
             if self.try_consume(terminate_on):
                 break
+            if self.pos == len(self.code):
+                raise GenerationError(f"Expected {terminate_on}")
             if self.try_consume("|"):
                 piped_statements.append(self.tokens_to_statement(tokens))
                 tokens = []
@@ -481,12 +516,14 @@ class StatementParser:
     def parse_token(self, terminate_on=None) -> Token:
         atoms = []
 
-        while not self.matches(terminate_on) and not self.code[self.pos].isspace():
+        while self.pos < len(self.code) and not self.matches(terminate_on) and not self.code[self.pos].isspace():
             if self.try_consume("\""):
                 while not self.try_consume("\""):
-                    atoms.append(self.parse_atom())
+                    if self.pos == len(self.code):
+                        raise GenerationError("Unterminated quotation mark")
+                    atoms.append(self.parse_atom(QUOTED_LITERAL_REGEX))
             else:
-                atom = self.parse_atom()
+                atom = self.parse_atom(UNQUOTED_LITERAL_REGEXES[terminate_on])
                 if not isinstance(atom, StringToken):
                     raise GenerationError(f"Complex atoms MUST be wrapped in quotes: {atom}")
                 atoms.append(atom)
@@ -505,7 +542,7 @@ class StatementParser:
             return ConcatToken(new_atoms)
 
 
-    def parse_atom(self) -> Atom:
+    def parse_atom(self, literal_regex: re.Pattern) -> Atom:
         if self.code[self.pos] == "\"":
             raise GenerationError("Unescaped quotation mark in the middle of token")
 
@@ -521,9 +558,10 @@ class StatementParser:
         elif self.try_consume("$@"):
             return MetaVariableToken("$@")
 
-        atom = self.code[self.pos]
-        self.pos += 1
-        return StringToken(atom)
+        # Consume the whole run of literal characters at once
+        match = literal_regex.match(self.code, self.pos)
+        self.pos = match.end()
+        return StringToken(match[0])
 
 
     def skip_whitespace(self):
@@ -553,15 +591,66 @@ class StatementParser:
             return ExecStatement(tokens)
 
 
+# Parsed makefiles are cached, so that only changed languages are parsed again. The cache is invalidated
+# whenever this script changes.
+with open(__file__, "rb") as f:
+    GENERATOR_VERSION = hashlib.sha256(f.read()).hexdigest()
+
+DEFAULT_CACHE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "make_config_cache.json")
+
+# Version of the format written by --json; bump it on incompatible changes
+INDEX_VERSION = 1
+
+
+# Runs the identify rules of languages in the sandbox at generation time, so that the config can carry their results
+# instead of commands that judges would have to run on startup. Results are cached by the fingerprint of the package
+# they were obtained from: the hash bake_image.sh records for the package, or the hash of the built archive in --dev mode.
+class Identifier:
+    def __init__(self, run_opts: list[str], cache: Optional[dict[str, str]]=None):
+        self.run_opts: list[str] = run_opts  # options passed to run.sh
+        self.cache: dict[str, str] = {} if cache is None else cache  # hash of package, fingerprint and rule -> result
+        self.used_keys: set[str] = set()
+        self.n_evaluated: int = 0  # number of rules that were not in the cache
+        self.fingerprints: dict[str, str] = {}  # package -> fingerprint
+        self.image_hashes: dict[str, str] = read_image_hashes(run_opts)
+
+
+    def get_fingerprint(self, package: str) -> str:
+        if package not in self.fingerprints:
+            fingerprint = get_package_hash(package, self.run_opts, self.image_hashes)
+            if fingerprint is None:
+                raise GenerationError(f"{package} is not built" if "--dev" in self.run_opts else f"{package} is not in the image")
+            self.fingerprints[package] = fingerprint
+        return self.fingerprints[package]
+
+
+    def identify(self, package: str, identify: str) -> str:
+        fingerprint = self.get_fingerprint(package)
+        key = hashlib.sha256(f"{package} {fingerprint} {identify}".encode()).hexdigest()
+        self.used_keys.add(key)
+        if key not in self.cache:
+            with tempfile.TemporaryDirectory(prefix="sunwalker-identify-") as tmp:
+                try:
+                    result = Evaluator(Sandbox(package, self.run_opts, tmp)).evaluate(parse(identify))
+                except EvaluationError as e:
+                    raise GenerationError(f"Cannot identify: {e}")
+            self.cache[key] = str(result).strip()
+            self.n_evaluated += 1
+        return self.cache[key]
+
+
 class PackageConfigGenerator:
-    def __init__(self, name: str, path: str):
+    def __init__(self, name: str, path: str, cache: Optional[dict[str, dict]]=None, identifier: Optional[Identifier]=None):
         self.name: str = name  # name of package
         self.path: str = path  # path to package directory
+        self.cache: dict[str, dict] = {} if cache is None else cache  # hash of makefile -> language description
+        self.identifier: Optional[Identifier] = identifier  # embeds the results of identify rules if set
+        self.n_generated: int = 0  # number of languages that were not in the cache
+        self.used_hashes: set[str] = set()
+        self.descriptions: dict[str, dict] = {}  # language -> description, as returned by MakefileParser
 
 
     def generate_config(self) -> str:
-        print("Generating config for", self.name)
-
         """
         tar_path = os.path.join(self.path, self.name + ".tar.gz")
         environment: dict[str, str] = {}
@@ -574,43 +663,162 @@ class PackageConfigGenerator:
 
         languages = []
 
-        for language in os.listdir(os.path.join(self.path, "languages")):
+        for language in sorted(os.listdir(os.path.join(self.path, "languages"))):
             assert language.endswith(".make")
             language = language[:-5]
 
             with open(os.path.join(self.path, "languages", language + ".make")) as f:
                 makefile = f.read()
 
-            try:
-                language_config = MakefileParser(makefile).parse()
-            except GenerationError as e:
-                raise GenerationError(f"Error while parsing makefile at {self.name}/languages/{language}.make")
-
-            languages.append(f"(pair {json.dumps(language)} {language_config})")
+            makefile_hash = hashlib.sha256(makefile.encode()).hexdigest()
+            self.used_hashes.add(makefile_hash)
+            description = self.cache.get(makefile_hash)
+            if description is None:
+                try:
+                    description = MakefileParser(makefile).parse_description()
+                except GenerationError as e:
+                    raise GenerationError(f"Error while parsing makefile at {self.name}/languages/{language}.make: {e}")
+                self.cache[makefile_hash] = description
+                self.n_generated += 1
+            if self.identifier is not None:
+                try:
+                    identity = self.identifier.identify(self.name, description["identify"])
+                except GenerationError as e:
+                    raise GenerationError(f"{self.name}/languages/{language}.make: {e}")
+                # A string literal evaluates to itself, so judges don't need to know it was precomputed
+                description = {
+                    **description,
+                    "identify": json.dumps(identity),
+                    "fingerprint": self.identifier.get_fingerprint(self.name),
+                }
+            self.descriptions[language] = description
+
+            languages.append(f"(pair {json.dumps(language)} {description_to_lisp(description)})")
 
         languages_code = f"(map (list {' '.join(languages)}))" if languages else "nil"
 
         return f"(package {languages_code})"
 
 
+# Returns the cached language descriptions and identify results
+def load_cache(path: str) -> tuple[dict[str, dict], dict[str, str]]:
+    try:
+        with open(path) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return {}, {}
+    if cache.get("version") != GENERATOR_VERSION:
+        return {}, {}
+    return cache["languages"], cache.get("identify", {})
+
+
+def save_cache(path: str, languages: dict[str, dict], identified: dict[str, str]) -> None:
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({"version": GENERATOR_VERSION, "languages": languages, "identify": identified}, f, indent=4, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+# The same languages as in image.cfg, indexed so that a judge can look up a language without parsing the whole config
+def make_index(generators: list[PackageConfigGenerator]) -> dict:
+    entries = []
+    by_package: dict[str, list[int]] = {}
+    by_language: dict[str, int] = {}
+    by_extension: dict[str, list[int]] = {}
+    for generator in generators:
+        by_package[generator.name] = []
+        for language, description in generator.descriptions.items():
+            if language in by_language:
+                other = entries[by_language[language]]["package"]
+                raise GenerationError(f"Language {language} is defined by both {other} and {generator.name}")
+            i = len(entries)
+            extensions = [input[1:] for input in description["inputs"] if input.startswith("%.")]
+            entries.append({"package": generator.name, "language": language, "extensions": extensions, **description})
+            by_package[generator.name].append(i)
+            by_language[language] = i
+            for extension in extensions:
+                by_extension.setdefault(extension, []).append(i)
+    return {
+        "version": INDEX_VERSION,
+        "entries": entries,
+        "by_package": by_package,
+        "by_language": by_language,
+        "by_extension": by_extension,
+    }
+
+
+# Leave the file untouched if nothing has changed, so that its modification time means something
+def write_if_changed(path: str, content: str) -> None:
+    try:
+        with open(path) as f:
+            unchanged = f.read() == content
+    except OSError:
+        unchanged = False
+    if unchanged:
+        print(f"{path} is up to date")
+    else:
+        with open(path, "w") as f:
+            f.write(content)
+
 
 def main():
-    if len(sys.argv) == 1:
-        package_names = os.listdir("packages")
-    else:
-        package_names = sys.argv[1:]
+    parser = argparse.ArgumentParser(description="Generate image.cfg from the languages/*.make files of packages.")
+    parser.add_argument("packages", nargs="*", help="names of packages to include (default: all packages)")
+    parser.add_argument("-o", "--output", default="image.cfg", help="where to write the config (default: image.cfg)")
+    parser.add_argument("--json", metavar="PATH", help="also write the config as indexed JSON, e.g. to image.json")
+    parser.add_argument("--cache", default=DEFAULT_CACHE_PATH, help="where to cache parsed makefiles (default: make_config_cache.json)")
+    parser.add_argument("--no-cache", action="store_true", help="parse all makefiles from scratch")
+    parser.add_argument("--identify", action="store_true", help="run the identify rules now and embed their results in the config")
+    parser.add_argument("--dev", action="store_true", help="with --identify, use the built packages instead of the image")
+    parser.add_argument("--image", help="with --identify, use this image instead of image.sfs or image/")
+    args = parser.parse_args()
+
+    package_names = args.packages or sorted(os.listdir("packages"))
+
+    cache, identified = ({}, {}) if args.no_cache else load_cache(args.cache)
+    used_hashes: set[str] = set()
+
+    identifier = None
+    if args.identify:
+        run_opts = []
+        if args.dev:
+            run_opts.append("--dev")
+        if args.image:
+            run_opts += ["--image", os.path.realpath(args.image)]
+        identifier = Identifier(run_opts, identified)
 
     packages = []
+    generators = []
+    n_languages = 0
+    n_generated = 0
     for package_name in package_names:
-        path = os.path.join("packages", package_name)
-        code = PackageConfigGenerator(package_name, path).generate_config()
+        generator = PackageConfigGenerator(package_name, os.path.join("packages", package_name), cache, identifier)
+        code = generator.generate_config()
         packages.append(f"(pair {json.dumps(package_name)} {code})")
+        generators.append(generator)
+        n_generated += generator.n_generated
+        used_hashes |= generator.used_hashes
+        n_languages += len(generator.descriptions)
+        if generator.n_generated:
+            print("Generated config for", package_name)
 
     packages_code = f"(map (list {' '.join(packages)}))" if packages else "nil"
     config = f"(config {packages_code})"
 
-    with open("image.cfg", "w") as f:
-        f.write(config)
+    if not args.no_cache:
+        if not args.packages:
+            # Drop the makefiles that no longer exist
+            cache = {makefile_hash: description for makefile_hash, description in cache.items() if makefile_hash in used_hashes}
+            if identifier is not None:
+                identified = {key: result for key, result in identified.items() if key in identifier.used_keys}
+        save_cache(args.cache, cache, identified)
+
+    write_if_changed(args.output, config)
+    if args.json:
+        write_if_changed(args.json, json.dumps(make_index(generators), indent=4, sort_keys=True) + "\n")
+    print(f"{n_generated} of {n_languages} languages generated, the rest taken from the cache")
+    if identifier is not None:
+        print(f"{identifier.n_evaluated} of {n_languages} languages identified, the rest taken from the cache")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,329 @@
+#!/usr/bin/env python3
+from __future__ import annotations
+
+import argparse
+import os
+import re
+import shutil
+import stat
+import subprocess
+import sys
+import tempfile
+from typing import Optional
+
+from benchmark_languages import Program, find_program_source, get_programs, load_languages
+from config_eval import EvaluationError, Language, Sandbox, build_submission, run_submission
+from dedup_image import escape
+
+
+# Files a compiler needs are scattered all over the image, so the first compilation after boot seeks all over the disk.
+# This script runs the tests of each package under strace and records which files from the package were opened, in
+# order, to packages/<name>/access.trace. bake_image.sh then asks mksquashfs to put these files first, so that they are
+# stored contiguously.
+
+
+ROOT = os.path.realpath(os.path.join(os.path.dirname(__file__), ".."))
+
+# Syscalls that read files or change the working directory, and the ones that create processes
+TRACED_SYSCALLS = "open,openat,openat2,execve,execveat,chdir,fchdir,clone,clone3,fork,vfork"
+# When files are removed from the package based on the trace, files that are only checked for existence matter too
+TRACED_SYSCALLS_WITH_STAT = TRACED_SYSCALLS + ",stat,lstat,newfstatat,statx,access,faccessat,faccessat2,readlink,readlinkat"
+
+# Paths that are not a part of the package
+IGNORED_PREFIXES = ("/proc/", "/dev/", "/sys/", "/tmp/", "/old-root/")
+
+# Programs from programs/ that make up the corpus of sample submissions when pruning packages. hello_world is left out,
+# since every package has it in its tests.
+CORPUS_PROGRAMS = ("heavy_includes", "io")
+
+# run.sh reads this file right after pivot_root, so whichever process opens it is inside the sandbox from then on
+MARKER_PATH = "/.sunwalker/env"
+
+# "1234 openat(AT_FDCWD, "/etc/ld.so.cache", O_RDONLY|O_CLOEXEC) = 3</etc/ld.so.cache>". The sandbox has its own PID
+# namespace, so clone returns the child's PID in there; with --pidns-translation, strace appends the PID it uses in the
+# line prefixes: "1234 clone(...) = 5 /* 1240 */".
+LINE_REGEX = re.compile(r"^(\d+) +(\w+)\((.*)\) += (-?\d+)(?:<(.*)>| /\* (\d+) \*/)?")
+UNFINISHED_REGEX = re.compile(r"^(\d+) +(.*) <unfinished \.\.\.>$")
+RESUMED_REGEX = re.compile(r"^(\d+) +<\.\.\. \w+ resumed>(.*)$")
+STRING_REGEX = re.compile(r'"((?:[^"\\]|\\.)*)"')
+FD_REGEX = re.compile(r"^(?:\d+|AT_FDCWD)<(.*)>$")
+
+
+def unescape(s: str) -> str:
+    # strace escapes everything but printable ASCII
+    return s.encode().decode("unicode_escape").encode("latin-1").decode(errors="surrogateescape")
+
+
+class TraceParser:
+    def __init__(self):
+        self.in_sandbox: set[int] = set()
+        self.cwd: dict[int, str] = {}
+        self.pending: dict[int, str] = {}
+        # With -f, a new process often makes syscalls before the clone that created it returns in the parent. Paths
+        # accessed by processes whose parent is not known yet are held here until it is.
+        self.unattributed: dict[int, list[str]] = {}
+        self.known: set[int] = set()
+        self.paths: list[str] = []
+        self.seen_paths: set[str] = set()
+
+
+    def feed(self, line: str) -> None:
+        line = line.rstrip("\n")
+
+        # With -f, a syscall may be interrupted by another process's one
+        match = UNFINISHED_REGEX.match(line)
+        if match:
+            self.pending[int(match[1])] = match[2]
+            return
+        match = RESUMED_REGEX.match(line)
+        if match:
+            pid = int(match[1])
+            if pid not in self.pending:
+                return
+            line = f"{pid} {self.pending.pop(pid)}{match[2]}"
+
+        match = LINE_REGEX.match(line)
+        if not match:
+            return
+        pid = int(match[1])
+        syscall, args, result, annotation = match[2], match[3], int(match[4]), match[5]
+        if result < 0:
+            return
+
+        if syscall in ("clone", "clone3", "fork", "vfork"):
+            child = int(match[6]) if match[6] else result
+            self.known.add(child)
+            if pid in self.cwd:
+                self.cwd.setdefault(child, self.cwd[pid])
+            if pid in self.in_sandbox:
+                self.in_sandbox.add(child)
+                for path in self.unattributed.pop(child, []):
+                    self.add_path(path)
+            else:
+                self.unattributed.pop(child, None)
+            return
+
+        if syscall == "fchdir":
+            fd_match = FD_REGEX.match(args)
+            if fd_match:
+                self.cwd[pid] = unescape(fd_match[1])
+            return
+
+        strings = STRING_REGEX.findall(args)
+        if not strings:
+            return
+        path = unescape(strings[0])
+
+        if syscall == "chdir":
+            self.cwd[pid] = self.resolve(pid, path)
+            return
+
+        base = None
+        if syscall in ("openat", "openat2", "execveat"):
+            fd_match = FD_REGEX.match(args.split(",", 1)[0])
+            if fd_match:
+                base = unescape(fd_match[1])
+
+        # The annotation of the returned descriptor is the path with symlinks resolved
+        if annotation is not None and syscall.startswith("open"):
+            path = unescape(annotation)
+        else:
+            path = self.resolve(pid, path, base)
+
+        if path == MARKER_PATH:
+            # Whatever the process did before pivot_root was outside the sandbox
+            self.in_sandbox.add(pid)
+            self.known.add(pid)
+            self.unattributed.pop(pid, None)
+        if pid in self.in_sandbox:
+            self.add_path(path)
+        elif pid not in self.known:
+            self.unattributed.setdefault(pid, []).append(path)
+
+
+    def resolve(self, pid: int, path: str, base: Optional[str]=None) -> str:
+        if not path.startswith("/"):
+            path = os.path.join(base or self.cwd.get(pid, "/"), path)
+        return os.path.normpath(path)
+
+
+    def add_path(self, path: str) -> None:
+        if path.startswith(IGNORED_PREFIXES) or path in self.seen_paths:
+            return
+        self.seen_paths.add(path)
+        self.paths.append(path)
+
+
+# Run a command under strace and return the paths accessed inside sandboxes in order, or None if the command failed
+def trace_command(argv: list[str], syscalls: str=TRACED_SYSCALLS) -> Optional[list[str]]:
+    with tempfile.TemporaryDirectory() as tmp:
+        trace_path = os.path.join(tmp, "strace.log")
+        # The runner daemon sets its sandboxes up in advance, outside of the trace
+        env = {key: value for key, value in os.environ.items() if key != "SUNWALKER_RUNNER_SOCKET"}
+        argv = ["strace", "-f", "-qq", "-y", "--pidns-translation", "-s", "4096", "-e", f"trace={syscalls}", "-o", trace_path, *argv]
+        if subprocess.run(argv, stdout=subprocess.DEVNULL, env=env).returncode != 0:
+            return None
+
+        parser = TraceParser()
+        with open(trace_path, errors="surrogateescape") as f:
+            for line in f:
+                parser.feed(line)
+        return parser.paths
+
+
+# Run the tests of the package under strace and return the accessed paths in order, or None if the tests failed
+def trace_package(package_name: str, run_opts: list[str], syscalls: str=TRACED_SYSCALLS) -> Optional[list[str]]:
+    paths = trace_command([os.path.join(ROOT, "scripts", "test_image.sh"), *run_opts, package_name], syscalls)
+    if paths is None:
+        print(f"Tests of {package_name} failed", file=sys.stderr)
+    return paths
+
+
+# The programs from programs/ that are available in the languages of the package, with their sources
+def get_corpus(package_name: str) -> list[tuple[str, Language, Program, str]]:
+    corpus = []
+    programs = [program for program in get_programs() if program.name in CORPUS_PROGRAMS]
+    for name, language in load_languages(package_name).items():
+        extensions = [pattern[1:] for pattern in language.inputs if pattern.startswith("%.")]
+        for program in programs:
+            source = next(filter(None, (find_program_source(package_name, program.name, extension) for extension in extensions)), None)
+            if source is not None:
+                corpus.append((name, language, program, source))
+    return corpus
+
+
+# Build and run the corpus of the package, checking the outputs. Returns False if anything fails.
+def run_corpus(package_name: str, run_opts: list[str]) -> bool:
+    success = True
+    with tempfile.TemporaryDirectory(prefix="sunwalker-corpus-") as tmp:
+        for name, language, program, source in get_corpus(package_name):
+            directory = os.path.join(tmp, f"{name}-{program.name}")
+            os.mkdir(directory)
+            shutil.copy(source, os.path.join(directory, program.name + os.path.splitext(source)[1]))
+            try:
+                evaluator = build_submission(language, Sandbox(package_name, run_opts, directory), program.name)
+                output = run_submission(language, evaluator, program.input)
+                if output.strip() != program.expected_output:
+                    raise EvaluationError(f"Expected {program.expected_output!r}, got {output.strip()[:100]!r}")
+            except EvaluationError as e:
+                print(f"{package_name}/{name}: {program.name}: {e}", file=sys.stderr)
+                success = False
+    return success
+
+
+# Run the corpus of the package under strace and return the accessed paths in order, or None if it failed
+def trace_corpus(package_name: str, run_opts: list[str], syscalls: str=TRACED_SYSCALLS) -> Optional[list[str]]:
+    paths = trace_command([sys.executable, os.path.abspath(__file__), "--run-corpus", *run_opts, package_name], syscalls)
+    if paths is None:
+        print(f"Sample submissions of {package_name} failed", file=sys.stderr)
+    return paths
+
+
+# Run the tests and the corpus of the package without tracing them. Returns False if anything fails.
+def test_package(package_name: str, run_opts: list[str]) -> bool:
+    argv = [os.path.join(ROOT, "scripts", "test_image.sh"), *run_opts, "--with-samples", package_name]
+    if subprocess.run(argv, stdout=subprocess.DEVNULL).returncode != 0:
+        print(f"Tests of {package_name} failed", file=sys.stderr)
+        return False
+    return run_corpus(package_name, run_opts)
+
+
+# Resolve path inside a package root, following symlinks as if the root were /
+def resolve_in_root(root: str, path: str) -> Optional[str]:
+    parts = [part for part in path.split("/") if part]
+    resolved: list[str] = []
+    for _ in range(256):
+        if not parts:
+            return os.path.join(root, *resolved)
+        part = parts.pop(0)
+        if part == ".":
+            continue
+        if part == "..":
+            if resolved:
+                resolved.pop()
+            continue
+        host_path = os.path.join(root, *resolved, part)
+        try:
+            st = os.lstat(host_path)
+        except OSError:
+            return None
+        if stat.S_ISLNK(st.st_mode):
+            target = os.readlink(host_path)
+            if target.startswith("/"):
+                resolved = []
+            parts = [part for part in target.split("/") if part] + parts
+        else:
+            resolved.append(part)
+    return None
+
+
+# Write a mksquashfs -sort file for the packages mounted in root. Files with higher priority are stored first, so the
+# files are ordered by first access within each package.
+def write_sort_file(root: str, sort_file: str) -> None:
+    lines = []
+    for package_name in sorted(os.listdir(root)):
+        trace_path = os.path.join(ROOT, "packages", package_name, "access.trace")
+        if not os.path.isfile(trace_path):
+            continue
+        with open(trace_path) as f:
+            paths = f.read().splitlines()
+        seen = set()
+        for path in paths:
+            host_path = resolve_in_root(os.path.join(root, package_name), path)
+            if host_path is None or host_path in seen or not os.path.isfile(host_path):
+                continue
+            seen.add(host_path)
+            lines.append(host_path)
+
+    with open(sort_file, "w") as f:
+        for i, path in enumerate(lines):
+            priority = max(32767 - i, 1)
+            f.write(f"{escape(path)} {priority}\n")
+    print(f"Sorting {len(lines)} files")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Record which files the tests of packages access, so that bake_image.sh can store them contiguously.")
+    parser.add_argument("packages", nargs="*", help="names of packages to profile (default: all packages with tests)")
+    parser.add_argument("--image", help="use this image instead of the built packages")
+    parser.add_argument("--archive", help="use this built package instead of the one in packages/ (only with a single package)")
+    parser.add_argument("--run-corpus", action="store_true", help="instead of profiling, build and run the programs from programs/ in the languages of the packages")
+    parser.add_argument("--sort-file", nargs=2, metavar=("ROOT", "SORT_FILE"), help="instead of profiling, write a mksquashfs sort file for the packages mounted in ROOT")
+    args = parser.parse_args()
+
+    if args.sort_file:
+        write_sort_file(*args.sort_file)
+        return
+
+    package_names = args.packages or sorted(
+        name for name in os.listdir(os.path.join(ROOT, "packages"))
+        if os.path.isdir(os.path.join(ROOT, "packages", name, "tests"))
+    )
+    if args.archive:
+        if len(package_names) != 1:
+            print("--archive requires a single package", file=sys.stderr)
+            sys.exit(1)
+        run_opts = ["--archive", os.path.realpath(args.archive)]
+    elif args.image:
+        run_opts = ["--image", args.image]
+    else:
+        run_opts = ["--dev"]
+
+    if args.run_corpus:
+        if not all([run_corpus(package_name, run_opts) for package_name in package_names]):
+            sys.exit(1)
+        return
+
+    for package_name in package_names:
+        print(f"Profiling {package_name}")
+        paths = trace_package(package_name, run_opts)
+        if paths is None:
+            continue
+        with open(os.path.join(ROOT, "packages", package_name, "access.trace"), "w") as f:
+            for path in paths:
+                f.write(path + "\n")
+        print(f"{len(paths)} files accessed")
+
+
+if __name__ == "__main__":
+    main()
@@ -2,6 +2,11 @@
 set -e
 
 
+# Send the command to runner_daemon.py if it's running; it has the sandboxes ready
+if [[ -n "$SUNWALKER_RUNNER_SOCKET" ]] && [[ "$1" != "--unshared" ]]; then
+	exec "$(dirname "$0")/runner_daemon.py" run "$@"
+fi
+
 if [[ "$1" != "--unshared" ]]; then
 	exec unshare -p -f --kill-child -U -r -m "$0" --unshared "$@"
 fi
@@ -11,6 +16,8 @@ shift
 root="$(realpath "$(dirname "$0")/..")"
 
 use_dev=0
+image=""
+archive=""
 files=()
 dir=/
 dir_set=0
@@ -20,6 +27,16 @@ while [[ "$#" -gt 0 ]]; do
 		if [[ "$1" == "--dev" ]]; then
 			use_dev=1
 			shift
+		elif [[ "$1" == "--image" ]]; then
+			shift
+			image="$(realpath "$1")"
+			shift
+		elif [[ "$1" == "--archive" ]]; then
+			# Use this built package instead of looking it up in packages/
+			shift
+			archive="$(realpath "$1")"
+			use_dev=1
+			shift
 		elif [[ "$1" == "-f" ]] || [[ "$1" == "--file" ]]; then
 			shift
 			files+=( "$1" )
@@ -66,6 +83,14 @@ if [[ -z "$pkg" ]]; then
 	exit 1
 fi
 
+if [[ -z "$image" ]]; then
+	if [[ -d "$root/image" ]]; then
+		image="$root/image"
+	else
+		image="$root/image.sfs"
+	fi
+fi
+
 
 if ! [[ -e "$root/tmp" ]]; then
 	mkdir "$root/tmp"
@@ -78,14 +103,32 @@ mkdir "$root/tmp/work"
 mkdir "$root/tmp/root"
 
 if [[ "$use_dev" == "1" ]]; then
-	# Use package tar image
+	# Use package image
 	mkdir "$root/tmp/package"
-	ratarmount "$root/packages/$pkg/$pkg.tar.gz" "$root/tmp/package"
+	if [[ -z "$archive" ]]; then
+		archive="$root/packages/$pkg/$pkg.sfs"
+		if ! [[ -f "$archive" ]]; then
+			archive="$root/packages/$pkg/$pkg.tar.zst"
+		fi
+		if ! [[ -f "$archive" ]]; then
+			archive="$root/packages/$pkg/$pkg.tar.gz"
+		fi
+	fi
+	if [[ "$archive" == *.sfs ]]; then
+		squashfuse "$archive" "$root/tmp/package"
+	else
+		ratarmount "$archive" "$root/tmp/package"
+	fi
 	lowerdir="$root/tmp/package"
+elif [[ -d "$image" ]]; then
+	# Use split squashfs image
+	mkdir "$root/tmp/image"
+	squashfuse "$image/$pkg.sfs" "$root/tmp/image"
+	lowerdir="$root/tmp/image"
 else
 	# Use common squashfs image
 	mkdir "$root/tmp/image"
-	squashfuse "$root/image.sfs" "$root/tmp/image"
+	squashfuse "$image" "$root/tmp/image"
 	lowerdir="$root/tmp/image/$pkg"
 fi
 
@@ -130,7 +173,11 @@ cd "$root/tmp/root"
 pivot_root . old-root
 cd "$dir"
 
-export LD_LIBRARY_PATH=/usr/local/lib64:/usr/local/lib:/usr/lib64:/usr/lib:/lib64:/lib
+# Packages built with a generated ld.so.cache don't need the library search path, which costs a failed open per
+# directory per library in every process
+if [[ ! -e /.sunwalker/ld-cache ]]; then
+	export LD_LIBRARY_PATH=/usr/local/lib64:/usr/local/lib:/usr/lib64:/usr/lib:/lib64:/lib
+fi
 export LANGUAGE=en_US
 export LC_ALL=en_US.UTF-8
 export LC_ADDRESS=en_US.UTF-8
@@ -148,4 +195,11 @@ while read -r line; do
 	export "$line"
 done </.sunwalker/env
 
+# Tell whoever is measuring when the sandbox was ready, to separate setup time from the time of the command itself
+if [[ -n "$SUNWALKER_TIMING_FD" ]]; then
+	echo "$EPOCHREALTIME" >&"$SUNWALKER_TIMING_FD"
+	exec {SUNWALKER_TIMING_FD}>&-
+	unset SUNWALKER_TIMING_FD
+fi
+
 exec "$@"
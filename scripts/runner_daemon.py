@@ -0,0 +1,447 @@
+#!/usr/bin/env python3
+from __future__ import annotations
+
+import argparse
+import array
+import ctypes
+import json
+import os
+import queue
+import shutil
+import signal
+import socket
+import socketserver
+import struct
+import subprocess
+import sys
+import threading
+import time
+from typing import Optional
+
+
+# run.sh sets up a sandbox from scratch for each command: it mounts the image via FUSE, creates an overlay, bind-mounts
+# devices and so on, which takes much longer than e.g. `gcc -v` itself. This daemon mounts the image once and keeps a
+# pool of ready overlay roots for each package. Commands are sent over a Unix socket; each one gets a root from the
+# pool, and the root is reset and returned to the pool in background once the command exits. Like in run.sh, each command
+# runs in its own PID namespace, so it can neither see nor signal other commands, and nothing it starts outlives it.
+#
+# Protocol: the client sends a 4-byte big-endian length followed by a JSON request, with its stdin, stdout and stderr
+# attached as SCM_RIGHTS to the first message:
+#   {"package": "gcc", "argv": ["gcc", "-v"], "files": ["/dest=/source", "/path"], "cwd": "/"}
+# `files` have the same meaning as -f in run.sh. The daemon replies with a single line of JSON once the command exits:
+#   {"status": 0}, {"signal": 9} or {"error": "..."}
+# Successful responses also contain "started", the time at which the command was started.
+
+
+ROOT = os.path.realpath(os.path.join(os.path.dirname(__file__), ".."))
+
+DEFAULT_SOCKET = os.path.join(ROOT, "runner.sock")
+
+# Keep in sync with run.sh
+DEV_FILES = ["null", "full", "zero", "urandom", "random", "stdin", "stdout", "stderr", "shm", "mqueue", "ptmx", "pts", "fd"]
+DEFAULT_ENV = {
+    "LD_LIBRARY_PATH": "/usr/local/lib64:/usr/local/lib:/usr/lib64:/usr/lib:/lib64:/lib",
+    "LANGUAGE": "en_US",
+    **{
+        name: "en_US.UTF-8"
+        for name in (
+            "LC_ALL", "LC_ADDRESS", "LC_NAME", "LC_MONETARY", "LC_PAPER", "LC_IDENTIFIER", "LC_TELEPHONE",
+            "LC_MEASUREMENT", "LC_TIME", "LC_NUMERIC", "LANG"
+        )
+    },
+}
+
+# Seconds to wait for a root from the pool before preparing a new one
+POOL_TIMEOUT = 5
+
+MS_BIND = 4096
+MS_REC = 16384
+MNT_DETACH = 2
+
+libc = ctypes.CDLL(None, use_errno=True)
+
+
+class RunnerError(Exception):
+    pass
+
+
+def mount(source: str, target: str, fstype: Optional[str]=None, flags: int=0, data: Optional[str]=None) -> None:
+    if libc.mount(source.encode(), target.encode(), fstype.encode() if fstype else None, flags, data.encode() if data else None) != 0:
+        errno = ctypes.get_errno()
+        raise RunnerError(f"Could not mount {source} to {target}: {os.strerror(errno)}")
+
+
+def umount(target: str) -> None:
+    if libc.umount2(target.encode(), MNT_DETACH) != 0:
+        errno = ctypes.get_errno()
+        raise RunnerError(f"Could not unmount {target}: {os.strerror(errno)}")
+
+
+# Bind-mount a file or a directory from the host into a root, or copy it if it's a symlink, like run.sh does
+def bind(source: str, dest: str) -> None:
+    if not os.path.lexists(source):
+        raise RunnerError(f"{source} does not exist")
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    if os.path.islink(source):
+        os.symlink(os.readlink(source), dest)
+    elif os.path.isdir(source):
+        os.makedirs(dest, exist_ok=True)
+        mount(source, dest, flags=MS_BIND | MS_REC)
+    else:
+        open(dest, "a").close()
+        mount(source, dest, flags=MS_BIND)
+
+
+# An overlay root for a single command
+class Root:
+    def __init__(self, package: Package, path: str):
+        self.package: Package = package
+        self.path: str = path  # directory containing upper, work and root
+        self.root: str = os.path.join(path, "root")  # the root the command is run in
+
+
+    def prepare(self) -> None:
+        for name in ("upper", "work", "root"):
+            os.makedirs(os.path.join(self.path, name), exist_ok=True)
+        upper = os.path.join(self.path, "upper")
+        work = os.path.join(self.path, "work")
+        mount("overlay", self.root, "overlay", data=f"lowerdir={self.package.lowerdir},upperdir={upper},workdir={work}")
+
+        for name in DEV_FILES:
+            if os.path.lexists(f"/dev/{name}"):
+                bind(f"/dev/{name}", os.path.join(self.root, "dev", name))
+
+        # /proc of the PID namespace of the command is mounted when the command is started
+        os.makedirs(os.path.join(self.root, "proc"), exist_ok=True)
+        os.makedirs(os.path.join(self.root, "tmp"), exist_ok=True)
+        mount("tmpfs", os.path.join(self.root, "tmp"), "tmpfs")
+
+
+    # Drop everything the previous command has written
+    def reset(self) -> None:
+        umount(self.root)
+        for name in ("upper", "work"):
+            shutil.rmtree(os.path.join(self.path, name))
+        self.prepare()
+
+
+class Package:
+    def __init__(self, name: str, lowerdir: str, path: str, pool_size: int):
+        self.name: str = name
+        self.lowerdir: str = lowerdir  # the mounted package
+        self.path: str = path  # directory containing the roots
+        self.env: dict[str, str] = dict(DEFAULT_ENV)
+        if os.path.exists(os.path.join(lowerdir, ".sunwalker", "ld-cache")):
+            del self.env["LD_LIBRARY_PATH"]
+        with open(os.path.join(lowerdir, ".sunwalker", "env")) as f:
+            for line in f:
+                line = line.rstrip("\n")
+                if line:
+                    key, _, value = line.partition("=")
+                    self.env[key] = value
+
+        self.pool: queue.Queue[Root] = queue.Queue()  # ready roots
+        self.n_roots: int = 0  # number of roots created, including the ones that were dropped from the pool
+        self.lock = threading.Lock()  # guards n_roots
+        for _ in range(pool_size):
+            self.pool.put(self.create_root())
+
+
+    def create_root(self) -> Root:
+        with self.lock:
+            root = Root(self, os.path.join(self.path, str(self.n_roots)))
+            self.n_roots += 1
+        root.prepare()
+        return root
+
+
+    # Take a ready root from the pool. If none gets ready in time, e.g. because all roots are busy or have failed to
+    # reset, a new one is prepared, so that a broken pool makes commands slower instead of hanging them.
+    def acquire(self) -> Root:
+        try:
+            return self.pool.get(timeout=POOL_TIMEOUT)
+        except queue.Empty:
+            print(f"No ready root of {self.name}, preparing a new one", file=sys.stderr)
+            return self.create_root()
+
+
+    def release(self, root: Root) -> None:
+        def reset():
+            try:
+                root.reset()
+            except (OSError, RunnerError) as e:
+                print(f"Could not reset a root of {self.name}, removing it from the pool:", e, file=sys.stderr)
+                return
+            self.pool.put(root)
+        threading.Thread(target=reset, daemon=True).start()
+
+
+class Daemon:
+    def __init__(self, image: str, use_dev: bool, pool_size: int):
+        self.image: str = image  # image.sfs, or a directory of split images
+        self.use_dev: bool = use_dev  # whether to use packages/*/<name>.{sfs,tar.zst} instead of the image
+        self.pool_size: int = pool_size  # number of ready roots per package
+
+        self.tmp: str = os.path.join(ROOT, "tmp")
+        self.packages: dict[str, Package] = {}
+        self.lock = threading.Lock()  # guards packages
+        self.image_mountpoint: Optional[str] = None
+        # Looked up on the host, while the PATH commands are run with is the one of the package
+        self.unshare: str = shutil.which("unshare") or "/usr/bin/unshare"
+
+
+    # Mount the package and prepare its roots on first use
+    def get_package(self, name: str) -> Package:
+        with self.lock:
+            if name not in self.packages:
+                if "/" in name or name.startswith("."):
+                    raise RunnerError(f"Invalid package name {name}")
+                print(f"Preparing {name}", file=sys.stderr)
+                lowerdir = self.mount_package(name)
+                self.packages[name] = Package(name, lowerdir, os.path.join(self.tmp, "roots", name), self.pool_size)
+            return self.packages[name]
+
+
+    def mount_package(self, name: str) -> str:
+        mountpoint = os.path.join(self.tmp, "packages", name)
+        if self.use_dev:
+            package_path = os.path.join(ROOT, "packages", name)
+            for file_name, argv in ((f"{name}.sfs", ["squashfuse"]), (f"{name}.tar.zst", ["ratarmount"]), (f"{name}.tar.gz", ["ratarmount"])):
+                source = os.path.join(package_path, file_name)
+                if os.path.isfile(source):
+                    break
+            else:
+                raise RunnerError(f"Package {name} is not built")
+        elif os.path.isdir(self.image):
+            source = os.path.join(self.image, f"{name}.sfs")
+            argv = ["squashfuse"]
+            if not os.path.isfile(source):
+                raise RunnerError(f"Package {name} is not in the image")
+        else:
+            if self.image_mountpoint is None:
+                self.image_mountpoint = os.path.join(self.tmp, "image")
+                os.makedirs(self.image_mountpoint)
+                if subprocess.run(["squashfuse", self.image, self.image_mountpoint]).returncode != 0:
+                    self.image_mountpoint = None
+                    raise RunnerError(f"Could not mount {self.image}")
+            lowerdir = os.path.join(self.image_mountpoint, name)
+            if not os.path.isdir(lowerdir):
+                raise RunnerError(f"Package {name} is not in the image")
+            return lowerdir
+
+        os.makedirs(mountpoint)
+        if subprocess.run(argv + [source, mountpoint], stdout=subprocess.DEVNULL).returncode != 0:
+            raise RunnerError(f"Could not mount {source}")
+        return mountpoint
+
+
+    def run(self, request: dict, fds: list[int]) -> dict:
+        package = self.get_package(request["package"])
+        try:
+            root = package.acquire()
+        except (OSError, RunnerError) as e:
+            return {"error": str(e)}
+        try:
+            for file in request.get("files", []):
+                dest, _, source = file.partition("=")
+                bind(source or dest, root.root + os.path.normpath("/" + dest))
+
+            # unshare mounts /proc of the new PID namespace after entering the root. The command is the init process
+            # of the namespace, so the kernel kills whatever it leaves behind once it exits, even processes that have
+            # called setsid.
+            argv = [
+                self.unshare, "--pid", "--fork", "--kill-child", "--mount-proc=/proc", f"--root={root.root}",
+                f"--wd={request.get('cwd', '/')}", "--", *request["argv"]
+            ]
+            proc = subprocess.Popen(
+                argv, stdin=fds[0], stdout=fds[1], stderr=fds[2], env=package.env, start_new_session=True
+            )
+            started = time.time()
+            returncode = proc.wait()
+            kill_session(proc.pid)
+        except (OSError, RunnerError) as e:
+            return {"error": str(e)}
+        finally:
+            package.release(root)
+
+        if returncode < 0:
+            return {"signal": -returncode, "started": started}
+        return {"status": returncode, "started": started}
+
+
+    def serve(self, socket_path: str, package_names: list[str]) -> None:
+        os.makedirs(self.tmp, exist_ok=True)
+        mount("tmpfs", self.tmp, "tmpfs")
+        for name in package_names:
+            self.get_package(name)
+
+        daemon = self
+
+        class Handler(socketserver.BaseRequestHandler):
+            def handle(self):
+                fds: list[int] = []
+                try:
+                    request, fds = receive_request(self.request)
+                    if len(fds) != 3:
+                        raise RunnerError("Expected 3 file descriptors")
+                    response = daemon.run(request, fds)
+                except (KeyError, ValueError, RunnerError) as e:
+                    response = {"error": str(e)}
+                finally:
+                    for fd in fds:
+                        os.close(fd)
+                self.request.sendall(json.dumps(response).encode() + b"\n")
+
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        with socketserver.ThreadingUnixStreamServer(socket_path, Handler) as server:
+            server.daemon_threads = True
+            print(f"Listening on {socket_path}", file=sys.stderr)
+            server.serve_forever()
+
+
+# Kill whatever is left of the session of unshare, in case it was interrupted. The daemon is the init process of its PID
+# namespace, so the orphaned processes become its children and have to be reaped.
+def kill_session(pgid: int) -> None:
+    try:
+        os.killpg(pgid, signal.SIGKILL)
+    except ProcessLookupError:
+        return
+    while True:
+        try:
+            os.waitpid(-pgid, 0)
+        except ChildProcessError:
+            return
+
+
+def receive_request(sock: socket.socket) -> tuple[dict, list[int]]:
+    fds = array.array("i")
+    data, ancdata, _, _ = sock.recvmsg(4096, socket.CMSG_LEN(3 * fds.itemsize))
+    for level, type, cmsg_data in ancdata:
+        if level == socket.SOL_SOCKET and type == socket.SCM_RIGHTS:
+            fds.frombytes(cmsg_data[:len(cmsg_data) - len(cmsg_data) % fds.itemsize])
+    if len(data) < 4:
+        raise RunnerError("Truncated request")
+    length, = struct.unpack(">I", data[:4])
+    data = data[4:]
+    while len(data) < length:
+        chunk = sock.recv(length - len(data))
+        if not chunk:
+            raise RunnerError("Truncated request")
+        data += chunk
+    return json.loads(data), list(fds)
+
+
+# fds are the stdin, stdout and stderr of the command
+def send_request(sock: socket.socket, request: dict, fds: list[int]=[0, 1, 2]) -> None:
+    data = json.dumps(request).encode()
+    data = struct.pack(">I", len(data)) + data
+    sent = sock.sendmsg([data], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array("i", fds))])
+    sock.sendall(data[sent:])
+
+
+# Run a command via the daemon, accepting the same arguments as run.sh
+def run_client(socket_path: str, argv: list[str]) -> int:
+    files = []
+    cwd = "/"
+    package = None
+    i = 0
+    while i < len(argv):
+        arg = argv[i]
+        if arg == "--":
+            i += 1
+            break
+        elif arg in ("-f", "--file"):
+            files.append(argv[i + 1])
+            i += 2
+        elif arg.startswith("-f"):
+            files.append(arg[2:])
+            i += 1
+        elif arg in ("-d", "--chdir"):
+            cwd = argv[i + 1]
+            i += 2
+        elif arg.startswith("-d"):
+            cwd = arg[2:]
+            i += 1
+        elif arg == "--image":
+            # The image is chosen when the daemon is started
+            i += 2
+        elif arg == "--dev":
+            i += 1
+        elif arg == "--archive":
+            print("--archive is not supported by the runner daemon", file=sys.stderr)
+            return 1
+        elif arg.startswith("-"):
+            print(f"Unknown option {arg}", file=sys.stderr)
+            return 1
+        elif package is None:
+            package = arg
+            i += 1
+        else:
+            break
+    if package is None:
+        print("Expected package name as the first unnamed argument", file=sys.stderr)
+        return 1
+
+    # Sources are resolved on the client side, the daemon may have a different working directory
+    def absolute(file: str) -> str:
+        dest, sep, source = file.partition("=")
+        if not sep:
+            source = dest
+        return f"{dest}={os.path.abspath(source)}"
+
+    request = {"package": package, "argv": argv[i:], "files": [absolute(file) for file in files], "cwd": cwd}
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(socket_path)
+        except OSError as e:
+            print(f"Could not connect to the runner daemon at {socket_path}: {e.strerror}", file=sys.stderr)
+            return 1
+        send_request(sock, request)
+        response = json.loads(sock.makefile("rb").readline())
+
+    if "error" in response:
+        print(response["error"], file=sys.stderr)
+        return 1
+    # Same as in run.sh
+    timing_fd = os.environ.get("SUNWALKER_TIMING_FD")
+    if timing_fd:
+        with os.fdopen(int(timing_fd), "w") as f:
+            f.write(f"{response['started']}\n")
+    if "signal" in response:
+        return 128 + response["signal"]
+    return response["status"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run commands in packages without setting up a sandbox for each command.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    serve_parser = subparsers.add_parser("serve", help="start the daemon")
+    serve_parser.add_argument("packages", nargs="*", help="packages to prepare roots for on start (default: on first use)")
+    serve_parser.add_argument("--socket", default=DEFAULT_SOCKET, help="path to the socket (default: runner.sock)")
+    serve_parser.add_argument("--dev", action="store_true", help="use the built packages instead of the image")
+    serve_parser.add_argument("--image", help="path to the image (default: image/ if it exists, else image.sfs)")
+    serve_parser.add_argument("--pool-size", type=int, default=4, help="number of ready roots per package (default: 4)")
+    serve_parser.add_argument("--unshared", action="store_true", help=argparse.SUPPRESS)
+
+    subparsers.add_parser("run", help="run a command via the daemon listening on $SUNWALKER_RUNNER_SOCKET (default: runner.sock); accepts the arguments of run.sh")
+
+    # The arguments of run are those of run.sh, which argparse can't handle
+    if sys.argv[1:2] == ["run"]:
+        sys.exit(run_client(os.environ.get("SUNWALKER_RUNNER_SOCKET", DEFAULT_SOCKET), sys.argv[2:]))
+
+    args = parser.parse_args()
+
+    if not args.unshared:
+        # Mounting requires a user namespace and mounting /proc requires a PID namespace, like in run.sh
+        os.execvp("unshare", ["unshare", "-U", "-r", "-m", "-p", "-f", "--kill-child", sys.executable, os.path.abspath(__file__), *sys.argv[1:], "--unshared"])
+
+    image = args.image
+    if image is None:
+        image = os.path.join(ROOT, "image") if os.path.isdir(os.path.join(ROOT, "image")) else os.path.join(ROOT, "image.sfs")
+    Daemon(os.path.realpath(image), args.dev, args.pool_size).serve(os.path.abspath(args.socket), args.packages)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+from __future__ import annotations
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass
+import fnmatch
+import hashlib
+import json
+import os
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from typing import Optional
+from xml.etree import ElementTree
+
+
+# Runs the tests of the packages in parallel. Each test runs in a copy of its tests/ directory, so that tests don't
+# trip over each other's artifacts. A test that passed is skipped until the package or the tests change.
+
+
+ROOT = os.path.realpath(os.path.join(os.path.dirname(__file__), ".."))
+
+DEFAULT_STATE_PATH = os.path.join(ROOT, "test_state.json")
+
+# The `run` function the tests use, exported the way bash exports functions. Same as in test_image.sh: the options of
+# run.sh are read from a file that declares them as an array, so that paths with spaces survive.
+RUN_FUNCTION = '() {  source "$SUNWALKER_RUN_OPTS_FILE";\n "$SUNWALKER_ROOT/scripts/run.sh" "${opts[@]}" "$SUNWALKER_PACKAGE" "$@"\n}'
+
+
+# bake_image.sh stores the hashes of the packages in the image next to it
+def read_image_hashes(run_opts: list[str]) -> dict[str, str]:
+    if "--dev" in run_opts:
+        return {}
+    if "--image" in run_opts:
+        image = run_opts[run_opts.index("--image") + 1]
+    elif os.path.isdir(os.path.join(ROOT, "image")):
+        image = os.path.join(ROOT, "image")
+    else:
+        image = os.path.join(ROOT, "image.sfs")
+    sources = os.path.join(image, ".sources") if os.path.isdir(image) else image + ".sources"
+    hashes = {}
+    if os.path.exists(sources):
+        with open(sources) as f:
+            for line in f:
+                name, _, package_hash = line.rstrip("\n").partition(" ")
+                hashes[name] = package_hash
+    return hashes
+
+
+# Identify the version of the package commands would run against, given the hashes from read_image_hashes; None if the
+# package is not built or not in the image. Hashing a whole package is slow, so in --dev mode the archive is identified
+# by its size and modification time.
+def get_package_hash(package: str, run_opts: list[str], image_hashes: dict[str, str]) -> Optional[str]:
+    if "--dev" not in run_opts:
+        return image_hashes.get(package)
+    package_path = os.path.join(ROOT, "packages", package)
+    for extension in (".sfs", ".tar.zst", ".tar.gz"):
+        path = os.path.join(package_path, package + extension)
+        if os.path.exists(path):
+            st = os.stat(path)
+            return f"{path} {st.st_size} {st.st_mtime_ns}"
+    return None
+
+
+# Patterns from the .gitignore file of a directory, which lists the artifacts tests leave behind. Only the simple
+# patterns the packages use are supported: they are matched against the names of the directory's own entries.
+def read_gitignore(directory: str) -> list[str]:
+    path = os.path.join(directory, ".gitignore")
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return [line.strip().strip("/") for line in f if line.strip() and not line.startswith("#")]
+
+
+def is_ignored(name: str, patterns: list[str]) -> bool:
+    return any(fnmatch.fnmatch(name, pattern) for pattern in patterns)
+
+
+@dataclass
+class TestResult:
+    package: str
+    test: str
+    status: str  # "passed", "failed" or "skipped"
+    time: float = 0  # seconds
+    output: str = ""
+
+
+@dataclass
+class Test:
+    package: str
+    name: str
+    directory: str  # tests/ or samples/ directory of the package
+    key: str  # hash of everything the result depends on
+
+
+class TestRunner:
+    def __init__(self, run_opts: list[str], state_path: str, force: bool):
+        self.run_opts: list[str] = run_opts  # options passed to run.sh
+        self.state_path: str = state_path
+        self.force: bool = force  # whether to run tests that passed before
+
+        self.state: dict[str, str] = {}  # "<package>/<test>" -> key of the last pass
+        if not force and os.path.exists(state_path):
+            with open(state_path) as f:
+                self.state = json.load(f)
+        self.lock = threading.Lock()  # guards state and output
+        self.package_hashes: dict[str, str] = read_image_hashes(run_opts)
+
+
+    def collect(self, package: str, with_samples: bool) -> list[Test]:
+        package_hash = get_package_hash(package, self.run_opts, self.package_hashes)
+        tests = []
+        directories = ["tests", "samples"] if with_samples else ["tests"]
+        for directory in directories:
+            directory_path = os.path.join(ROOT, "packages", package, directory)
+            if not os.path.isdir(directory_path):
+                continue
+
+            # Tests share artifacts, so each test depends on the whole directory, except for what the tests leave behind
+            h = hashlib.sha256()
+            h.update(f"{package_hash} {' '.join(self.run_opts)}\n".encode())
+            ignored = read_gitignore(directory_path)
+            for file_name in sorted(os.listdir(directory_path)):
+                path = os.path.join(directory_path, file_name)
+                if not os.path.isfile(path) or is_ignored(file_name, ignored):
+                    continue
+                with open(path, "rb") as f:
+                    content = f.read()
+                h.update(f"{file_name} {len(content)}\n".encode())
+                h.update(content)
+
+            for file_name in sorted(os.listdir(directory_path)):
+                if file_name.endswith(".sh"):
+                    test_h = h.copy()
+                    test_h.update(file_name.encode())
+                    # Without a package hash, there is no way to know if the package has changed
+                    key = test_h.hexdigest() if package_hash is not None else ""
+                    tests.append(Test(package, f"{directory}/{file_name}", directory_path, key))
+        return tests
+
+
+    def run(self, test: Test) -> TestResult:
+        state_key = f"{test.package}/{test.name}"
+        if test.key and self.state.get(state_key) == test.key:
+            return TestResult(test.package, test.name, "skipped")
+
+        env = dict(os.environ)
+        env["SUNWALKER_ROOT"] = ROOT
+        env["SUNWALKER_PACKAGE"] = test.package
+        env["BASH_FUNC_run%%"] = RUN_FUNCTION
+
+        with tempfile.TemporaryDirectory(prefix=f"sunwalker-{test.package}-") as tmp:
+            env["SUNWALKER_RUN_OPTS_FILE"] = os.path.join(tmp, "run_opts")
+            with open(env["SUNWALKER_RUN_OPTS_FILE"], "w") as f:
+                f.write(f"declare -a opts=({' '.join(shlex.quote(opt) for opt in self.run_opts)})\n")
+            work_dir = os.path.join(tmp, "tests")
+            shutil.copytree(test.directory, work_dir, symlinks=True)
+            start = time.monotonic()
+            proc = subprocess.run(
+                [os.path.join(work_dir, os.path.basename(test.name))], cwd=work_dir, env=env,
+                stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.STDOUT
+            )
+            duration = time.monotonic() - start
+
+        output = proc.stdout.decode(errors="replace")
+        if proc.returncode == 0:
+            with self.lock:
+                if test.key:
+                    self.state[state_key] = test.key
+                    self.save_state()
+            return TestResult(test.package, test.name, "passed", duration, output)
+        else:
+            with self.lock:
+                self.state.pop(state_key, None)
+                self.save_state()
+            return TestResult(test.package, test.name, "failed", duration, output)
+
+
+    def save_state(self) -> None:
+        tmp_path = self.state_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.state, f, indent=4, sort_keys=True)
+        os.replace(tmp_path, self.state_path)
+
+
+def write_junit(path: str, results: list[TestResult]) -> None:
+    suites = ElementTree.Element("testsuites")
+    by_package: dict[str, list[TestResult]] = {}
+    for result in results:
+        by_package.setdefault(result.package, []).append(result)
+    for package, package_results in by_package.items():
+        suite = ElementTree.SubElement(
+            suites, "testsuite", name=package, tests=str(len(package_results)),
+            failures=str(sum(result.status == "failed" for result in package_results)),
+            skipped=str(sum(result.status == "skipped" for result in package_results)),
+            time=f"{sum(result.time for result in package_results):.3f}"
+        )
+        for result in package_results:
+            case = ElementTree.SubElement(suite, "testcase", classname=package, name=result.test, time=f"{result.time:.3f}")
+            if result.status == "failed":
+                ElementTree.SubElement(case, "failure", message="Test failed").text = result.output
+            elif result.status == "skipped":
+                ElementTree.SubElement(case, "skipped", message="Unchanged since the last pass")
+            elif result.output:
+                ElementTree.SubElement(case, "system-out").text = result.output
+    ElementTree.ElementTree(suites).write(path, encoding="utf-8", xml_declaration=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the tests of sunwalker packages in parallel.")
+    parser.add_argument("packages", nargs="*", help="names of packages to test (default: all packages)")
+    parser.add_argument("-j", "--jobs", type=int, default=0, help="number of tests to run in parallel, 0 means one per CPU (default: 0)")
+    parser.add_argument("--dev", action="store_true", help="test the built packages instead of the image")
+    parser.add_argument("--image", help="test this image instead of image.sfs or image/")
+    parser.add_argument("--with-samples", action="store_true", help="also run the sample submissions in samples/")
+    parser.add_argument("-f", "--force", action="store_true", help="run tests even if they passed before and nothing has changed")
+    parser.add_argument("--state", default=DEFAULT_STATE_PATH, help="where to store the results of the last pass (default: test_state.json)")
+    parser.add_argument("--json", metavar="PATH", help="save the results in JSON")
+    parser.add_argument("--junit", metavar="PATH", help="save the results in JUnit XML")
+    args = parser.parse_args()
+
+    run_opts = []
+    if args.dev:
+        run_opts.append("--dev")
+    if args.image:
+        run_opts += ["--image", os.path.realpath(args.image)]
+
+    runner = TestRunner(run_opts, args.state, args.force)
+
+    package_names = args.packages or sorted(os.listdir(os.path.join(ROOT, "packages")))
+    tests = []
+    for package in package_names:
+        package_tests = runner.collect(package, args.with_samples)
+        if not package_tests:
+            print(f"{package} has no tests")
+        tests += package_tests
+
+    results: list[TestResult] = []
+    with ThreadPoolExecutor(args.jobs or os.cpu_count()) as executor:
+        for result in executor.map(runner.run, tests):
+            results.append(result)
+            if result.status == "skipped":
+                print(f"SKIP {result.package} {result.test}")
+            elif result.status == "passed":
+                print(f"PASS {result.package} {result.test} ({result.time:.1f}s)")
+            else:
+                print(f"FAIL {result.package} {result.test} ({result.time:.1f}s)")
+                if result.output:
+                    print(result.output, end="" if result.output.endswith("\n") else "\n")
+            sys.stdout.flush()
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump([asdict(result) for result in results], f, indent=4)
+    if args.junit:
+        write_junit(args.junit, results)
+
+    counts = {status: sum(result.status == status for result in results) for status in ("passed", "failed", "skipped")}
+    print(f"{counts['passed']} passed, {counts['failed']} failed, {counts['skipped']} skipped")
+    if counts["failed"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
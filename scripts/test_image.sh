@@ -5,12 +5,26 @@ export SUNWALKER_ROOT="$(realpath "$(dirname "$0")/..")"
 
 
 use_dev=0
+use_samples=0
+image=""
+archive=""
 packages=()
 while [[ "$#" -gt 0 ]]; do
 	if [[ "$1" =~ ^-.* ]]; then
 		if [[ "$1" == "--dev" ]]; then
 			use_dev=1
 			shift
+		elif [[ "$1" == "--with-samples" ]]; then
+			use_samples=1
+			shift
+		elif [[ "$1" == "--image" ]]; then
+			shift
+			image="$(realpath "$1")"
+			shift
+		elif [[ "$1" == "--archive" ]]; then
+			shift
+			archive="$(realpath "$1")"
+			shift
 		elif [[ "$1" == "--" ]]; then
 			shift
 			break
@@ -37,11 +51,21 @@ opts=()
 if [[ "$use_dev" == "1" ]]; then
 	opts+=( "--dev" )
 fi
+if [[ -n "$image" ]]; then
+	opts+=( "--image" "$image" )
+fi
+if [[ -n "$archive" ]]; then
+	opts+=( "--archive" "$archive" )
+fi
 
-export SUNWALKER_RUN_OPTS="${opts[@]}"
+# Arrays can't be exported, so run reads the options from a file. declare makes them local to the function.
+export SUNWALKER_RUN_OPTS_FILE="$(mktemp)"
+trap 'rm -f "$SUNWALKER_RUN_OPTS_FILE"' EXIT
+declare -p opts >"$SUNWALKER_RUN_OPTS_FILE"
 
 run() {
-	"$SUNWALKER_ROOT/scripts/run.sh" $SUNWALKER_RUN_OPTS "$SUNWALKER_PACKAGE" "$@"
+	source "$SUNWALKER_RUN_OPTS_FILE"
+	"$SUNWALKER_ROOT/scripts/run.sh" "${opts[@]}" "$SUNWALKER_PACKAGE" "$@"
 }
 export -f run
 
@@ -50,14 +74,25 @@ for pkg in "${packages[@]}"; do
 	export SUNWALKER_PACKAGE="$pkg"
 	pkg_path="$SUNWALKER_ROOT/packages/$pkg"
 
+	# Sample submissions are written like tests, but are only run on request, e.g. when pruning unused files
+	test_dirs=( "$pkg_path/tests" )
+	if [[ "$use_samples" == "1" ]]; then
+		test_dirs+=( "$pkg_path/samples" )
+	fi
+
 	if [[ -d "$pkg_path/tests" ]]; then
 		echo "$pkg"
-		for test_path in "$pkg_path/tests/"*".sh"; do
-			test_name="${test_path##*/}"
-			echo "- $test_name"
-			pushd "$(dirname "$test_path")" >/dev/null
-			"$test_path"
-			popd >/dev/null
+		for test_dir in "${test_dirs[@]}"; do
+			if ! [[ -d "$test_dir" ]]; then
+				continue
+			fi
+			for test_path in "$test_dir/"*".sh"; do
+				test_name="${test_path##*/}"
+				echo "- $test_name"
+				pushd "$(dirname "$test_path")" >/dev/null
+				"$test_path"
+				popd >/dev/null
+			done
 		done
 	else
 		echo "$pkg has no tests"